@@ -3,9 +3,12 @@ from xfel.merging.application.worker import worker
 from dials.array_family import flex
 from dxtbx.model.experiment_list import ExperimentList
 from xfel.merging.application.reflection_table_utils import reflection_table_utils
+from xfel.merging.application.experiment_summary import experiment_summary
 import math
 
 class load_balancer(worker):
+  needs_experiment_models = False
+
   def __init__(self, params, mpi_helper=None, mpi_logger=None):
     super(load_balancer, self).__init__(params=params, mpi_helper=mpi_helper, mpi_logger=mpi_logger)
 
@@ -104,18 +107,27 @@ class load_balancer(worker):
 
     self.logger.log_step_time("LB_EXPTS_CONSOLIDATE")
     self.logger.log("Consolidating experiments after all-to-all...")
-    new_experiments = ExperimentList()
-    for entry in new_split_experiments:
-      new_experiments.extend(entry)
+    if any(isinstance(entry, experiment_summary) for entry in new_split_experiments):
+      new_experiments = experiment_summary.concat(new_split_experiments)
+    else:
+      new_experiments = ExperimentList()
+      for entry in new_split_experiments:
+        new_experiments.extend(entry)
     del new_split_experiments
     self.logger.log_step_time("LB_EXPTS_CONSOLIDATE", True)
 
     return new_experiments
 
+  def alltoall_reflections(self, reflection_chunks, mpi_communicator):
+    '''Exchange reflection chunks between the ranks of mpi_communicator using the method selected by parallel.a2a_method'''
+    if self.params.parallel.a2a_method == 'buffer':
+      return self.mpi_helper.alltoall_reflection_tables(reflection_chunks, comm=mpi_communicator)
+    return mpi_communicator.alltoall(reflection_chunks)
+
   def exchange_reflections_by_alltoall(self, mpi_communicator):
     ''' Run all-to-all and return a new reflection table'''
     self.logger.log_step_time("LB_REFLS_ALL_TO_ALL")
-    new_split_reflections = mpi_communicator.alltoall(self.split_reflections)
+    new_split_reflections = self.alltoall_reflections(self.split_reflections, mpi_communicator)
     del self.split_reflections
     self.logger.log_step_time("LB_REFLS_ALL_TO_ALL", True)
 
@@ -142,7 +154,7 @@ class load_balancer(worker):
         reflection_chunks_for_alltoall.append(list_of_sliced_reflection_chunks[i][j]) # [Aj,Bj,Cj...]
 
       self.logger.log_step_time("ALL-TO-ALL")
-      received_reflection_chunks = mpi_communicator.alltoall(reflection_chunks_for_alltoall)
+      received_reflection_chunks = self.alltoall_reflections(reflection_chunks_for_alltoall, mpi_communicator)
       self.logger.log("After all-to-all received %d reflection chunks" %len(received_reflection_chunks))
       self.logger.log_step_time("ALL-TO-ALL", True)
 
@@ -183,8 +195,8 @@ class load_balancer(worker):
       exp_id_list = flex.std_string()
       chunk_id_list = flex.int()
       for i in range(len(self.split_experiments)):
-        for exp in self.split_experiments[i]:
-          exp_id_list.append(exp.identifier)
+        for identifier in self.split_experiments[i].identifiers():
+          exp_id_list.append(identifier)
           chunk_id_list.append(i)
 
       # distribute reflections over the experiment chunks using a C++ extension
@@ -263,8 +275,8 @@ class load_balancer(worker):
       send_expt_j = experiments[-count:]
       experiments = experiments[:-count]
       send_refl_j = self.reflection_table_stub(reflections)
-      for k, e in enumerate(send_expt_j):
-        sel = emap.values() == e.identifier
+      for identifier in send_expt_j.identifiers():
+        sel = emap.values() == identifier
         assert sel.count(True) == 1
         e_id = emap.keys().select(sel)[0]
         r = reflections.select(reflections['id'] == e_id) # select matching reflections to send
@@ -277,8 +289,8 @@ class load_balancer(worker):
     # tack on only what was targeted to be received by the current rank
     for (received_expt_i, received_refl_i) in recv_data:
       if received_expt_i is None: continue
-      current_ids = set([e.identifier for e in experiments])
-      recv_ids = set([e.identifier for e in received_expt_i])
+      current_ids = set(experiments.identifiers())
+      recv_ids = set(received_expt_i.identifiers())
       assert current_ids.isdisjoint(recv_ids)
       experiments.extend(received_expt_i)
       reflections = flex.reflection_table.concat([reflections, received_refl_i])
@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function
+import sys, time
+import numpy as np
+from dials.array_family import flex
+from xfel.merging.application.reflection_table_utils import reflection_table_utils
+
+"""
+Benchmark of the vectorized odd/even/all merge of reflection_table_utils against the per-HKL loop, on a synthetic
+asu-sorted table. Checks that both give the same merged tables and reports the time of each. Usage:
+  libtbx.python benchmark_reflection_table_utils.py [n_hkls] [mean_multiplicity] [mad_thresh]
+"""
+
+def run(args):
+  n_hkls = int(args[0]) if len(args) > 0 else 20000
+  mean_multiplicity = float(args[1]) if len(args) > 1 else 10
+  thresh = float(args[2]) if len(args) > 2 else None
+
+  rng = np.random.default_rng(0)
+  multiplicities = rng.poisson(mean_multiplicity, n_hkls) + 1
+  n_refls = int(multiplicities.sum())
+  hkl = np.repeat(np.stack([np.arange(n_hkls), np.arange(n_hkls) % 7, np.arange(n_hkls) % 5], axis=1), multiplicities, axis=0)
+  reflections = flex.reflection_table()
+  reflections['miller_index_asymmetric'] = flex.miller_index([tuple(int(x) for x in row) for row in hkl])
+  reflections['intensity.sum.value'] = flex.double(rng.normal(100., 30., n_refls))
+  reflections['intensity.sum.variance'] = flex.double(rng.uniform(-1., 100., n_refls))
+  reflections['id'] = flex.int(rng.integers(0, 1000, n_refls).astype(np.int32))
+  print("Synthetic table: %d HKLs, %d reflections, mad_thresh=%s"%(n_hkls, n_refls, thresh))
+
+  t0 = time.time()
+  odd = reflection_table_utils.select_odd_experiment_reflections(reflections)
+  even = reflection_table_utils.select_even_experiment_reflections(reflections)
+  reference = [reflection_table_utils.merge_reflections_per_hkl(table, 2, thresh=thresh) for table in (odd, even, reflections)]
+  t1 = time.time()
+  vectorized = reflection_table_utils.merge_odd_even_all_reflections(reflections, 2, thresh=thresh)
+  t2 = time.time()
+  print("Per-HKL loop (odd, even, all): %.3f s"%(t1 - t0))
+  print("Vectorized (odd, even, all):   %.3f s"%(t2 - t1))
+
+  for ref, vec in zip(reference, vectorized):
+    assert ref.size() == vec.size()
+    assert np.array_equal(reflection_table_utils.miller_index_as_numpy(ref['miller_index']),
+                          reflection_table_utils.miller_index_as_numpy(vec['miller_index']))
+    assert np.array_equal(ref['multiplicity'].as_numpy_array(), vec['multiplicity'].as_numpy_array())
+    assert np.allclose(ref['intensity'].as_numpy_array(), vec['intensity'].as_numpy_array(), equal_nan=True)
+    assert np.allclose(ref['sigma'].as_numpy_array(), vec['sigma'].as_numpy_array(), equal_nan=True)
+  print("OK")
+
+if __name__ == '__main__':
+  run(sys.argv[1:])
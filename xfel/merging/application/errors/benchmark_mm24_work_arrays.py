@@ -0,0 +1,99 @@
+from __future__ import absolute_import, division, print_function
+import sys, time
+import numpy as np
+from dials.array_family import flex
+from xfel.merging.application.reflection_table_utils import reflection_table_utils
+from xfel.merging.application.errors.error_modifier_mm24 import error_modifier_mm24
+
+"""
+Regression check and benchmark for the batched pairwise-difference generation of the mm24 error model: compare the
+work table built by error_modifier_mm24.setup_work_arrays with the one built by the original per-HKL loop.
+Usage: libtbx.python benchmark_mm24_work_arrays.py [n_hkl] [max_multiplicity]
+"""
+
+def synthetic_reflections(n_hkl, max_multiplicity, seed=0):
+  '''An asu hkl-sorted reflection table with random multiplicities, intensities, variances and correlations'''
+  rng = np.random.default_rng(seed)
+  multiplicity = rng.integers(1, max_multiplicity + 1, n_hkl)
+  hkl = np.unique(rng.integers(-60, 60, (3*n_hkl, 3)), axis=0)[:n_hkl]
+  multiplicity = multiplicity[:len(hkl)]
+  n = int(multiplicity.sum())
+  reflections = flex.reflection_table()
+  reflections['miller_index_asymmetric'] = flex.miller_index([tuple(int(v) for v in row) for row in np.repeat(hkl, multiplicity, axis=0)])
+  reflections['intensity.sum.value'] = flex.double(rng.gamma(1., 1000., n))
+  reflections['intensity.sum.variance'] = flex.double(rng.uniform(10., 1000., n))
+  reflections['correlation'] = flex.double(rng.uniform(0., 1., n))
+  return reflections
+
+def setup_work_arrays_per_hkl(modifier, reflections):
+  '''The original per-HKL implementation of setup_work_arrays. Returns the work table and the biased means.'''
+  def pairing(k1, k2):
+    return int((k1 + k2) * (k1 + k2 + 1) / 2 + k2)
+  params = modifier.params
+  columns = {key: flex.double() for key in ['pairwise_differences', 'biased_mean', 'counting_stats_var_i',
+                                            'counting_stats_var_j', 'correlation_i', 'correlation_j']}
+  biased_mean_to_reflections = flex.double()
+  for refls in reflection_table_utils.get_next_hkl_reflection_table(reflections):
+    number_of_measurements = refls.size()
+    if number_of_measurements == 0:
+      break
+    refls_biased_mean = flex.double(len(refls), flex.mean(refls['intensity.sum.value']))
+    biased_mean_to_reflections.extend(refls_biased_mean)
+    if number_of_measurements > params.merging.minimum_multiplicity:
+      I = refls['intensity.sum.value'].as_numpy_array()
+      var_cs = refls['intensity.sum.variance'].as_numpy_array()
+      correlation = refls[modifier.cc_key].as_numpy_array()
+      indices = np.triu_indices(n=I.size, k=1)
+      N = indices[0].size
+      if modifier.limit_differences == False:
+        if N > params.merging.error.mm24.n_max_differences:
+          hkl = refls[0]['miller_index_asymmetric']
+          hkl_hash = pairing(pairing(hkl[0]+1000, hkl[1]+1000), hkl[2]+1000)
+          rng = np.random.default_rng(seed=hkl_hash + params.merging.error.mm24.random_seed)
+          sort_indices = np.argsort(I)
+          rng.shuffle(sort_indices)
+          I = I[sort_indices]
+          var_cs = var_cs[sort_indices]
+          correlation = correlation[sort_indices]
+          if N > 1000:
+            subset_indices = rng.choice(N, size=params.merging.error.mm24.n_max_differences, replace=False, shuffle=False)
+          else:
+            subset_indices = rng.permutation(N)[:params.merging.error.mm24.n_max_differences]
+          indices = (indices[0][subset_indices], indices[1][subset_indices])
+          N = params.merging.error.mm24.n_max_differences
+      columns['pairwise_differences'].extend(flex.double(np.abs(I[indices[0]] - I[indices[1]])))
+      columns['biased_mean'].extend(flex.double(N, refls_biased_mean[0]))
+      columns['counting_stats_var_i'].extend(flex.double(var_cs[indices[0]]))
+      columns['counting_stats_var_j'].extend(flex.double(var_cs[indices[1]]))
+      columns['correlation_i'].extend(flex.double(correlation[indices[0]]))
+      columns['correlation_j'].extend(flex.double(correlation[indices[1]]))
+  return columns, biased_mean_to_reflections
+
+if __name__ == '__main__':
+  n_hkl = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  max_multiplicity = int(sys.argv[2]) if len(sys.argv) > 2 else 80
+
+  from xfel.merging.application.phil.phil import phil_scope
+  params = phil_scope.extract()
+  params.merging.error.model = 'mm24'
+  reflections = synthetic_reflections(n_hkl, max_multiplicity)
+  print("Synthetic data: %d asu HKLs, %d reflections"%(n_hkl, len(reflections)))
+
+  for n_max_differences in [params.merging.error.mm24.n_max_differences, None]:
+    params.merging.error.mm24.n_max_differences = n_max_differences
+    modifier = error_modifier_mm24(params)
+    t0 = time.time()
+    reference, reference_biased_mean = setup_work_arrays_per_hkl(modifier, reflections)
+    t1 = time.time()
+    modifier.setup_work_arrays(reflections)
+    t2 = time.time()
+    print("n_max_differences=%s: %d differences"%(n_max_differences, len(modifier.work_table)))
+    print("  per HKL: %.3f s"%(t1 - t0))
+    print("  batched: %.3f s"%(t2 - t1))
+    # The group means are summed in a different order, so they agree to rounding; everything else is identical
+    for key in ['pairwise_differences', 'counting_stats_var_i', 'counting_stats_var_j', 'correlation_i', 'correlation_j']:
+      assert np.array_equal(reference[key].as_numpy_array(), modifier.work_table[key].as_numpy_array()), key
+    assert np.allclose(reference['biased_mean'].as_numpy_array(), modifier.work_table['biased_mean'].as_numpy_array(), rtol=1e-12)
+    assert np.allclose(reference_biased_mean.as_numpy_array(), reflections['biased_mean'].as_numpy_array(), rtol=1e-12)
+    del reflections['biased_mean']
+  print("OK")
@@ -94,51 +94,42 @@ class error_modifier_ev11(worker):
     comm = self.mpi_helper.comm
     MPI = self.mpi_helper.MPI
 
-    for reflections in self.intensity_bins:
-      number_of_reflections_in_bin = reflections.size()
+    # Evaluate all work reflections at once and sum the terms per intensity bin; one reduction for all bins
+    sums_rank = np.zeros((4, number_of_intensity_bins))
+    if self.work_table.size() > 0:
+      variance = self.work_table['var']
+      mean_intensity = self.work_table['biased_mean'] # the mean intensity of the sample of HKLs which includes this reflection
+
+      var_ev11               = self.sfac**2*(variance + self.sb**2*mean_intensity + self.sadd**2*mean_intensity**2)
+      var_ev11_der_over_sfac = 2*self.sfac * (variance + self.sb**2 * mean_intensity + self.sadd**2 * mean_intensity**2)
+      var_ev11_der_over_sb   = self.sfac**2 * 2*self.sb   * mean_intensity
+      var_ev11_der_over_sadd = self.sfac**2 * 2*self.sadd * mean_intensity**2
+
+      delta_sq_over_var_sq = self.work_table['delta_sq'] / var_ev11**2
+      sums_rank[0] = self.sum_over_intensity_bins(self.work_table['delta_sq'] / var_ev11)
+      sums_rank[1] = -self.sum_over_intensity_bins(delta_sq_over_var_sq * var_ev11_der_over_sfac)
+      sums_rank[2] = -self.sum_over_intensity_bins(delta_sq_over_var_sq * var_ev11_der_over_sb)
+      sums_rank[3] = -self.sum_over_intensity_bins(delta_sq_over_var_sq * var_ev11_der_over_sadd)
+
+    sums = np.empty_like(sums_rank)
+    comm.Reduce(sums_rank, sums, op=MPI.SUM, root=0)
 
-      sum_of_delta_squared_in_bin = flex.double(number_of_reflections_in_bin, 0)
-      sum_of_der_wrt_sfac_in_bin  = flex.double(number_of_reflections_in_bin, 0)
-      sum_of_der_wrt_sb_in_bin    = flex.double(number_of_reflections_in_bin, 0)
-      sum_of_der_wrt_sadd_in_bin  = flex.double(number_of_reflections_in_bin, 0)
-
-      if number_of_reflections_in_bin > 0:
-        variance = reflections['var']
-        mean_intensity = reflections['biased_mean'] # the mean intensity of the sample of HKLs which includes this reflection
-
-        var_ev11               = self.sfac**2*(variance + self.sb**2*mean_intensity + self.sadd**2*mean_intensity**2)
-        var_ev11_der_over_sfac = 2*self.sfac * (variance + self.sb**2 * mean_intensity + self.sadd**2 * mean_intensity**2)
-        var_ev11_der_over_sb   = self.sfac**2 * 2*self.sb   * mean_intensity
-        var_ev11_der_over_sadd = self.sfac**2 * 2*self.sadd * mean_intensity**2
-
-        sum_of_delta_squared_in_bin += reflections['delta_sq'] / var_ev11
-
-        sum_of_der_wrt_sfac_in_bin  -= reflections['delta_sq'] / var_ev11**2 * var_ev11_der_over_sfac
-        sum_of_der_wrt_sb_in_bin    -= reflections['delta_sq'] / var_ev11**2 * var_ev11_der_over_sb
-        sum_of_der_wrt_sadd_in_bin  -= reflections['delta_sq'] / var_ev11**2 * var_ev11_der_over_sadd
-
-      global_number_of_reflections_in_bin   = comm.reduce(number_of_reflections_in_bin, MPI.SUM, root=0)
-      global_sum_of_delta_squared_in_bin    = comm.reduce(flex.sum(sum_of_delta_squared_in_bin),  MPI.SUM, root=0)
-      global_sum_of_der_wrt_sfac_in_bin     = comm.reduce(flex.sum(sum_of_der_wrt_sfac_in_bin),   MPI.SUM, root=0)
-      global_sum_of_der_wrt_sb_in_bin       = comm.reduce(flex.sum(sum_of_der_wrt_sb_in_bin),     MPI.SUM, root=0)
-      global_sum_of_der_wrt_sadd_in_bin     = comm.reduce(flex.sum(sum_of_der_wrt_sadd_in_bin),   MPI.SUM, root=0)
-
-      if self.mpi_helper.rank == 0:
-        if global_number_of_reflections_in_bin > 0 and global_sum_of_delta_squared_in_bin > 0:
-
-          global_weight_for_bin = math.sqrt(global_number_of_reflections_in_bin)
-
-          func += global_weight_for_bin * (1 - math.sqrt(global_sum_of_delta_squared_in_bin/global_number_of_reflections_in_bin))**2
+    if self.mpi_helper.rank == 0:
+      global_number_of_reflections_in_bin = self.global_number_of_reflections_in_bin
+      global_sum_of_delta_squared_in_bin = sums[0]
+      good_bins = (global_number_of_reflections_in_bin > 0) & (global_sum_of_delta_squared_in_bin > 0)
+      n_in_bin = global_number_of_reflections_in_bin[good_bins]
 
-          #if global_sum_of_delta_squared_in_bin == 0:
-          #  from IPython import embed;embed()
+      global_weight_for_bin = np.sqrt(n_in_bin)
+      root_mean_delta_squared = np.sqrt(global_sum_of_delta_squared_in_bin[good_bins]/n_in_bin)
 
-          der_temp = global_weight_for_bin * (1 / math.sqrt(global_sum_of_delta_squared_in_bin/global_number_of_reflections_in_bin) - 1)  / global_number_of_reflections_in_bin
+      func = float(np.sum(global_weight_for_bin * (1 - root_mean_delta_squared)**2))
 
-          der_wrt_sfac  -= der_temp * global_sum_of_der_wrt_sfac_in_bin
-          der_wrt_sb    -= der_temp * global_sum_of_der_wrt_sb_in_bin
-          der_wrt_sadd  -= der_temp * global_sum_of_der_wrt_sadd_in_bin
+      der_temp = global_weight_for_bin * (1 / root_mean_delta_squared - 1) / n_in_bin
 
+      der_wrt_sfac  = -float(np.sum(der_temp * sums[1][good_bins]))
+      der_wrt_sb    = -float(np.sum(der_temp * sums[2][good_bins]))
+      der_wrt_sadd  = -float(np.sum(der_temp * sums[3][good_bins]))
 
     #if self.mpi_helper.rank==0:
     #  self.functional = functional
@@ -369,24 +360,29 @@ class error_modifier_ev11(worker):
     self.sadd  = initial_params[1]
     self.sb    = initial_params[2]
 
+  def sum_over_intensity_bins(self, values):
+    '''Per-bin sums of a work table quantity'''
+    return np.bincount(self.work_bin_indices, weights=values.as_numpy_array(), minlength=number_of_intensity_bins + 1)[:-1]
+
   def distribute_reflections_over_intensity_bins(self):
-    self.intensity_bins = []
+    '''Assign intensity bins in one pass and sort the work table by bin, so that each bin is a contiguous slice
+    intensity_bin_offsets[i]:intensity_bin_offsets[i+1]. The global reflection counts per bin are reduced once.'''
     count = self.work_table.size()
 
-    for bin_begin in range(number_of_intensity_bins):
-      self.intensity_bins.append(flex.reflection_table())
-
-      test_1 = self.work_table['biased_mean'] >= flex.double(count, self.intensity_bin_limits[bin_begin])
-      test_2 = self.work_table['biased_mean'] < flex.double(count, self.intensity_bin_limits[bin_begin + 1])
-
-      sel = self.work_table.select(test_1 & test_2)
+    bin_indices = np.searchsorted(self.intensity_bin_limits, self.work_table['biased_mean'].as_numpy_array(), side='right') - 1
+    bin_indices[(bin_indices < 0) | (bin_indices >= number_of_intensity_bins)] = number_of_intensity_bins
+    order = np.argsort(bin_indices, kind='stable')
+    self.work_table = self.work_table.select(flex.size_t(order.astype(np.uint64)))
+    self.work_bin_indices = bin_indices[order]
+    number_of_reflections_in_bin = np.bincount(self.work_bin_indices, minlength=number_of_intensity_bins + 1)[:-1]
+    self.intensity_bin_offsets = np.concatenate([[0], np.cumsum(number_of_reflections_in_bin)])
 
-      self.intensity_bins[bin_begin].extend(sel)
+    self.global_number_of_reflections_in_bin = np.empty(number_of_intensity_bins, dtype=np.int64)
+    self.mpi_helper.comm.Allreduce(number_of_reflections_in_bin.astype(np.int64), self.global_number_of_reflections_in_bin,
+                                   op=self.mpi_helper.MPI.SUM)
 
     # for debugging
-    number_of_refls_distributed = 0
-    for intensity_bin in self.intensity_bins:
-      number_of_refls_distributed += intensity_bin.size()
+    number_of_refls_distributed = int(self.intensity_bin_offsets[-1])
     self.logger.log("Distributed over intensity bins %d out of %d reflections"%(number_of_refls_distributed, count))
 
   def run_minimizer(self):
@@ -64,81 +64,98 @@ class error_modifier_mm24(worker):
     del reflections['biased_mean']
     return reflections
 
-  def setup_work_arrays(self, reflections):
+  @staticmethod
+  def _hkl_hash(hkl):
+    # Convert hkl to a hash with Cantor's pairing function.
+    # Add 1000 to keep inputs positive.
     def pairing(k1, k2):
       return int((k1 + k2) * (k1 + k2 + 1) / 2 + k2)
+    return pairing(pairing(int(hkl[0])+1000, int(hkl[1])+1000), int(hkl[2])+1000)
+
+  @staticmethod
+  def _triu_rows(k, m):
+    '''Row and column of the k-th entry of np.triu_indices(n=m, k=1), without building the full index arrays'''
+    b = 2*m - 1
+    i = np.floor((b - np.sqrt(float(b)**2 - 8*k)) / 2).astype(np.int64)
+    row_start = lambda i: i*m - i*(i+1)//2
+    i = np.where(row_start(i+1) <= k, i+1, i)
+    i = np.where(row_start(i) > k, i-1, i)
+    return i, k - row_start(i) + i + 1
+
+  def get_pairwise_difference_rows(self, hkl, I, offsets, selected):
+    '''Rows (i, j) of the pairwise differences within the selected hkl groups of an asu hkl-sorted table.
+    Group g spans rows offsets[g]:offsets[g+1]. Pairs come out in group order and, within a group, in
+    np.triu_indices order, so they match the per-HKL loop. Groups with more than n_max_differences pairs are
+    subsampled with the same per-HKL random number generator as before, so the result does not depend on the
+    number of ranks. Returns the two row arrays and the pair offsets of the selected groups.'''
+    starts = offsets[:-1][selected]
+    multiplicity = np.diff(offsets)[selected]
+    n_pairs = multiplicity * (multiplicity - 1) // 2
+    n_max_differences = self.params.merging.error.mm24.n_max_differences
+    subsampled = n_pairs > n_max_differences if self.limit_differences == False else np.zeros(len(starts), dtype=bool)
+    n_pairs[subsampled] = n_max_differences
+    pair_offsets = np.concatenate([[0], np.cumsum(n_pairs)]).astype(np.int64)
+    rows_i = np.empty(pair_offsets[-1], dtype=np.int64)
+    rows_j = np.empty(pair_offsets[-1], dtype=np.int64)
+
+    # Full sets of pairs: one np.triu_indices per distinct multiplicity, placed for all its groups at once
+    full = ~subsampled
+    for m in np.unique(multiplicity[full]):
+      groups = np.flatnonzero(full & (multiplicity == m))
+      triu_i, triu_j = np.triu_indices(n=m, k=1)
+      destination = pair_offsets[groups][:, np.newaxis] + np.arange(triu_i.size)
+      rows_i[destination] = starts[groups][:, np.newaxis] + triu_i
+      rows_j[destination] = starts[groups][:, np.newaxis] + triu_j
+
+    # Subsampled groups: random number generation needs to be consistent between symmetry related reflections
+    # for reproducibility
+    for g in np.flatnonzero(subsampled):
+      begin, m = starts[g], multiplicity[g]
+      N = m * (m - 1) // 2
+      rng = np.random.default_rng(seed=self._hkl_hash(hkl[begin]) + self.params.merging.error.mm24.random_seed)
+      # Reflections are in different order when run with different numbers of ranks
+      sort_indices = np.argsort(I[begin:begin + m])
+      rng.shuffle(sort_indices)
+      # this option is for performance trade-offs
+      if N > 1000:
+        subset_indices = rng.choice(N, size=n_max_differences, replace=False, shuffle=False)
+      else:
+        subset_indices = rng.permutation(N)[:n_max_differences]
+      triu_i, triu_j = self._triu_rows(subset_indices, m)
+      rows_i[pair_offsets[g]:pair_offsets[g+1]] = begin + sort_indices[triu_i]
+      rows_j[pair_offsets[g]:pair_offsets[g+1]] = begin + sort_indices[triu_j]
+    return rows_i, rows_j, pair_offsets
 
+  def setup_work_arrays(self, reflections):
+    '''Build the work table of pairwise differences within each multiply-measured asu HKL, in bulk from the
+    hkl group offsets of the sorted reflection table'''
+    offsets = reflection_table_utils.get_hkl_group_offsets(reflections)
+    multiplicity = np.diff(offsets)
+    I = reflections['intensity.sum.value'].as_numpy_array()
+    var_cs = reflections['intensity.sum.variance'].as_numpy_array()
+    correlation = reflections[self.cc_key].as_numpy_array()
+    hkl = reflection_table_utils.miller_index_as_numpy(reflections['miller_index_asymmetric'])
+
+    if len(multiplicity) > 0:
+      group_biased_means = np.add.reduceat(I, offsets[:-1]) / multiplicity
+    else:
+      group_biased_means = np.zeros(0)
+    self.refl_biased_means = list(group_biased_means)
+    selected = multiplicity > self.params.merging.minimum_multiplicity
+    number_of_reflections = int(multiplicity[selected].sum())
+    # Used to calculate the number of reflections in each intensity bin
+    self.biased_mean_count = flex.double(np.repeat(group_biased_means[selected], multiplicity[selected]))
+
+    rows_i, rows_j, pair_offsets = self.get_pairwise_difference_rows(hkl, I, offsets, selected)
     self.work_table = flex.reflection_table()
-    self.refl_biased_means = []
-    biased_mean = flex.double() # Go with the pairwise differences in self.work_table
-    biased_mean_to_reflections = flex.double() # Put into the original reflection table
-    self.biased_mean_count = flex.double() # Used to calculate the number of reflections in each intensity bin
-    pairwise_differences = flex.double()
-    pairwise_differences_normalized = flex.double()
-    counting_stats_var_i = flex.double()
-    counting_stats_var_j = flex.double()
-    correlation_i = flex.double()
-    correlation_j = flex.double()
-    number_of_reflections = 0
-
-    for refls in reflection_table_utils.get_next_hkl_reflection_table(reflections):
-      number_of_measurements = refls.size()
-      # if the returned "refls" list is empty, it's the end of the input "reflections" list
-      if number_of_measurements == 0:
-        break
-      refls_biased_mean = flex.double(len(refls), flex.mean(refls['intensity.sum.value']))
-      biased_mean_to_reflections.extend(refls_biased_mean)
-      self.refl_biased_means.append(refls_biased_mean[0])
-      if number_of_measurements > self.params.merging.minimum_multiplicity:
-        I = refls['intensity.sum.value'].as_numpy_array()
-        var_cs = refls['intensity.sum.variance'].as_numpy_array()
-        correlation = refls[self.cc_key].as_numpy_array()
-        number_of_reflections += I.size
-        self.biased_mean_count.extend(flex.double(I.size, refls_biased_mean[0]))
-        indices = np.triu_indices(n=I.size, k=1)
-        N = indices[0].size
-        if self.limit_differences == False:
-          if N > self.params.merging.error.mm24.n_max_differences:
-            # random number generation needs to be consistent between symmetry related reflections
-            # for reproducibility
-            hkl = refls[0]['miller_index_asymmetric']
-            # Convert hkl to a hash with Cantor's pairing function.
-            # Add 1000 to keep inputs positive.
-            hkl_hash = pairing(pairing(hkl[0]+1000, hkl[1]+1000), hkl[2]+1000)
-            rng = np.random.default_rng(seed=hkl_hash + self.params.merging.error.mm24.random_seed)
-            # Reflections are in different order when run with different numbers of ranks
-            sort_indices = np.argsort(I)
-            rng.shuffle(sort_indices)
-            I = I[sort_indices]
-            var_cs = var_cs[sort_indices]
-            correlation = correlation[sort_indices]
-            # this option is for performance trade-offs
-            if N > 1000:
-              subset_indices = rng.choice(
-                N,
-                size=self.params.merging.error.mm24.n_max_differences,
-                replace=False,
-                shuffle=False
-                )
-            else:
-              subset_indices = rng.permutation(N)[:self.params.merging.error.mm24.n_max_differences]
-            indices = (indices[0][subset_indices], indices[1][subset_indices])
-            N = self.params.merging.error.mm24.n_max_differences
-        differences = flex.double(np.abs(I[indices[0]] - I[indices[1]]))
-        pairwise_differences.extend(differences)
-        biased_mean.extend(flex.double(N, refls_biased_mean[0]))
-        counting_stats_var_i.extend(flex.double(var_cs[indices[0]]))
-        counting_stats_var_j.extend(flex.double(var_cs[indices[1]]))
-        correlation_i.extend(flex.double(correlation[indices[0]]))
-        correlation_j.extend(flex.double(correlation[indices[1]]))
-
-    self.work_table['pairwise_differences'] = pairwise_differences
-    self.work_table['biased_mean'] = biased_mean
-    self.work_table['counting_stats_var_i'] = counting_stats_var_i
-    self.work_table['counting_stats_var_j'] = counting_stats_var_j
-    self.work_table['correlation_i'] = correlation_i
-    self.work_table['correlation_j'] = correlation_j
-    reflections['biased_mean'] = biased_mean_to_reflections
+    self.work_table['pairwise_differences'] = flex.double(np.abs(I[rows_i] - I[rows_j]))
+    self.work_table['biased_mean'] = flex.double(np.repeat(group_biased_means[selected], np.diff(pair_offsets)))
+    self.work_table['counting_stats_var_i'] = flex.double(var_cs[rows_i])
+    self.work_table['counting_stats_var_j'] = flex.double(var_cs[rows_j])
+    self.work_table['correlation_i'] = flex.double(correlation[rows_i])
+    self.work_table['correlation_j'] = flex.double(correlation[rows_j])
+    # Put into the original reflection table
+    reflections['biased_mean'] = flex.double(np.repeat(group_biased_means, multiplicity))
 
     self.logger.log(f"Number of work reflections selected: {number_of_reflections}")
     return reflections
@@ -160,55 +177,58 @@ class error_modifier_mm24(worker):
       self.intensity_bin_limits = np.empty(self.number_of_intensity_bins + 1)
     self.mpi_helper.comm.Bcast(self.intensity_bin_limits, root=0)
 
+  def assign_intensity_bins(self, values):
+    '''Intensity bin of each value, with self.number_of_intensity_bins for values outside the bin limits'''
+    bin_indices = np.searchsorted(self.intensity_bin_limits, values, side='right') - 1
+    bin_indices[(bin_indices < 0) | (bin_indices >= self.number_of_intensity_bins)] = self.number_of_intensity_bins
+    return bin_indices
+
+  def sum_over_intensity_bins(self, values):
+    '''Per-bin sums of a work table quantity'''
+    if isinstance(values, flex.double):
+      values = values.as_numpy_array()
+    return np.bincount(self.work_bin_indices, weights=values, minlength=self.number_of_intensity_bins + 1)[:-1]
+
   def distribute_differences_over_intensity_bins(self):
-    self.intensity_bins = [flex.reflection_table() for i in range(self.number_of_intensity_bins)]
-    self.n_differences_in_bin = flex.double(self.number_of_intensity_bins, 0)
-    self.n_refls_in_bin = flex.double(self.number_of_intensity_bins, 0)
-    self.bin_weighting = flex.double(self.number_of_intensity_bins, 0)
+    '''Sort the work table by intensity bin, so that each bin is the contiguous slice
+    intensity_bin_offsets[i]:intensity_bin_offsets[i+1]. Differences outside the bin limits go to the end.
+    The global counts of differences and reflections per bin are reduced in one collective.'''
     count = self.work_table.size()
-    for bin_index in range(self.number_of_intensity_bins):
-      subset_work_table = self.work_table.select(
-        (self.work_table['biased_mean'] >= self.intensity_bin_limits[bin_index])
-        & (self.work_table['biased_mean'] < self.intensity_bin_limits[bin_index + 1])
-        )
-      self.intensity_bins[bin_index].extend(subset_work_table)
-      self.n_differences_in_bin[bin_index] = self.mpi_helper.comm.allreduce(
-        len(subset_work_table), self.mpi_helper.MPI.SUM
-        )
-
-      subset_biased_mean = self.biased_mean_count.select(
-        (self.biased_mean_count >= self.intensity_bin_limits[bin_index])
-        & (self.biased_mean_count < self.intensity_bin_limits[bin_index + 1])
-        )
-      self.n_refls_in_bin[bin_index] = self.mpi_helper.comm.allreduce(
-        len(subset_biased_mean), self.mpi_helper.MPI.SUM
-        )
-      if self.n_differences_in_bin[bin_index] > 0:
-        self.bin_weighting[bin_index] = math.sqrt(self.n_refls_in_bin[bin_index]) / self.n_differences_in_bin[bin_index]
+    bin_indices = self.assign_intensity_bins(self.work_table['biased_mean'].as_numpy_array())
+    order = np.argsort(bin_indices, kind='stable')
+    self.work_table = self.work_table.select(flex.size_t(order.astype(np.uint64)))
+    self.work_bin_indices = bin_indices[order]
+    n_differences_in_bin_rank = np.bincount(self.work_bin_indices, minlength=self.number_of_intensity_bins + 1)
+    self.intensity_bin_offsets = np.concatenate([[0], np.cumsum(n_differences_in_bin_rank[:-1])])
+
+    refl_bin_indices = self.assign_intensity_bins(self.biased_mean_count.as_numpy_array())
+    n_refls_in_bin_rank = np.bincount(refl_bin_indices, minlength=self.number_of_intensity_bins + 1)
+
+    counts_rank = np.stack([n_differences_in_bin_rank[:-1], n_refls_in_bin_rank[:-1]]).astype(np.float64)
+    counts = np.empty_like(counts_rank)
+    self.mpi_helper.comm.Allreduce(counts_rank, counts, op=self.mpi_helper.MPI.SUM)
+    self.n_differences_in_bin = flex.double(counts[0])
+    self.n_refls_in_bin = flex.double(counts[1])
+    bin_weighting = np.zeros(self.number_of_intensity_bins)
+    populated = counts[0] > 0
+    bin_weighting[populated] = np.sqrt(counts[1][populated]) / counts[0][populated]
+    self.bin_weighting = flex.double(bin_weighting)
 
     # for debugging
-    number_of_differences_distributed = 0
-    for intensity_bin in self.intensity_bins:
-      number_of_differences_distributed += intensity_bin.size()
+    number_of_differences_distributed = int(self.intensity_bin_offsets[-1])
     self.logger.log(
       "Distributed over intensity bins %d out of %d differences"
       % (number_of_differences_distributed, count)
       )
 
   def initialize_mm24_params(self):
-    mean_differences = np.zeros(self.number_of_intensity_bins)
-    for bin_index, differences in enumerate(self.intensity_bins):
-      summation = self.mpi_helper.comm.reduce(
-        flex.sum(differences['pairwise_differences']), op=self.mpi_helper.MPI.SUM, root=0
-        )
-      counts = self.mpi_helper.comm.reduce(
-        len(differences['pairwise_differences']), op=self.mpi_helper.MPI.SUM, root=0
-        )
-      if self.mpi_helper.rank == 0:
-        if counts > 0:
-          mean_differences[bin_index] = summation / counts
-        else:
-          mean_differences[bin_index] = np.nan
+    summation_rank = self.sum_over_intensity_bins(self.work_table['pairwise_differences'])
+    summation = np.empty_like(summation_rank)
+    self.mpi_helper.comm.Reduce(summation_rank, summation, op=self.mpi_helper.MPI.SUM, root=0)
+    if self.mpi_helper.rank == 0:
+      counts = self.n_differences_in_bin.as_numpy_array()
+      mean_differences = np.full(self.number_of_intensity_bins, np.nan)
+      mean_differences[counts > 0] = summation[counts > 0] / counts[counts > 0]
 
     if self.mpi_helper.rank == 0:
       def fitting_equation(params, bin_centers, mean_differences_0, return_jac):
@@ -545,67 +565,63 @@ class error_modifier_mm24(worker):
       return var
 
   def calculate_functional(self):
+    '''Evaluate the loss over the whole work table at once and sum it per intensity bin. The per-bin sums of
+    the functional and of each gradient component are reduced to rank 0 in one collective.'''
     comm = self.mpi_helper.comm
     MPI = self.mpi_helper.MPI
-    L_bin_rank = flex.double(self.number_of_intensity_bins, 0)
-    dL_dsfac_bin_rank = flex.double(self.number_of_intensity_bins, 0)
-    dL_dsadd_bin_rank = [flex.double(self.number_of_intensity_bins, 0) for i in range(self.n_coefs)]
-    if self.params.merging.error.mm24.tuning_param_opt:
-      dL_dnu_bin_rank = flex.double(self.number_of_intensity_bins, 0)
-
-    for bin_index, differences in enumerate(self.intensity_bins):
-      if len(differences) > 0:
-        var_i, dvar_i_dsfac, dvar_i_dsadd, dsadd_i_dsaddi = self._get_var_mm24(
-          differences['counting_stats_var_i'],
-          differences['biased_mean'],
-          differences['correlation_i'],
-          return_der=True
-          )
-        var_j, dvar_j_dsfac, dvar_j_dsadd, dsadd_j_dsaddi = self._get_var_mm24(
-          differences['counting_stats_var_j'],
-          differences['biased_mean'],
-          differences['correlation_j'],
-          return_der=True
-          )
+    differences = self.work_table
+    n_terms = 2 + self.n_coefs + 1
+    sums_rank = np.zeros((n_terms, self.number_of_intensity_bins))
+
+    if len(differences) > 0:
+      var_i, dvar_i_dsfac, dvar_i_dsadd, dsadd_i_dsaddi = self._get_var_mm24(
+        differences['counting_stats_var_i'],
+        differences['biased_mean'],
+        differences['correlation_i'],
+        return_der=True
+        )
+      var_j, dvar_j_dsfac, dvar_j_dsadd, dsadd_j_dsaddi = self._get_var_mm24(
+        differences['counting_stats_var_j'],
+        differences['biased_mean'],
+        differences['correlation_j'],
+        return_der=True
+        )
 
-        if self.params.merging.error.mm24.likelihood == 'normal':
-          L_in_bin, dL_dvar_x = self._loss_function_normal(
+      if self.params.merging.error.mm24.likelihood == 'normal':
+        L_in_bin, dL_dvar_x = self._loss_function_normal(
+          differences['pairwise_differences'], var_i, var_j
+          )
+      elif self.params.merging.error.mm24.likelihood == 't-dist':
+        if self.params.merging.error.mm24.tuning_param_opt:
+          L_in_bin, dL_dvar_x, dL_dnu = self._loss_function_t_v_opt(
             differences['pairwise_differences'], var_i, var_j
             )
-        elif self.params.merging.error.mm24.likelihood == 't-dist':
-          if self.params.merging.error.mm24.tuning_param_opt:
-            L_in_bin, dL_dvar_x, dL_dnu = self._loss_function_t_v_opt(
-              differences['pairwise_differences'], var_i, var_j
-              )
-            dL_dnu_bin_rank[bin_index] = flex.sum(dL_dnu)
-          else:
-            L_in_bin, dL_dvar_x = self._loss_function_t(
-              differences['pairwise_differences'], var_i, var_j
-              )
-
-        L_bin_rank[bin_index] = flex.sum(L_in_bin)
-        dL_dsfac_bin_rank[bin_index] = flex.sum(dL_dvar_x * (dvar_i_dsfac + dvar_j_dsfac))
-        for degree_index in range(self.n_coefs):
-          dL_dsadd_bin_rank[degree_index][bin_index] = flex.sum(dL_dvar_x * (
-            dvar_i_dsadd * dsadd_i_dsaddi[degree_index] + dvar_j_dsadd * dsadd_j_dsaddi[degree_index]
-            ))
-
-    L_bin = comm.reduce(L_bin_rank, MPI.SUM, root=0)
-    dL_dsfac_bin = comm.reduce(dL_dsfac_bin_rank, MPI.SUM, root=0)
-    dL_dsadd_bin = [None for i in range(self.n_coefs)]
-    for degree_index in range(self.n_coefs):
-      dL_dsadd_bin[degree_index] = comm.reduce(dL_dsadd_bin_rank[degree_index], MPI.SUM, root=0)
-    if self.params.merging.error.mm24.tuning_param_opt:
-      dL_dnu_bin = comm.reduce(dL_dnu_bin_rank, MPI.SUM, root=0)
+          sums_rank[-1] = self.sum_over_intensity_bins(dL_dnu)
+        else:
+          L_in_bin, dL_dvar_x = self._loss_function_t(
+            differences['pairwise_differences'], var_i, var_j
+            )
+
+      sums_rank[0] = self.sum_over_intensity_bins(L_in_bin)
+      sums_rank[1] = self.sum_over_intensity_bins(dL_dvar_x * (dvar_i_dsfac + dvar_j_dsfac))
+      for degree_index in range(self.n_coefs):
+        sums_rank[2 + degree_index] = self.sum_over_intensity_bins(dL_dvar_x * (
+          dvar_i_dsadd * dsadd_i_dsaddi[degree_index] + dvar_j_dsadd * dsadd_j_dsaddi[degree_index]
+          ))
+
+    sums = np.empty_like(sums_rank)
+    comm.Reduce(sums_rank, sums, op=MPI.SUM, root=0)
 
     if self.mpi_helper.rank == 0:
-      self.L = flex.sum(self.bin_weighting * L_bin)
-      self.dL_dsfac = flex.sum(self.bin_weighting * dL_dsfac_bin)
+      bin_weighting = self.bin_weighting.as_numpy_array()
+      weighted_sums = sums @ bin_weighting
+      self.L = float(weighted_sums[0])
+      self.dL_dsfac = float(weighted_sums[1])
       self.dL_dsadd = [0 for i in range(self.n_coefs)]
       for degree_index in range(self.n_coefs):
-        self.dL_dsadd[degree_index] = flex.sum(self.bin_weighting * dL_dsadd_bin[degree_index])
+        self.dL_dsadd[degree_index] = float(weighted_sums[2 + degree_index])
       if self.params.merging.error.mm24.tuning_param_opt:
-        self.dL_dnu = flex.sum(self.bin_weighting * dL_dnu_bin)
+        self.dL_dnu = float(weighted_sums[-1])
 
   def plot_diagnostics(self, reflections):
     I_scale = 100000
@@ -736,25 +752,22 @@ class error_modifier_mm24(worker):
         binned_scale[bin_index] = np.median(all_median_differences) * conversion_factor
 
     # Get all the pairwise differences onto rank 0 for plotting
-    pairwise_differences = []
-    for bin_index, differences in enumerate(self.intensity_bins):
-      if len(differences) > 0:
-        var_i = self._get_var_mm24(
-          differences['counting_stats_var_i'],
-          differences['biased_mean'],
-          differences['correlation_i'],
-          return_der=False
-          )
-        var_j = self._get_var_mm24(
-          differences['counting_stats_var_j'],
-          differences['biased_mean'],
-          differences['correlation_j'],
-          return_der=False
-          )
-        normalized_differences = differences['pairwise_differences'] / flex.sqrt(var_i + var_j)
-        pairwise_differences.append(normalized_differences.as_numpy_array())
+    differences = self.work_table
+    var_i = self._get_var_mm24(
+      differences['counting_stats_var_i'],
+      differences['biased_mean'],
+      differences['correlation_i'],
+      return_der=False
+      )
+    var_j = self._get_var_mm24(
+      differences['counting_stats_var_j'],
+      differences['biased_mean'],
+      differences['correlation_j'],
+      return_der=False
+      )
+    normalized_differences = differences['pairwise_differences'] / flex.sqrt(var_i + var_j)
     all_pairwise_differences = self.mpi_helper.gather_variable_length_numpy_arrays(
-        np.concatenate(pairwise_differences), root=0, dtype=float
+        normalized_differences.as_numpy_array()[:self.intensity_bin_offsets[-1]], root=0, dtype=float
         )
 
     if self.mpi_helper.rank == 0:
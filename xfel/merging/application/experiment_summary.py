@@ -0,0 +1,127 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+from dials.array_family import flex
+
+"""
+A compact, array-backed stand-in for an experiment list, used by the merging application between the input step and
+the first step that needs full experiment models
+"""
+
+class experiment_summary(object):
+  '''One row per experiment: identifier, crystal real space vectors, space group and Sauter mosaicity, beam wavelength,
+     direction and polarization. Detectors and imagesets are not kept. The summary supports the experiment list
+     operations used by the input and balance steps (len, slicing, extend, identifiers) and pickles as a few numpy
+     arrays. Full experiment models are rebuilt with to_experiment_list.'''
+
+  def __init__(self, n=0):
+    self.identifier = np.empty(n, dtype=object)
+    self.real_space_abc = np.empty((n, 9))           # a, b, c as rows of a 3x3 matrix
+    self.space_group_index = np.empty(n, dtype=np.int32) # index into self.space_group_hall_symbols
+    self.space_group_hall_symbols = []
+    self.domain_size_ang = np.full(n, np.nan)        # nan: not a MosaicCrystalSauter2014
+    self.half_mosaicity_deg = np.full(n, np.nan)
+    self.wavelength = np.empty(n)
+    self.beam_direction = np.empty((n, 3))
+    self.polarization_normal = np.empty((n, 3))
+    self.polarization_fraction = np.empty(n)
+
+  row_arrays = ['identifier', 'real_space_abc', 'space_group_index', 'domain_size_ang', 'half_mosaicity_deg',
+                'wavelength', 'beam_direction', 'polarization_normal', 'polarization_fraction']
+
+  @staticmethod
+  def from_experiments(experiments):
+    '''Summarize an experiment list'''
+    summary = experiment_summary(len(experiments))
+    hall_symbols = {}
+    for i, experiment in enumerate(experiments):
+      crystal = experiment.crystal
+      beam = experiment.beam
+      summary.identifier[i] = experiment.identifier
+      summary.real_space_abc[i] = crystal.get_real_space_vectors().as_double()
+      hall = crystal.get_space_group().type().hall_symbol()
+      summary.space_group_index[i] = hall_symbols.setdefault(hall, len(hall_symbols))
+      if hasattr(crystal, 'get_domain_size_ang'):
+        summary.domain_size_ang[i] = crystal.get_domain_size_ang()
+        summary.half_mosaicity_deg[i] = crystal.get_half_mosaicity_deg()
+      summary.wavelength[i] = beam.get_wavelength()
+      summary.beam_direction[i] = beam.get_sample_to_source_direction()
+      summary.polarization_normal[i] = beam.get_polarization_normal()
+      summary.polarization_fraction[i] = beam.get_polarization_fraction()
+    summary.space_group_hall_symbols = sorted(hall_symbols, key=hall_symbols.get)
+    return summary
+
+  @staticmethod
+  def concat(summaries):
+    '''Concatenate a list of summaries into a new summary'''
+    result = experiment_summary()
+    hall_symbols = {}
+    space_group_indices = []
+    for summary in summaries:
+      remap = np.array([hall_symbols.setdefault(hall, len(hall_symbols)) for hall in summary.space_group_hall_symbols] or [0], dtype=np.int32)
+      space_group_indices.append(remap[summary.space_group_index])
+    result.space_group_hall_symbols = sorted(hall_symbols, key=hall_symbols.get)
+    for name in experiment_summary.row_arrays:
+      if name == 'space_group_index':
+        arrays = space_group_indices
+      else:
+        arrays = [getattr(summary, name) for summary in summaries]
+      if arrays:
+        setattr(result, name, np.concatenate(arrays))
+    return result
+
+  def __len__(self):
+    return len(self.identifier)
+
+  def __getitem__(self, item):
+    '''A slice of the summary. Single experiments are materialized.'''
+    if not isinstance(item, slice):
+      return self[item:item+1 or None].to_experiment_list()[0]
+    result = experiment_summary()
+    for name in experiment_summary.row_arrays:
+      setattr(result, name, getattr(self, name)[item])
+    result.space_group_hall_symbols = list(self.space_group_hall_symbols)
+    return result
+
+  def __iter__(self):
+    return iter(self.to_experiment_list())
+
+  def extend(self, other):
+    '''Append the rows of another summary'''
+    result = experiment_summary.concat([self, other])
+    self.__dict__.update(result.__dict__)
+
+  def identifiers(self):
+    return flex.std_string(list(self.identifier))
+
+  def imagesets(self):
+    return []
+
+  @property
+  def nbytes(self):
+    '''Approximate memory footprint in bytes'''
+    return sum(getattr(self, name).nbytes for name in experiment_summary.row_arrays) + \
+           sum(len(identifier) for identifier in self.identifier)
+
+  def crystal_A(self):
+    '''Setting matrices A = U B, the inverses of the real space matrices, as an (n, 3, 3) array'''
+    return np.linalg.inv(self.real_space_abc.reshape(-1, 3, 3))
+
+  def to_experiment_list(self):
+    '''Materialize experiment models with a crystal and a beam for every row'''
+    from dxtbx.model import Beam, Crystal, Experiment, MosaicCrystalSauter2014
+    from dxtbx.model.experiment_list import ExperimentList
+    from cctbx import sgtbx
+    space_groups = [sgtbx.space_group(hall) for hall in self.space_group_hall_symbols]
+    experiments = ExperimentList()
+    for i in range(len(self)):
+      a, b, c = self.real_space_abc[i].reshape(3, 3).tolist()
+      crystal = Crystal(a, b, c, space_group=space_groups[self.space_group_index[i]])
+      if not np.isnan(self.domain_size_ang[i]):
+        crystal = MosaicCrystalSauter2014(crystal)
+        crystal.set_domain_size_ang(float(self.domain_size_ang[i]))
+        crystal.set_half_mosaicity_deg(float(self.half_mosaicity_deg[i]))
+      beam = Beam(tuple(self.beam_direction[i]), float(self.wavelength[i]))
+      beam.set_polarization_normal(tuple(self.polarization_normal[i]))
+      beam.set_polarization_fraction(float(self.polarization_fraction[i]))
+      experiments.append(Experiment(beam=beam, crystal=crystal, identifier=self.identifier[i]))
+    return experiments
@@ -1,7 +1,9 @@
 from __future__ import absolute_import, division, print_function
 from xfel.merging.application.worker import worker
+from dials.array_family import flex
 from cctbx.crystal import symmetry
 from libtbx import Auto
+import numpy as np
 
 class experiment_filter(worker):
   '''Reject experiments based on various criteria'''
@@ -18,55 +20,79 @@ class experiment_filter(worker):
   def __repr__(self):
     return 'Filter experiments'
 
-  def check_unit_cell(self, experiment):
-
-    experiment_unit_cell = experiment.crystal.get_unit_cell()
-
-    is_ok = experiment_unit_cell.is_similar_to(self.params.filter.unit_cell.value.target_unit_cell,
-                                               self.params.filter.unit_cell.value.relative_length_tolerance,
-                                               self.params.filter.unit_cell.value.absolute_angle_tolerance)
-    return is_ok
-
-  def check_space_group(self, experiment):
+  @staticmethod
+  def unit_cell_parameters(experiments):
+    '''Unit cell parameters (a, b, c, alpha, beta, gamma) of all experiments as an (n, 6) array'''
+    return np.array([experiment.crystal.get_unit_cell().parameters() for experiment in experiments]).reshape(-1, 6)
+
+  def check_unit_cells(self, unit_cell_parameters):
+    '''Vectorized uctbx.unit_cell.is_similar_to against the target unit cell: the ratio of the shorter to the longer
+       of each cell length must be within the relative length tolerance of 1, and the angles within the absolute angle
+       tolerance. Returns a boolean array.'''
+    target = np.array(self.params.filter.unit_cell.value.target_unit_cell.parameters())
+    lengths = unit_cell_parameters[:, :3]
+    length_ratios = np.minimum(lengths, target[:3]) / np.maximum(lengths, target[:3])
+    lengths_ok = np.all(np.abs(length_ratios - 1) <= self.params.filter.unit_cell.value.relative_length_tolerance, axis=1)
+    angles_ok = np.all(np.abs(unit_cell_parameters[:, 3:] - target[3:]) <= self.params.filter.unit_cell.value.absolute_angle_tolerance, axis=1)
+    return lengths_ok & angles_ok
+
+  def check_space_groups(self, experiments):
+    '''Compare the derived Patterson group of each experiment with that of the target space group. The target group is
+       built once, and the Patterson group of each distinct experiment space group only once. Returns a boolean array.'''
     # build patterson group from the target space group
     target_unit_cell = self.params.filter.unit_cell.value.target_unit_cell
     target_space_group_info = self.params.filter.unit_cell.value.target_space_group
     target_symmetry = symmetry(unit_cell=target_unit_cell, space_group_info=target_space_group_info)
-    target_space_group = target_symmetry.space_group()
-    target_patterson_group_sn = target_space_group.build_derived_patterson_group().info().symbol_and_number()
-
-    # build patterson group from the experiment space group
-    experiment_space_group = experiment.crystal.get_space_group()
-    experiment_patterson_group_sn = experiment_space_group.build_derived_patterson_group().info().symbol_and_number()
-
-    is_ok = (target_patterson_group_sn == experiment_patterson_group_sn)
-
+    target_patterson_group_sn = target_symmetry.space_group().build_derived_patterson_group().info().symbol_and_number()
+
+    # build patterson groups from the experiment space groups
+    is_target_patterson_group = {} # hall symbol of the experiment space group vs result
+    is_ok = np.zeros(len(experiments), dtype=bool)
+    for i, experiment in enumerate(experiments):
+      experiment_space_group = experiment.crystal.get_space_group()
+      hall_symbol = experiment_space_group.type().hall_symbol()
+      if hall_symbol not in is_target_patterson_group:
+        experiment_patterson_group_sn = experiment_space_group.build_derived_patterson_group().info().symbol_and_number()
+        is_target_patterson_group[hall_symbol] = (target_patterson_group_sn == experiment_patterson_group_sn)
+      is_ok[i] = is_target_patterson_group[hall_symbol]
     return is_ok
 
   @staticmethod
   def remove_experiments(experiments, reflections, experiment_ids_to_remove):
-    '''Remove specified experiments from the experiment list. Remove corresponding reflections from the reflection table'''
+    '''Remove specified experiments from the experiment list. Remove corresponding reflections from the reflection table
+       in one selection and renumber the reflection ids.'''
+    experiment_ids_to_remove = set(experiment_ids_to_remove)
+    if not experiment_ids_to_remove:
+      return experiments, reflections
     experiments.select_on_experiment_identifiers([i for i in experiments.identifiers() if i not in experiment_ids_to_remove])
-    reflections.remove_on_experiment_identifiers(experiment_ids_to_remove)
+
+    id_map = reflections.experiment_identifiers()
+    removed_ids = [i for i in id_map.keys() if id_map[i] in experiment_ids_to_remove]
+    if reflections.size() > 0 and removed_ids:
+      ids = reflections['id'].as_numpy_array()
+      id_removed = np.zeros(max(int(ids.max()), max(removed_ids)) + 1, dtype=bool)
+      id_removed[removed_ids] = True
+      reflections = reflections.select(flex.bool(~id_removed[np.maximum(ids, 0)] | (ids < 0)))
+    for i in removed_ids:
+      del reflections.experiment_identifiers()[i]
     reflections.reset_ids()
 
     return experiments, reflections
 
-  def check_cluster(self, experiment):
-    import numpy as np
-    from math import sqrt
-    experiment_unit_cell = experiment.crystal.get_unit_cell()
-    P = experiment_unit_cell.parameters()
-    features = [P[idx] for idx in self.cluster_data["idxs"]]
-    features = np.array(features).reshape(1,-1)
+  def check_clusters(self, unit_cell_parameters):
+    '''Mahalanobis distances of all experiments to the chosen cluster component (and to the components to be skipped)
+       in one call per component. Returns a boolean array.'''
+    features = unit_cell_parameters[:, self.cluster_data["idxs"]]
+    if len(features) == 0:
+      return np.zeros(0, dtype=bool)
     cov=self.cluster_data["populations"].fit_components[self.params.filter.unit_cell.cluster.covariance.component]
-    m_distance = sqrt(cov.mahalanobis(features))
+    m_distance = np.sqrt(cov.mahalanobis(features))
+    is_ok = m_distance < self.params.filter.unit_cell.cluster.covariance.mahalanobis
     for other in self.params.filter.unit_cell.cluster.covariance.skip_component:
       skip_cov = self.cluster_data["populations"].fit_components[other]
-      skip_distance = sqrt(skip_cov.mahalanobis(features))
-      if skip_distance < self.params.filter.unit_cell.cluster.covariance.skip_mahalanobis:
-        return False
-    return m_distance < self.params.filter.unit_cell.cluster.covariance.mahalanobis
+      skip_distance = np.sqrt(skip_cov.mahalanobis(features))
+      is_ok &= ~(skip_distance < self.params.filter.unit_cell.cluster.covariance.skip_mahalanobis)
+    return is_ok
 
   def run(self, experiments, reflections):
     if 'unit_cell' not in self.params.filter.algorithm: # so far only "unit_cell" algorithm is supported
@@ -95,13 +121,14 @@ class experiment_filter(worker):
       self.logger.log("Using filter target unit cell: %s"%str(self.params.filter.unit_cell.value.target_unit_cell))
       self.logger.log("Using filter target space group: %s"%str(self.params.filter.unit_cell.value.target_space_group))
 
-      for experiment in experiments:
-        if not self.check_space_group(experiment):
-          experiment_ids_to_remove.append(experiment.identifier)
-          removed_for_space_group += 1
-        elif not self.check_unit_cell(experiment):
-          experiment_ids_to_remove.append(experiment.identifier)
-          removed_for_unit_cell += 1
+      space_group_ok = self.check_space_groups(experiments)
+      unit_cell_ok = self.check_unit_cells(self.unit_cell_parameters(experiments))
+      rejected_for_space_group = ~space_group_ok
+      rejected_for_unit_cell = space_group_ok & ~unit_cell_ok
+      identifiers = list(experiments.identifiers())
+      experiment_ids_to_remove = [identifiers[i] for i in np.flatnonzero(rejected_for_space_group | rejected_for_unit_cell)]
+      removed_for_space_group = int(rejected_for_space_group.sum())
+      removed_for_unit_cell = int(rejected_for_unit_cell.sum())
 # END BY-VALUE FILTER
     elif self.params.filter.unit_cell.algorithm == "cluster":
 
@@ -132,10 +159,10 @@ class experiment_filter(worker):
       # pull out the index numbers of the unit cell parameters to be used for covariance matrix
       self.cluster_data["idxs"]=[["a","b","c","alpha","beta","gamma"].index(F) for F in self.cluster_data["features"]]
 
-      for experiment in experiments:
-        if not self.check_cluster(experiment):
-          experiment_ids_to_remove.append(experiment.identifier)
-          removed_for_unit_cell += 1
+      rejected_for_unit_cell = ~self.check_clusters(self.unit_cell_parameters(experiments))
+      identifiers = list(experiments.identifiers())
+      experiment_ids_to_remove = [identifiers[i] for i in np.flatnonzero(rejected_for_unit_cell)]
+      removed_for_unit_cell = int(rejected_for_unit_cell.sum())
 # END OF COVARIANCE FILTER
     input_len_expts = len(experiments)
     input_len_refls = len(reflections)
@@ -149,14 +176,17 @@ class experiment_filter(worker):
     self.logger.log("Reflections rejected because of rejected experiments: %d"%removed_reflections)
 
     # MPI-reduce total counts
-    comm = self.mpi_helper.comm
-    MPI = self.mpi_helper.MPI
-    total_removed_for_unit_cell  = comm.reduce(removed_for_unit_cell, MPI.SUM, 0)
-    total_removed_for_space_group  = comm.reduce(removed_for_space_group, MPI.SUM, 0)
-    total_reflections_removed  = comm.reduce(removed_reflections, MPI.SUM, 0)
+    reduction = self.mpi_helper.reduction()
+    reduction.add_sum('removed_for_unit_cell', removed_for_unit_cell)
+    reduction.add_sum('removed_for_space_group', removed_for_space_group)
+    reduction.add_sum('removed_reflections', removed_reflections)
+    totals = reduction.flush()
 
     # rank 0: log total counts
     if self.mpi_helper.rank == 0:
+      total_removed_for_unit_cell = totals['removed_for_unit_cell']
+      total_removed_for_space_group = totals['removed_for_space_group']
+      total_reflections_removed = totals['removed_reflections']
       self.logger.main_log("Total experiments rejected because of unit cell dimensions: %d"%total_removed_for_unit_cell)
       self.logger.main_log("Total experiments rejected because of space group %d"%total_removed_for_space_group)
       self.logger.main_log("Total reflections rejected because of rejected experiments %d"%total_reflections_removed)
@@ -1,12 +1,14 @@
 from __future__ import absolute_import, division, print_function
 from six.moves import range
 from xfel.merging.application.worker import worker
+from xfel.merging.application.reflection_table_utils import experiment_index
 from dials.array_family import flex
 from dxtbx.model.experiment_list import ExperimentList
 from rstbx.dials_core.integration_core import show_observations
 from cctbx import miller
 from cctbx.crystal import symmetry
 from six.moves import cStringIO as StringIO
+import numpy as np
 
 class reflection_filter(worker):
   '''Reject individual reflections based on various criteria'''
@@ -43,13 +45,18 @@ class reflection_filter(worker):
     target_symm = symmetry(unit_cell = unit_cell, space_group_info = self.params.scaling.space_group)
 
     new_experiments = ExperimentList()
-    new_reflections = flex.reflection_table()
 
     kap = 'kapton_absorption_correction' in reflections
 
+    # index the reflections by experiment once; accepted rows are collected and selected in a single pass at the end
+    index = experiment_index(reflections, n_experiments=len(experiments))
+    accepted_experiments = np.zeros(len(experiments), dtype=bool)
+    accepted_rows = []
+
     for expt_id, experiment in enumerate(experiments):
-      exp_reflections = reflections.select(reflections['id'] == expt_id)
+      exp_reflections = index[expt_id]
       if not len(exp_reflections): continue
+      exp_first_row = index.rows(expt_id)[0]
 
       N_obs_pre_filter = exp_reflections.size()
 
@@ -61,21 +68,22 @@ class reflection_filter(worker):
 
       if kap:
         unattenuated = exp_reflections['kapton_absorption_correction'] == 1.0
-        iterable = [exp_reflections.select(unattenuated), exp_reflections.select(~unattenuated)]
+        iterable = [(unattenuated.iselection(), exp_reflections.select(unattenuated)),
+                    ((~unattenuated).iselection(), exp_reflections.select(~unattenuated))]
         exp_miller_indices = miller.set(target_symm, exp_reflections['miller_index'], True)
         exp_observations = miller.array(exp_miller_indices, exp_reflections['intensity.sum.value'], flex.sqrt(exp_reflections['intensity.sum.variance']))
         binner = exp_observations.setup_binner(n_bins = N_bins)
         N_bins = None
       else:
-        iterable = [exp_reflections]
+        iterable = [(flex.size_t_range(len(exp_reflections)), exp_reflections)]
 
       #print ("\nN_obs_pre_filter %d"%N_obs_pre_filter)
       #print >> out, "Total obs %d Choose n bins = %d"%(N_obs_pre_filter,N_bins)
       #if indices_to_edge is not None:
       #  print >> out, "Total preds %d to edge of detector"%indices_to_edge.size()
 
-      new_exp_reflections = flex.reflection_table()
-      for refls in iterable:
+      new_exp_rows = []
+      for refls_rows, refls in iterable:
         # Build a miller array for the experiment reflections
         exp_miller_indices = miller.set(target_symm, refls['miller_index'], True)
         exp_observations = miller.array(exp_miller_indices, refls['intensity.sum.value'], flex.sqrt(refls['intensity.sum.variance']))
@@ -119,17 +127,21 @@ class reflection_filter(worker):
 
           assert imposed_res_sel.size() == refls.size()
 
-          new_exp_reflections.extend(refls.select(imposed_res_sel))
+          new_exp_rows.append(refls_rows.select(imposed_res_sel).as_numpy_array() + exp_first_row)
 
-      if new_exp_reflections.size() > 0:
+      if sum(len(rows) for rows in new_exp_rows) > 0:
         new_experiments.append(experiment)
-        new_reflections.extend(new_exp_reflections)
+        accepted_experiments[expt_id] = True
+        accepted_rows.extend(new_exp_rows)
 
       #self.logger.log("N acceptable bins %d"%N_acceptable_bins)
       #self.logger.log("Old n_obs: %d, new n_obs: %d"%(N_obs_pre_filter, exp_observations.size()))
       #if indices_to_edge is not None:
       #  print >> out, "Total preds %d to edge of detector"%indices_to_edge.size()
 
+    new_reflections = index.select_experiments(accepted_experiments,
+      rows=np.concatenate(accepted_rows) if accepted_rows else np.empty(0, dtype=np.int64))
+
     removed_reflections = len(reflections) - len(new_reflections)
     removed_experiments = len(experiments) - len(new_experiments)
 
@@ -137,19 +149,20 @@ class reflection_filter(worker):
     self.logger.log("Experiments rejected because of significance filter: %d"%removed_experiments)
 
     # MPI-reduce total counts
-    comm = self.mpi_helper.comm
-    MPI = self.mpi_helper.MPI
-    total_removed_reflections  = comm.reduce(removed_reflections, MPI.SUM, 0)
-    total_removed_experiments  = comm.reduce(removed_experiments, MPI.SUM, 0)
+    reduction = self.mpi_helper.reduction()
+    reduction.add_sum('removed_reflections', removed_reflections)
+    reduction.add_sum('removed_experiments', removed_experiments)
+    totals = reduction.flush()
 
     # rank 0: log total counts
     if self.mpi_helper.rank == 0:
+      total_removed_reflections = totals['removed_reflections']
+      total_removed_experiments = totals['removed_experiments']
       self.logger.main_log("Total reflections rejected because of significance filter: %d"%total_removed_reflections)
       self.logger.main_log("Total experiments rejected because of significance filter: %d"%total_removed_experiments)
 
     self.logger.log_step_time("SIGNIFICANCE_FILTER", True)
 
-    new_reflections.reset_ids()
     return new_experiments, new_reflections
 
 if __name__ == '__main__':
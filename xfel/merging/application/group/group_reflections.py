@@ -4,6 +4,8 @@ from xfel.merging.application.worker import worker
 from dials.array_family import flex
 from xfel.merging.application.reflection_table_utils import reflection_table_utils
 from xfel.merging.application.utils.memory_usage import get_memory_usage
+import numpy as np
+import math
 
 class hkl_group(worker):
   '''For each asu hkl, gather all of its measurements from all ranks at a single rank, while trying to evenly distribute asu HKLs over the ranks.'''
@@ -41,10 +43,11 @@ class hkl_group(worker):
     self.logger.log_step_time("DISTRIBUTE_OVER_CHUNKS", True)
 
     # run all-to-all
-    if self.params.parallel.a2a == 1: # 1 means: the number of slices in each chunk is 1, i.e. alltoall is done on the whole chunks
+    number_of_slices = self.get_number_of_alltoall_slices()
+    if number_of_slices == 1: # 1 means: the number of slices in each chunk is 1, i.e. alltoall is done on the whole chunks
       alltoall_reflections = self.get_reflections_from_alltoall()
     else: # do alltoall on chunk slices - useful if the run-time memory is not sufficient to do alltoall on the whole chunks
-      alltoall_reflections = self.get_reflections_from_alltoall_sliced(number_of_slices=self.params.parallel.a2a)
+      alltoall_reflections = self.get_reflections_from_alltoall_sliced(number_of_slices=number_of_slices)
 
     self.logger.log_step_time("SORT")
     self.logger.log("Sorting consolidated reflection table...")
@@ -58,7 +61,6 @@ class hkl_group(worker):
   def setup_hkl_chunks(self, reflections):
     '''Set up a list of reflection tables, or chunks, for distributing reflections'''
     # split the full miller set into chunks; the number of chunks is equal to the number of ranks
-    import numpy as np
     self.hkl_split_set = np.array_split(self.params.scaling.miller_set.indices(), self.mpi_helper.size)
 
     # initialize a list of hkl chunks - reflection tables to store distributed reflections
@@ -98,12 +100,18 @@ class hkl_group(worker):
 
     reflections.clear()
 
+  def alltoall(self, hkl_chunks):
+    '''Exchange hkl chunks between all ranks using the all-to-all method selected by parallel.a2a_method'''
+    if self.params.parallel.a2a_method == 'buffer':
+      return self.mpi_helper.alltoall_reflection_tables(hkl_chunks)
+    return self.mpi_helper.comm.alltoall(hkl_chunks)
+
   def get_reflections_from_alltoall(self):
     '''Use MPI alltoall method to gather all reflections with the same asu hkl from all ranks at a single rank'''
     self.logger.log_step_time("ALL-TO-ALL")
     self.logger.log("Executing MPI all-to-all...")
 
-    received_hkl_chunks = self.mpi_helper.comm.alltoall(self.hkl_chunks)
+    received_hkl_chunks = self.alltoall(self.hkl_chunks)
 
     self.logger.log("Received %d hkl chunks after all-to-all"%len(received_hkl_chunks))
     self.logger.log_step_time("ALL-TO-ALL", True)
@@ -117,41 +125,82 @@ class hkl_group(worker):
 
     return result_reflections
 
+  def get_number_of_alltoall_slices(self):
+    '''Number of all-to-all rounds: at least parallel.a2a, and enough for no rank to send more than
+       parallel.a2a_memory_budget MB in a single round. The budget only bounds what a rank sends per round; what it
+       receives per round depends on the data the other ranks hold for its hkls. All ranks must agree, so take the
+       maximum over ranks.'''
+    number_of_slices = self.params.parallel.a2a
+    budget = self.params.parallel.a2a_memory_budget
+    if not budget:
+      return number_of_slices # same on all ranks, no need to communicate
+    send_mb = sum(self._estimate_table_bytes(chunk) for chunk in self.hkl_chunks) / 1024**2
+    number_of_slices = max(number_of_slices, int(math.ceil(send_mb / budget)))
+    return self.mpi_helper.comm.allreduce(number_of_slices, self.mpi_helper.MPI.MAX)
+
+  @staticmethod
+  def _estimate_table_bytes(table):
+    '''Approximate in-memory size of a reflection table from its column element sizes'''
+    element_sizes = {'double':8, 'int':4, 'size_t':8, 'bool':1, 'miller_index':12,
+                     'vec2_double':16, 'vec3_double':24, 'mat3_double':72}
+    row_size = sum(element_sizes.get(type(table[key]).__name__, 8) for key in table.keys())
+    return row_size * table.size()
+
   def get_reflections_from_alltoall_sliced(self, number_of_slices):
-    '''Split each hkl chunk into N slices. This is needed to address the MPI alltoall memory problem'''
+    '''Run all-to-all in number_of_slices rounds, each sending one slice of every hkl chunk. Each chunk is split into
+       its slices as soon as the rounds start and every slice is released once sent, so the data left to send shrinks
+       round by round. Received slices are written in place into a single table, allocated from the row counts
+       exchanged up front, so nothing is concatenated at the end. The rows are in the same order as with the one-shot
+       all-to-all: by source rank, then by row within the source chunk.'''
+    self.logger.log("Ready for all-to-all in %d slices..."%number_of_slices)
+    self.logger.log("Memory usage: %d MB"%get_memory_usage())
 
-    result_reflections = self.distribute_reflection_table() # the total reflection table, which this rank will receive after all slices of alltoall
+    # rows to receive from each rank, so the result can be allocated once and filled in source rank order
+    recv_rows = self.mpi_helper.comm.alltoall([len(chunk) for chunk in self.hkl_chunks])
+    recv_offsets = np.concatenate(([0], np.cumsum(recv_rows)[:-1])).astype(np.int64)
 
-    list_of_sliced_hkl_chunks = [] # if self.hkl_chunks is [A,B,C...], this list will be [[A1,A2,...,An], [B1,B2,...,Bn], [C1,C2,...,Cn], ...], where n is the number of chunk slices
-    for i in range(len(self.hkl_chunks)):
-      hkl_chunk_slices = []
-      for chunk_slice in reflection_table_utils.get_next_reflection_table_slice(self.hkl_chunks[i], number_of_slices, self.distribute_reflection_table):
-        hkl_chunk_slices.append(chunk_slice)
-      list_of_sliced_hkl_chunks.append(hkl_chunk_slices)
-
-    self.logger.log("Ready for all-to-all...")
-    self.logger.log("Memory usage: %d MB"%get_memory_usage())
+    # split the chunks into slices, releasing each chunk once split; a chunk with fewer rows than slices yields some
+    # empty slices
+    slices = []
+    for i, chunk in enumerate(self.hkl_chunks):
+      bounds = (np.arange(number_of_slices + 1) * len(chunk)) // number_of_slices
+      slices.append([chunk[int(bounds[j]):int(bounds[j+1])] for j in range(number_of_slices)])
+      self.hkl_chunks[i] = None
+    self.hkl_chunks = None
 
+    result_reflections = None
     for j in range(number_of_slices):
-      hkl_chunks_for_alltoall = list()
-      for i in range(len(self.hkl_chunks)):
-        hkl_chunks_for_alltoall.append(list_of_sliced_hkl_chunks[i][j]) # [Aj,Bj,Cj...]
+      hkl_chunks_for_alltoall = [] # [Aj,Bj,Cj...]
+      for chunk_slices in slices:
+        hkl_chunks_for_alltoall.append(chunk_slices[j])
+        chunk_slices[j] = None
 
       self.logger.log_step_time("ALL-TO-ALL")
-      self.logger.log("Executing MPI all-to-all...")
+      self.logger.log("Executing MPI all-to-all, slice %d of %d..."%(j+1, number_of_slices))
       self.logger.log("Memory usage: %d MB"%get_memory_usage())
 
-      received_hkl_chunks = comm.alltoall(hkl_chunks_for_alltoall)
+      received_hkl_chunks = self.alltoall(hkl_chunks_for_alltoall)
+      del hkl_chunks_for_alltoall
 
       self.logger.log("After all-to-all received %d hkl chunks" %len(received_hkl_chunks))
       self.logger.log_step_time("ALL-TO-ALL", True)
 
       self.logger.log_step_time("CONSOLIDATE")
       self.logger.log("Consolidating reflection tables...")
-
-      for chunk in received_hkl_chunks:
-        result_reflections.extend(chunk)
-
+      for i, chunk in enumerate(received_hkl_chunks):
+        if len(chunk) == 0:
+          continue
+        if result_reflections is None:
+          result_reflections = self.distribute_reflection_table(chunk)
+          result_reflections.resize(int(sum(recv_rows)))
+        start = int(recv_offsets[i])
+        result_reflections[start:start + len(chunk)] = chunk
+        recv_offsets[i] += len(chunk)
+        for expt_id, identifier in chunk.experiment_identifiers():
+          result_reflections.experiment_identifiers()[expt_id] = identifier
+      if result_reflections is None and j == number_of_slices - 1:
+        result_reflections = flex.reflection_table.concat(received_hkl_chunks) # no data: keep the columns, if any
+      del received_hkl_chunks
       self.logger.log_step_time("CONSOLIDATE", True)
 
     return result_reflections
@@ -0,0 +1,103 @@
+from __future__ import absolute_import, division, print_function
+import sys, tempfile
+import numpy as np
+from dials.array_family import flex
+from xfel.merging.application.mpi_helper import mpi_helper
+from xfel.merging.application.group.group_reflections import hkl_group
+
+"""
+Regression test for the sliced all-to-all of the group step: every rank exchanges the same synthetic hkl chunks with
+the one-shot all-to-all and with get_reflections_from_alltoall_sliced, for both values of parallel.a2a_method, and
+checks that it receives the same reflection table, row for row, with the same experiment identifiers. The cases cover
+a fixed number of slices, a number of slices derived from parallel.a2a_memory_budget, a rank holding no data, and
+more slices than rows. Timings are reported for the first case. Run under MPI:
+  mpirun -n 4 libtbx.python tst_alltoall_slices.py [reflections_per_rank] [number_of_slices]
+"""
+
+def synthetic_hkl_chunks(n_reflections, n_ranks, rank, seed=0):
+  '''One reflection table per destination rank, with the columns kept by the group step and random sizes'''
+  rng = np.random.default_rng(seed + rank)
+  sizes = rng.multinomial(n_reflections, rng.dirichlet(np.ones(n_ranks))) if n_reflections > 0 else np.zeros(n_ranks)
+  chunks = []
+  for size in sizes:
+    size = int(size)
+    chunk = flex.reflection_table()
+    hkl = rng.integers(-50, 50, (size, 3))
+    chunk['miller_index_asymmetric'] = flex.miller_index(flex.vec3_double(flex.double(hkl.astype(np.float64).reshape(-1))).iround())
+    chunk['intensity.sum.value'] = flex.double(rng.gamma(1., 1000., size))
+    chunk['intensity.sum.variance'] = flex.double(rng.uniform(10., 1000., size))
+    expt_ids = rng.integers(0, 100, size).astype(np.int32) + 1000 * rank
+    chunk['id'] = flex.int(expt_ids)
+    for expt_id in set(expt_ids.tolist()):
+      chunk.experiment_identifiers()[expt_id] = "rank_%d_experiment_%d"%(rank, expt_id)
+    chunks.append(chunk)
+  return chunks
+
+def assert_tables_equal(reference, table, what):
+  assert len(reference) == len(table), (what, len(reference), len(table))
+  assert sorted(reference.keys()) == sorted(table.keys()), what
+  for key in reference.keys():
+    if key == 'miller_index_asymmetric':
+      equal = np.array_equal(reference[key].as_vec3_double().as_double().as_numpy_array(),
+                             table[key].as_vec3_double().as_double().as_numpy_array())
+    else:
+      equal = np.array_equal(reference[key].as_numpy_array(), table[key].as_numpy_array())
+    assert equal, (what, key)
+  assert dict(reference.experiment_identifiers()) == dict(table.experiment_identifiers()), what
+
+def exercise(grouper, helper, n_reflections, number_of_slices = None, budget = None, report = False):
+  '''Compare the sliced and the one-shot all-to-all of the same chunks. The number of slices is either given or
+     derived from the budget, in MB.'''
+  params = grouper.params
+  for method in ['pickle', 'buffer']:
+    params.parallel.a2a_method = method
+    grouper.hkl_chunks = synthetic_hkl_chunks(n_reflections, helper.size, helper.rank)
+    helper.comm.barrier()
+    t0 = helper.time()
+    reference = grouper.get_reflections_from_alltoall()
+    helper.comm.barrier()
+    t1 = helper.time()
+
+    grouper.hkl_chunks = synthetic_hkl_chunks(n_reflections, helper.size, helper.rank)
+    if budget is not None:
+      params.parallel.a2a, params.parallel.a2a_memory_budget = 1, budget
+      slices = grouper.get_number_of_alltoall_slices()
+      params.parallel.a2a_memory_budget = None
+      assert slices > 1, "budget of %f MB too large for the test data"%budget
+    else:
+      slices = number_of_slices
+    helper.comm.barrier()
+    t2 = helper.time()
+    sliced = grouper.get_reflections_from_alltoall_sliced(slices)
+    helper.comm.barrier()
+    t3 = helper.time()
+
+    what = "rank %d, a2a_method=%s, %d reflections, %d slices"%(helper.rank, method, n_reflections, slices)
+    assert_tables_equal(reference, sliced, what)
+    n_received = helper.comm.reduce(len(reference), helper.MPI.SUM, root=0)
+    if helper.rank == 0:
+      print("OK: a2a_method=%s, %d reflections over %d ranks in %d slices"%(method, n_received, helper.size, slices))
+      if report:
+        print("  one-shot:     %.3f s"%(t1 - t0))
+        print("  %2d slices:    %.3f s"%(slices, t3 - t2))
+
+def run(args):
+  n_reflections = int(args[0]) if len(args) > 0 else 1000000
+  number_of_slices = int(args[1]) if len(args) > 1 else 4
+
+  from xfel.merging.application.phil.phil import phil_scope
+  helper = mpi_helper()
+  params = phil_scope.extract()
+  params.output.output_dir = helper.comm.bcast(tempfile.mkdtemp() if helper.rank == 0 else None, root=0)
+  grouper = hkl_group(params, mpi_helper=helper)
+
+  exercise(grouper, helper, n_reflections, number_of_slices = number_of_slices, report = True)
+  # rows of 4 columns take about 36 bytes: aim for about 5 rounds
+  exercise(grouper, helper, 100000, budget = 100000 * 36 / 5 / 1024**2)
+  # rank 0 holds no data
+  exercise(grouper, helper, 0 if helper.rank == 0 else 10000, number_of_slices = 3)
+  # fewer rows per chunk than slices
+  exercise(grouper, helper, 5 * helper.size, number_of_slices = 20)
+
+if __name__ == '__main__':
+  run(sys.argv[1:])
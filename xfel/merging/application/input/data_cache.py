@@ -0,0 +1,141 @@
+from __future__ import absolute_import, division, print_function
+import hashlib
+import json
+import os
+import numpy as np
+from dials.array_family import flex
+from dxtbx.model.experiment_list import ExperimentListFactory
+from xfel.merging.application.reflection_table_utils import reflection_table_utils
+from xfel.merging.application.experiment_summary import experiment_summary
+
+"""
+A per-rank, column-oriented cache of the data produced by the input step, so that repeated merging runs over the
+same input files don't have to re-read and re-parse them. Each rank stores its pruned, id-remapped reflections as
+one .npy file per column, plus its experiments and their experiment summary. With input.experiment_summary, a cache
+hit rebuilds the summary from its arrays and never parses the experiments file.
+"""
+
+# flex column types stored as plain numpy arrays
+numpy_column_types = {'double':flex.double, 'int':flex.int, 'size_t':flex.size_t, 'bool':flex.bool}
+
+def column_as_numpy(column):
+  '''Convert a reflection table column to a numpy array, or return None if the column type is not supported'''
+  type_name = type(column).__name__
+  if type_name in numpy_column_types:
+    return column.as_numpy_array()
+  if type_name == 'miller_index':
+    return reflection_table_utils.miller_index_as_numpy(column).astype(np.int32)
+  if type_name == 'vec3_double':
+    return column.as_double().as_numpy_array().reshape(-1, 3)
+  return None
+
+def column_from_numpy(type_name, array):
+  '''Convert a numpy array written by column_as_numpy back to a reflection table column'''
+  if type_name in numpy_column_types:
+    return numpy_column_types[type_name](np.ascontiguousarray(array))
+  if type_name == 'miller_index':
+    hkl = flex.vec3_double(flex.double(np.ascontiguousarray(array, dtype=np.float64).reshape(-1)))
+    return flex.miller_index(hkl.iround())
+  if type_name == 'vec3_double':
+    return flex.vec3_double(*[flex.double(np.ascontiguousarray(array[:, i])) for i in range(3)])
+  raise ValueError("Unsupported cached column type: %s"%type_name)
+
+class input_data_cache(object):
+  '''Read and write the per-rank input cache. All ranks must use the same key, computed at rank 0 by compute_key.'''
+
+  def __init__(self, params, key, mpi_helper, logger):
+    self.params = params
+    self.mpi_helper = mpi_helper
+    self.logger = logger
+    self.key_dir = os.path.join(params.input.cache.directory, key)
+    self.rank_dir = os.path.join(self.key_dir, 'rank_%06d'%mpi_helper.rank)
+
+  @staticmethod
+  def compute_key(params, file_list, n_ranks):
+    '''Hash the input file list (paths, sizes, modification times), the number of ranks and the input parameters
+       that determine what the input step produces'''
+    hash_obj = hashlib.md5()
+    for file_pair in file_list:
+      for path in file_pair:
+        st = os.stat(path)
+        hash_obj.update(("%s %d %d\n"%(os.path.abspath(path), st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    settings = dict(
+      n_ranks = n_ranks,
+      parallel_file_load = params.input.parallel_file_load.method,
+      ranks_per_node = params.input.parallel_file_load.ranks_per_node,
+      persistent_refl_cols = sorted(params.input.persistent_refl_cols or []),
+      keep_imagesets = params.input.keep_imagesets,
+      read_image_headers = params.input.read_image_headers,
+      override_identifiers = params.input.override_identifiers,
+      expanded_bookkeeping = params.output.expanded_bookkeeping,
+    )
+    hash_obj.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return hash_obj.hexdigest()
+
+  def is_complete(self):
+    return os.path.exists(os.path.join(self.key_dir, 'complete'))
+
+  def read(self, as_summary=False):
+    '''Load this rank's experiments, as an experiment_summary if as_summary is set, and reflections from the cache'''
+    if as_summary:
+      experiments = self.read_summary()
+    else:
+      experiments = ExperimentListFactory.from_json_file(os.path.join(self.rank_dir, 'experiments.expt'), check_format=False)
+    with open(os.path.join(self.rank_dir, 'reflections.json')) as f:
+      layout = json.load(f)
+    reflections = flex.reflection_table()
+    for i, (key, type_name) in enumerate(layout['columns']):
+      reflections[key] = column_from_numpy(type_name, np.load(os.path.join(self.rank_dir, 'column_%03d.npy'%i)))
+    for expt_id, identifier in layout['identifiers']:
+      reflections.experiment_identifiers()[expt_id] = identifier
+    self.logger.log("Read %d experiments and %d reflections from cache %s"%(len(experiments), len(reflections), self.rank_dir))
+    return experiments, reflections
+
+  def read_summary(self):
+    '''Rebuild this rank's experiment summary from its cached arrays'''
+    summary = experiment_summary()
+    for name in experiment_summary.row_arrays:
+      if name != 'identifier':
+        setattr(summary, name, np.load(os.path.join(self.rank_dir, 'experiment_%s.npy'%name)))
+    with open(os.path.join(self.rank_dir, 'experiment_summary.json')) as f:
+      summary_info = json.load(f)
+    summary.identifier = np.array(summary_info['identifiers'], dtype=object)
+    summary.space_group_hall_symbols = summary_info['space_group_hall_symbols']
+    return summary
+
+  def write(self, experiments, reflections):
+    '''Write this rank's experiments and reflections to the cache. The cache is marked complete once all ranks succeed.'''
+    layout = dict(columns=[], identifiers=[[int(k), v] for k, v in reflections.experiment_identifiers()])
+    columns = []
+    for key in reflections.keys():
+      array = column_as_numpy(reflections[key])
+      if array is None:
+        self.logger.log("Not caching input data: column %s of type %s is not supported"%(key, type(reflections[key]).__name__))
+        columns = None
+        break
+      layout['columns'].append((key, type(reflections[key]).__name__))
+      columns.append(array)
+
+    if columns is not None:
+      if isinstance(experiments, experiment_summary):
+        summary = experiments
+        experiments = experiments.to_experiment_list()
+      else:
+        summary = experiment_summary.from_experiments(experiments)
+      if not os.path.isdir(self.rank_dir):
+        os.makedirs(self.rank_dir)
+      for i, array in enumerate(columns):
+        np.save(os.path.join(self.rank_dir, 'column_%03d.npy'%i), array)
+      with open(os.path.join(self.rank_dir, 'reflections.json'), 'w') as f:
+        json.dump(layout, f)
+      experiments.as_file(os.path.join(self.rank_dir, 'experiments.expt'))
+      for name in experiment_summary.row_arrays:
+        if name != 'identifier':
+          np.save(os.path.join(self.rank_dir, 'experiment_%s.npy'%name), getattr(summary, name))
+      with open(os.path.join(self.rank_dir, 'experiment_summary.json'), 'w') as f:
+        json.dump(dict(identifiers=list(summary.identifier), space_group_hall_symbols=summary.space_group_hall_symbols), f)
+
+    all_written = self.mpi_helper.comm.allreduce(columns is not None, self.mpi_helper.MPI.LAND)
+    if all_written and self.mpi_helper.rank == 0:
+      open(os.path.join(self.key_dir, 'complete'), 'w').close()
+      self.logger.main_log("Wrote input data cache %s"%self.key_dir)
@@ -2,6 +2,8 @@ from __future__ import absolute_import, division, print_function
 from six.moves import range
 import sys
 import os
+import heapq
+import struct
 from xfel.merging.application.input.file_lister import list_input_pairs
 
 debug=False # set debug=True, if you want to see a per-rank experiments/reflections file pair list generated by this calculator
@@ -11,11 +13,54 @@ available_rank_count = 0  # used only when running this script stand-alone:
 
 b2GB = 1024 * 1024 * 1024 # byte to GB
 
+def _msgpack_uint(buf, pos):
+  '''Decode a msgpack unsigned integer at buf[pos], or return None'''
+  tag = buf[pos]
+  if tag <= 0x7f:
+    return tag
+  formats = {0xcc:'>B', 0xcd:'>H', 0xce:'>I', 0xcf:'>Q'}
+  if tag in formats:
+    fmt = formats[tag]
+    return struct.unpack(fmt, buf[pos+1:pos+1+struct.calcsize(fmt)])[0]
+  return None
+
+def _msgpack_map_size(buf, pos):
+  '''Decode the size of a msgpack map at buf[pos], or return None'''
+  tag = buf[pos]
+  if 0x80 <= tag <= 0x8f:
+    return tag & 0x0f
+  formats = {0xde:'>H', 0xdf:'>I'}
+  if tag in formats:
+    fmt = formats[tag]
+    return struct.unpack(fmt, buf[pos+1:pos+1+struct.calcsize(fmt)])[0]
+  return None
+
+def read_reflection_file_counts(reflections_filename, header_bytes=65536):
+  '''Read the number of reflections and experiments from the header of a msgpack reflection file
+     without loading the table. Return (n_reflections, n_experiments), either of which is None if not found.'''
+  try:
+    with open(reflections_filename, 'rb') as f:
+      buf = f.read(header_bytes)
+  except (IOError, OSError):
+    return None, None
+  n_reflections = n_experiments = None
+  try:
+    pos = buf.find(b'\xa5nrows')
+    if pos >= 0:
+      n_reflections = _msgpack_uint(buf, pos + 6)
+    pos = buf.find(b'\xabidentifiers')
+    if pos >= 0:
+      n_experiments = _msgpack_map_size(buf, pos + 12)
+  except (IndexError, struct.error):
+    pass
+  return n_reflections, n_experiments
+
 class file_load_calculator(object):
   def __init__(self, params, file_list, logger=None):
     self.params = params
     self.file_list = file_list
     self.logger = logger
+    self.rank_costs = None # {rank:estimated load cost}, set by the cost_model method
     global debug
     if debug:
       self.debug_log_path = os.path.join(self.params.output.output_dir, 'file_load_calculator.out')
@@ -39,6 +84,8 @@ class file_load_calculator(object):
       rank_files = self.calculate_file_load_simple(available_rank_count)
     elif self.params.input.parallel_file_load.method == "node_memory":
       rank_files = self.calculate_file_load_node_memory_based(available_rank_count)
+    elif self.params.input.parallel_file_load.method == "cost_model":
+      rank_files = self.calculate_file_load_cost_model(available_rank_count)
 
     if debug:
       for rank in range(len(rank_files)):
@@ -65,6 +112,53 @@ class file_load_calculator(object):
 
     return rank_files
 
+  def estimate_file_pair_cost(self, file_pair):
+    '''Estimate the cost of loading an experiments/reflections file pair, in units of the cost of loading one reflection.
+       Reflection and experiment counts are read from the reflection file header, or estimated from the file sizes.'''
+    cost_params = self.params.input.parallel_file_load.cost_model
+    experiments_filename, reflections_filename = file_pair
+    is_pickle = reflections_filename.endswith('.pickle')
+    n_reflections = n_experiments = None
+    if not is_pickle:
+      n_reflections, n_experiments = read_reflection_file_counts(reflections_filename)
+    if n_reflections is None:
+      n_reflections = os.stat(reflections_filename).st_size / cost_params.bytes_per_reflection
+    if n_experiments is None:
+      n_experiments = os.stat(experiments_filename).st_size / cost_params.bytes_per_experiment
+    cost = n_reflections + cost_params.experiment_cost * n_experiments
+    if is_pickle:
+      cost *= cost_params.pickle_cost_factor
+    return cost
+
+  def calculate_file_load_cost_model(self, available_rank_count):
+    '''Distribute experiments/reflections file pairs over the input number of ranks by longest-processing-time bin packing
+       of their estimated load costs. Return a dictionary {rank:filepair_list}; the estimated total cost of each rank is
+       stored in self.rank_costs.'''
+    assert available_rank_count > 0, "Available rank count has to be greater than zero."
+    costs = [self.estimate_file_pair_cost(file_pair) for file_pair in self.file_list]
+
+    # assign the most expensive remaining file pair to the least loaded rank
+    rank_heap = [(0.0, rank) for rank in range(available_rank_count)]
+    rank_file_indices = {rank:[] for rank in range(available_rank_count)}
+    for index in sorted(range(len(costs)), key=lambda i: costs[i], reverse=True):
+      rank_cost, rank = heapq.heappop(rank_heap)
+      rank_file_indices[rank].append(index)
+      heapq.heappush(rank_heap, (rank_cost + costs[index], rank))
+
+    rank_files = {} #{rank:[file_pair1, file_pair2, ...]}
+    self.rank_costs = {}
+    for rank in range(available_rank_count):
+      indices = sorted(rank_file_indices[rank]) # keep the input file order within each rank
+      rank_files[rank] = [self.file_list[i] for i in indices]
+      self.rank_costs[rank] = sum(costs[i] for i in indices)
+
+    if self.logger and len(costs) > 0:
+      rank_cost_values = list(self.rank_costs.values())
+      self.logger.log("Cost model: total estimated cost %.0f, per-rank min %.0f, max %.0f"%(
+        sum(costs), min(rank_cost_values), max(rank_cost_values)))
+
+    return rank_files
+
   def calculate_file_load_node_memory_based(self, available_rank_count):
     '''Assign experiments/reflections file pairs to nodes taking into account the node memory limit. Then distribute node-assigned file pairs over the ranks within each node. Return a dictionary {rank:file_list}'''
     # get sizes of all files
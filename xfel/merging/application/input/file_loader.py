@@ -6,6 +6,8 @@ from six.moves import range
 import json
 from xfel.merging.application.input.file_lister import list_input_pairs
 from xfel.merging.application.input.file_load_calculator import file_load_calculator
+from xfel.merging.application.input.data_cache import input_data_cache
+from xfel.merging.application.experiment_summary import experiment_summary
 from xfel.merging.application.utils.memory_usage import get_memory_usage
 
 """
@@ -87,6 +89,7 @@ def identifiers_match(*identifiers):
 from xfel.merging.application.worker import worker
 class simple_file_loader(worker):
   '''A class for running the script.'''
+  needs_experiment_models = False
 
   def __init__(self, params, mpi_helper=None, mpi_logger=None):
     super(simple_file_loader, self).__init__(params=params, mpi_helper=mpi_helper, mpi_logger=mpi_logger)
@@ -111,6 +114,16 @@ class simple_file_loader(worker):
       starting_refls_count = len(all_reflections)
     self.logger.log("Initial number of experiments: %d; Initial number of reflections: %d"%(starting_expts_count, starting_refls_count))
 
+    # with input.experiment_summary, the experiments of each file are summarized as soon as they are read
+    summary_chunks = None
+    summarized_expts_count = 0
+    if self.params.input.experiment_summary and not self.params.input.keep_imagesets:
+      summary_chunks = []
+      if isinstance(all_experiments, experiment_summary):
+        summary_chunks.append(all_experiments)
+        summarized_expts_count = len(all_experiments)
+        all_experiments = ExperimentList()
+
     # Generate and send a list of file paths to each worker
     if self.mpi_helper.rank == 0:
       file_list = list_input_pairs(self.params)
@@ -125,26 +138,40 @@ class simple_file_loader(worker):
           json.dump(file_names_from_id, o)
         file_id_from_names = {tuple(map(apath, exp_ref_pair)): i_f for i_f, exp_ref_pair in enumerate(file_list)}
 
-      per_rank_file_list = file_load_calculator(self.params, file_list, self.logger).\
-                              calculate_file_load(available_rank_count = self.mpi_helper.size)
+      # optionally look for cached input data from a previous run over the same input files
+      cache_key = cache_hit = None
+      if self.params.input.cache.directory is not None and test == 2:
+        cache_key = input_data_cache.compute_key(self.params, file_list, self.mpi_helper.size)
+        cache_hit = input_data_cache(self.params, cache_key, self.mpi_helper, self.logger).is_complete()
+        self.logger.main_log("Input data cache %s: %s"%(cache_key, "found" if cache_hit else "not found, will be written"))
+
+      if cache_hit:
+        per_rank_file_list, rank_costs = [], None
+      else:
+        load_calculator = file_load_calculator(self.params, file_list, self.logger)
+        per_rank_file_list = load_calculator.calculate_file_load(available_rank_count = self.mpi_helper.size)
+        rank_costs = load_calculator.rank_costs
       self.logger.log('Transmitting a list of %d lists of json/pickle file pairs'%(len(per_rank_file_list)))
-      transmitted = per_rank_file_list, file_id_from_names
+      transmitted = per_rank_file_list, file_id_from_names, rank_costs, cache_key, cache_hit
     else:
       transmitted = None
 
     self.logger.log_step_time("BROADCAST_FILE_LIST")
-    new_file_list, file_names_mapping = self.mpi_helper.comm.bcast(transmitted, root = 0)
+    new_file_list, file_names_mapping, rank_costs, cache_key, cache_hit = self.mpi_helper.comm.bcast(transmitted, root = 0)
     new_file_list = new_file_list[self.mpi_helper.rank] if self.mpi_helper.rank < len(new_file_list) else None
     self.logger.log_step_time("BROADCAST_FILE_LIST", True)
+    cache = input_data_cache(self.params, cache_key, self.mpi_helper, self.logger) if cache_key is not None else None
 
     # Load the data
     self.logger.log_step_time("LOAD")
-    if new_file_list is not None:
+    if cache_hit:
+      all_experiments, all_reflections = cache.read(as_summary = summary_chunks is not None)
+      if summary_chunks is not None:
+        summary_chunks.append(all_experiments)
+        all_experiments = ExperimentList()
+    elif new_file_list is not None:
       self.logger.log("Received a list of %d json/pickle file pairs"%len(new_file_list))
-      for experiments_filename, reflections_filename in new_file_list:
-        self.logger.log("Reading %s %s"%(experiments_filename, reflections_filename))
-        experiments = ExperimentListFactory.from_json_file(experiments_filename, check_format = self.params.input.read_image_headers)
-        reflections = flex.reflection_table.from_file(reflections_filename)
+      for experiments_filename, reflections_filename, experiments, reflections in self.read_file_pairs(new_file_list):
         if self.params.output.expanded_bookkeeping:
           # NOTE: these are un-prunable
           reflections["input_refl_index"] = flex.int(
@@ -191,26 +218,97 @@ class simple_file_loader(worker):
           all_experiments.append(experiment)
 
           # Reflection 'id' is unique within this rank; experiment.identifier is unique globally
-          new_id = len(all_experiments)-1
+          new_id = summarized_expts_count + len(all_experiments)-1
           eid[new_id] = experiment.identifier
           new_ids.set_selected(refls_sel, new_id)
         assert (new_ids < 0).count(True) == 0, "Not all reflections accounted for"
         reflections['id'] = new_ids
         all_reflections.extend(reflections)
+        if summary_chunks is not None:
+          summary_chunks.append(experiment_summary.from_experiments(all_experiments))
+          summarized_expts_count += len(all_experiments)
+          all_experiments = ExperimentList()
     else:
       self.logger.log("Received a list of 0 json/pickle file pairs")
+    if summary_chunks is not None:
+      summary_chunks.append(experiment_summary.from_experiments(all_experiments))
+      all_experiments = experiment_summary.concat(summary_chunks)
+      self.logger.log("Experiment summary: %d experiments in %.1f MB"%(len(all_experiments), all_experiments.nbytes/1024**2))
     self.logger.log_step_time("LOAD", True)
+    self.log_read_throughput(new_file_list)
+    if rank_costs is not None:
+      self.log_predicted_load_time(rank_costs.get(self.mpi_helper.rank, 0.0))
 
     self.logger.log('Read %d experiments consisting of %d reflections'%(len(all_experiments)-starting_expts_count, len(all_reflections)-starting_refls_count))
     self.logger.log("Memory usage: %d MB"%get_memory_usage())
 
     all_reflections = self.prune_reflection_table_keys(all_reflections)
 
+    if cache is not None and not cache_hit:
+      self.logger.log_step_time("WRITE_INPUT_CACHE")
+      cache.write(all_experiments, all_reflections)
+      self.logger.log_step_time("WRITE_INPUT_CACHE", True)
+
     # Do we have any data?
     from xfel.merging.application.utils.data_counter import data_counter
     data_counter(self.params).count(all_experiments, all_reflections)
     return all_experiments, all_reflections
 
+  def read_file_pair(self, experiments_filename, reflections_filename):
+    '''Read and decode an experiments/reflections file pair'''
+    experiments = ExperimentListFactory.from_json_file(experiments_filename, check_format = self.params.input.read_image_headers)
+    reflections = flex.reflection_table.from_file(reflections_filename)
+    return experiments, reflections
+
+  def read_file_pairs(self, file_list):
+    '''Generate (experiments_filename, reflections_filename, experiments, reflections) in file list order.
+       With input.read_ahead.nthreads > 0, file pairs are fetched and decoded by a thread pool up to read_ahead.depth
+       pairs ahead of the consumer, overlapping I/O with the processing of previously read pairs.'''
+    nthreads = self.params.input.read_ahead.nthreads
+    if nthreads == 0:
+      for experiments_filename, reflections_filename in file_list:
+        self.logger.log("Reading %s %s"%(experiments_filename, reflections_filename))
+        experiments, reflections = self.read_file_pair(experiments_filename, reflections_filename)
+        yield experiments_filename, reflections_filename, experiments, reflections
+      return
+
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    depth = max(1, self.params.input.read_ahead.depth)
+    pending = deque()
+    file_pairs = iter(file_list)
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+      def submit_next():
+        file_pair = next(file_pairs, None)
+        if file_pair is not None:
+          self.logger.log("Reading %s %s"%file_pair)
+          pending.append((file_pair, executor.submit(self.read_file_pair, *file_pair)))
+      for i in range(depth):
+        submit_next()
+      while pending:
+        (experiments_filename, reflections_filename), future = pending.popleft()
+        submit_next()
+        experiments, reflections = future.result()
+        yield experiments_filename, reflections_filename, experiments, reflections
+
+  def log_read_throughput(self, file_list):
+    '''Report the read throughput of the LOAD step in the timing log'''
+    load_time = self.logger.timing_table['LOAD']['single_step']['elapsed']
+    if not file_list or load_time <= 0:
+      return
+    total_mb = sum(os.stat(path).st_size for file_pair in file_list for path in file_pair) / 1024**2
+    self.logger.log("Read %.1f MB in %d file pairs"%(total_mb, len(file_list)))
+    self.logger.timing_log("LOAD_THROUGHPUT: %f MB/s %f files/s"%(total_mb / load_time, 2 * len(file_list) / load_time))
+
+  def log_predicted_load_time(self, rank_cost):
+    '''Write the LOAD time predicted by the file load cost model next to the actual LOAD time. The cost model is in
+       arbitrary units, so it is calibrated with the total LOAD time over all ranks.'''
+    load_time = self.logger.timing_table['LOAD']['single_step']['elapsed']
+    total_load_time = self.mpi_helper.sum(load_time, root=None)
+    total_cost = self.mpi_helper.sum(rank_cost, root=None)
+    predicted_load_time = rank_cost * total_load_time / total_cost if total_cost > 0 else 0.0
+    self.logger.timing_log("LOAD_PREDICTED: %f s LOAD_ACTUAL: %f s COST: %f"%(predicted_load_time, load_time, rank_cost))
+
   def prune_reflection_table_keys(self, reflections):
     from xfel.merging.application.reflection_table_utils import reflection_table_utils
     reflections = reflection_table_utils.prune_reflection_table_keys(reflections=reflections,
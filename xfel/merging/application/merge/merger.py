@@ -30,32 +30,18 @@ class merger(worker):
       reflections["shuffled_id"] = flex.int(new_id_col)
       sel_col = "shuffled_id"
 
-    # select, merge and output odd reflections
-    odd_reflections = rt_util.select_odd_experiment_reflections(reflections, sel_col)
-    odd_reflections_merged = rt_util.merge_reflections(
-        odd_reflections,
-        self.params.merging.minimum_multiplicity,
-        thresh=self.params.filter.outlier.mad_thresh
-    )
+    # merge odd, even and all reflections in a single pass over the asu HKL groups
+    odd_reflections_merged, even_reflections_merged, all_reflections_merged = \
+        rt_util.merge_odd_even_all_reflections(
+            reflections,
+            self.params.merging.minimum_multiplicity,
+            col=sel_col,
+            thresh=self.params.filter.outlier.mad_thresh
+        )
+
+    # output odd, even and all reflections
     self.gather_and_output_reflections(odd_reflections_merged, 'odd')
-
-    # select, merge and output even reflections
-    even_reflections = rt_util.select_even_experiment_reflections(reflections, sel_col)
-    even_reflections_merged = rt_util.merge_reflections(
-        even_reflections,
-        self.params.merging.minimum_multiplicity,
-        thresh=self.params.filter.outlier.mad_thresh
-    )
     self.gather_and_output_reflections(even_reflections_merged, 'even')
-
-    # merge and output all reflections
-    name = "merged_good_refls2/rank%d" % self.mpi_helper.comm.rank
-    all_reflections_merged = rt_util.merge_reflections(
-        reflections,
-        self.params.merging.minimum_multiplicity,
-        nameprefix=name,
-        thresh=self.params.filter.outlier.mad_thresh
-    )
     self.gather_and_output_reflections(all_reflections_merged, 'all')
 
     return None, reflections
@@ -1,8 +1,12 @@
 from __future__ import absolute_import, division, print_function
 from xfel.merging.application.worker import worker
+from xfel.merging.application.reflection_table_utils import hkl_bin_lookup
+from dials.array_family import flex
+import numpy as np
 from xfel.merging.application.utils.memory_usage import get_memory_usage
 
 class resolution_binner(worker):
+  needs_experiment_models = False
 
   def __init__(self, params, mpi_helper=None, mpi_logger=None):
     super(resolution_binner, self).__init__(params=params, mpi_helper=mpi_helper, mpi_logger=mpi_logger)
@@ -36,16 +40,10 @@ class resolution_binner(worker):
       self.params.statistics.__setattr__('resolution_binner', resolution_binner)
 
     # Provide resolution bin number for each asu hkl in the full miller set
-    hkl_resolution_bins = {} # hkl vs resolution bin number
-    hkls_with_assigned_bin = 0
-    for i_bin in resolution_binner.range_used():
-      bin_hkl_selection = resolution_binner.selection(i_bin)
-      bin_hkls = full_miller_set.select(bin_hkl_selection)
-      for hkl in bin_hkls.indices():
-        assert not hkl in hkl_resolution_bins # each hkl should be assigned a bin number only once
-        hkl_resolution_bins[hkl] = i_bin
-        hkls_with_assigned_bin += 1
-    self.logger.log("Provided resolution bin number for %d asu hkls"%(hkls_with_assigned_bin))
+    bin_indices = resolution_binner.bin_indices().as_numpy_array()
+    assigned = np.isin(bin_indices, np.array(list(resolution_binner.range_used())))
+    hkl_resolution_bins = hkl_bin_lookup(full_miller_set.indices().select(flex.bool(assigned)), bin_indices[assigned])
+    self.logger.log("Provided resolution bin number for %d asu hkls"%(len(hkl_resolution_bins)))
 
     # Save hkl bin asignments to the parameters
     if not 'hkl_resolution_bins' in (self.params.statistics).__dict__:
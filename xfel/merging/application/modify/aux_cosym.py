@@ -166,7 +166,9 @@ class CosymAnalysis(BaseClass):
           weights=self.params.weights,
           twin_axes=twin_axis,
           twin_angles=twin_rotation,
-          cb_op=self.cb_op
+          cb_op=self.cb_op,
+          rij_nproc=self.params.rij.nproc,
+          sparse=self.params.rij.sparse,
       )
 
 
@@ -333,12 +335,23 @@ cosym.single_cb_op_to_minimum is not True')
         )
 
 
+_rij_wij_state = None # (compute_rij_wij_detail instance, number of lattices) while the Rij/Wij rows are computed
+
+def _compute_rij_wij_row(i_row):
+  '''Rij and Wij triplets (rows, columns, values) of one lattice row block as numpy arrays'''
+  CC, n_lattices = _rij_wij_state
+  rij_row, rij_col, rij_data, wij_row, wij_col, wij_data = CC.compute_one_row(n_lattices, i_row)
+  return (rij_row.as_numpy_array(), rij_col.as_numpy_array(), rij_data.as_numpy_array(),
+          wij_row.as_numpy_array(), wij_col.as_numpy_array(), wij_data.as_numpy_array())
+
 class TargetWithFastRij(Target):
   def __init__(self, *args, **kwargs):
 
     # nproc is an init arg that was removed from class
     # dials.algorithms.symmetry.cosym.target.Target in dials commit 1cd5afe4
     self._nproc = kwargs.pop('nproc', 1)
+    self._rij_nproc = kwargs.pop('rij_nproc', 1)
+    self._sparse = kwargs.pop('sparse', False)
 
     # if test_data_path is provided, we are constructing this for a unit test
     test_data_path = kwargs.pop('test_data_path', None)
@@ -372,9 +385,35 @@ class TargetWithFastRij(Target):
            assert lattice_id == len(self._lattices) - 1
        return lower_index, upper_index
 
+  def _sparse_residuals(self, x):
+    '''Weighted residuals w_ij * (r_ij - x_i.x_j) over the nonzero entries of the sparse Rij and Wij matrices'''
+    rows, cols, rij, wij = self._rij_wij_entries
+    x = x.reshape((self.dim, x.size // self.dim))
+    dots = np.einsum('ij,ij->j', x[:, rows], x[:, cols])
+    return x, rij - dots, wij
+
+  def compute_functional(self, x):
+    if not sparse.issparse(self.rij_matrix):
+      return super(TargetWithFastRij, self).compute_functional(x)
+    x, residuals, wij = self._sparse_residuals(x)
+    return 0.5 * np.sum(wij * np.square(residuals))
+
   def compute_gradients(self, x):
-    grad = super(TargetWithFastRij, self).compute_gradients(x)
-    return grad.A1
+    if not sparse.issparse(self.rij_matrix):
+      grad = super(TargetWithFastRij, self).compute_gradients(x)
+      return grad.A1
+    x, residuals, wij = self._sparse_residuals(x)
+    rows, cols = self._rij_wij_entries[:2]
+    weighted_residuals = sparse.csr_matrix((wij * residuals, (rows, cols)), shape=self.rij_matrix.shape)
+    grad = -2 * (weighted_residuals.T @ x.T).T
+    return grad.flatten()
+
+  def curvatures(self, x):
+    if not sparse.issparse(self.rij_matrix):
+      return super(TargetWithFastRij, self).curvatures(x)
+    x = x.reshape((self.dim, x.size // self.dim))
+    curvs = 2 * (self.wij_matrix.T @ np.square(x).T).T
+    return curvs.flatten()
 
   def _compute_rij_wij(self, use_cache=True, use_super=False):
 
@@ -382,20 +421,6 @@ class TargetWithFastRij(Target):
       # for testing
       return super()._compute_rij_wij(use_cache=use_cache)
 
-    def _compute_one_row(args):
-      """
-      Call the compute_one_row method of CC, which is a compute_rij_wij_detail
-      instance. Args is a tuple that we unpack because easy_mp.parallel_map
-      can only pass a single argument.
-      """
-      CC, i, NN = args
-      rij_row, rij_col, rij_data, wij_row, wij_col, wij_data = [
-          list(x) for x in CC.compute_one_row(self._lattices.size, i)
-      ]
-      rij = sparse.coo_matrix((rij_data, (rij_row, rij_col)), shape=(NN, NN))
-      wij = sparse.coo_matrix((wij_data, (wij_row, wij_col)), shape=(NN, NN))
-      return rij, wij
-
     n_lattices = self._lattices.size
     n_sym_ops = len(self.sym_ops)
     NN = n_lattices * n_sym_ops
@@ -421,23 +446,34 @@ class TargetWithFastRij(Target):
         indices[cb_op.as_xyz()] = indices_reindexed
         CC.set_indices(cb_op, indices_reindexed)
 
-    assert self._nproc==1
-    results = map(
-        _compute_one_row,
-        [(CC, i, NN) for i in range(n_lattices)]
-    )
-
-    rij_matrix = None
-    wij_matrix = None
-    for (rij, wij) in results:
-        if rij_matrix is None:
-            rij_matrix = rij
-            wij_matrix = wij
-        else:
-            rij_matrix += rij
-            wij_matrix += wij
-    self.rij_matrix = rij_matrix.todense().astype(np.float64)
-    self.wij_matrix = wij_matrix.todense().astype(np.float64)
+    # compute the rows, optionally in a pool of forked processes that inherit CC, and collect the triplets
+    global _rij_wij_state
+    _rij_wij_state = CC, n_lattices
+    rij_wij_nproc = getattr(self, '_rij_nproc', 1)
+    if rij_wij_nproc > 1 and n_lattices > 1:
+      import multiprocessing
+      with multiprocessing.get_context('fork').Pool(rij_wij_nproc) as pool:
+        results = pool.map(_compute_rij_wij_row, range(n_lattices), chunksize=1)
+    else:
+      results = [_compute_rij_wij_row(i) for i in range(n_lattices)]
+    _rij_wij_state = None
+    rij_row, rij_col, rij_data, wij_row, wij_col, wij_data = [
+        np.concatenate([result[k] for result in results]) if results else np.empty(0) for k in range(6)]
+    del results
+
+    # assemble each matrix once; duplicate entries are summed
+    rij_matrix = sparse.csr_matrix((rij_data, (rij_row, rij_col)), shape=(NN, NN), dtype=np.float64)
+    wij_matrix = sparse.csr_matrix((wij_data, (wij_row, wij_col)), shape=(NN, NN), dtype=np.float64)
+    if getattr(self, '_sparse', False):
+      rij_coo = rij_matrix.tocoo()
+      wij_coo = wij_matrix.tocoo()
+      assert np.array_equal(rij_coo.row, wij_coo.row) and np.array_equal(rij_coo.col, wij_coo.col)
+      self._rij_wij_entries = rij_coo.row, rij_coo.col, rij_coo.data, wij_coo.data
+      self.rij_matrix = rij_matrix
+      self.wij_matrix = wij_matrix
+    else:
+      self.rij_matrix = rij_matrix.todense()
+      self.wij_matrix = wij_matrix.todense()
     return self.rij_matrix, self.wij_matrix
 
 class TargetWithCustomSymops(TargetWithFastRij):
@@ -453,6 +489,8 @@ class TargetWithCustomSymops(TargetWithFastRij):
       twin_axes=None,
       twin_angles=None,
       cb_op=None,
+      rij_nproc=1,
+      sparse=False,
   ):
     '''
     A couple extra init arguments permit testing user-defined reindexing ops.
@@ -462,11 +500,16 @@ class TargetWithCustomSymops(TargetWithFastRij):
     cb_op is the previously determined transformation from the input cells to
         the minimum cell. The data have already been transformed by this
         operator, so we transform the twin operators before testing them.
+    rij_nproc is the number of processes computing the rows of the Rij and
+        Wij matrices. If sparse is True, the matrices are kept in CSR format
+        and the target is evaluated over their nonzero entries only.
     '''
 
     if nproc is not None:
       warnings.warn("nproc is deprecated", DeprecationWarning)
     self._nproc = 1
+    self._rij_nproc = rij_nproc
+    self._sparse = sparse
 
     if weights is not None:
       assert weights in ("count", "standard_error")
@@ -2,6 +2,7 @@ from __future__ import absolute_import, division, print_function
 from collections import Counter
 from contextlib import contextmanager
 from libtbx.mpi4py import MPI
+from xfel.merging.application.utils.step_profiler import counting_comm
 import numpy as np
 
 
@@ -42,14 +43,116 @@ def adaptive_collective(rooted_variant, non_rooted_variant):
   yield adaptive_collective_dispatcher
 
 
+class rank_reduction(object):
+  """
+  Named per-rank statistics combined across ranks in one collective. Register values with
+    add_sum   - scalars or fixed-size arrays summed elementwise over ranks (counters, histograms)
+    add_min   - scalars or fixed-size arrays, elementwise minimum over ranks
+    add_max   - scalars or fixed-size arrays, elementwise maximum over ranks
+    add_array - variable-length arrays, concatenated in rank order (e.g. per-experiment slopes)
+  and call flush. Every rank must register the same names, kinds and fixed sizes in the same order. The values are
+  packed into one float64 buffer, which is combined with a single Reduce if all entries are sums, and with a single
+  gather of the packed buffers otherwise. flush returns a dict of the combined values on the root rank (on every rank
+  if root is None) and None elsewhere; scalars come back as Python numbers, integer entries keep integer types.
+  Example:
+    reduction = self.mpi_helper.reduction()
+    reduction.add_sum('rejected', n_rejected)
+    reduction.add_array('slopes', slopes)
+    totals = reduction.flush()
+  """
+  def __init__(self, mpi_helper):
+    self.mpi_helper = mpi_helper
+    self.entries = [] # (name, kind, values)
+
+  def _add(self, name, kind, values):
+    assert name not in [entry[0] for entry in self.entries], "Duplicate reduction entry %s"%name
+    values = np.asarray(values)
+    if values.dtype == bool:
+      values = values.astype(np.int64)
+    self.entries.append((name, kind, values))
+
+  def add_sum(self, name, values):
+    self._add(name, 'sum', values)
+
+  def add_min(self, name, values):
+    self._add(name, 'min', values)
+
+  def add_max(self, name, values):
+    self._add(name, 'max', values)
+
+  def add_array(self, name, values):
+    self._add(name, 'array', np.ravel(values))
+
+  @staticmethod
+  def _unpack(values, like):
+    if np.issubdtype(like.dtype, np.integer):
+      values = np.rint(values).astype(np.int64)
+    else:
+      values = values.astype(like.dtype, copy=False)
+    return values.reshape(like.shape).item() if like.ndim == 0 else values.reshape(like.shape)
+
+  def flush(self, root=0):
+    fixed = [entry for entry in self.entries if entry[1] != 'array']
+    arrays = [entry for entry in self.entries if entry[1] == 'array']
+    self.entries = []
+    sizes = [values.size for _, _, values in fixed]
+    fixed_offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    packed = np.concatenate([values.ravel().astype(np.float64) for _, _, values in fixed] or [np.zeros(0)])
+    comm = self.mpi_helper.comm
+    is_receiver = root is None or self.mpi_helper.rank == root
+
+    if not arrays and all(kind == 'sum' for _, kind, _ in fixed):
+      combined = np.empty_like(packed) if is_receiver else None
+      if root is None:
+        comm.Allreduce(packed, combined, op=self.mpi_helper.MPI.SUM)
+      else:
+        comm.Reduce(packed, combined, op=self.mpi_helper.MPI.SUM, root=root)
+      array_values = [[] for _ in arrays]
+    else:
+      # packed buffer: fixed entries, then the lengths of the variable arrays, then their data
+      lengths = np.array([values.size for _, _, values in arrays], dtype=np.float64)
+      buffer = np.concatenate([packed, lengths] + [values.astype(np.float64) for _, _, values in arrays])
+      with adaptive_collective(comm.gather, comm.allgather) as gather:
+        buffers = gather(buffer, root=root)
+      if not is_receiver:
+        return None
+      all_fixed = np.stack([rank_buffer[:len(packed)] for rank_buffer in buffers])
+      combined = np.empty(len(packed))
+      for (name, kind, values), begin, end in zip(fixed, fixed_offsets[:-1], fixed_offsets[1:]):
+        combine = {'sum': np.sum, 'min': np.min, 'max': np.max}[kind]
+        combined[begin:end] = combine(all_fixed[:, begin:end], axis=0)
+      array_values = [[] for _ in arrays]
+      for rank_buffer in buffers:
+        rank_lengths = rank_buffer[len(packed):len(packed) + len(arrays)].astype(np.int64)
+        rank_offsets = len(packed) + len(arrays) + np.concatenate([[0], np.cumsum(rank_lengths)])
+        for i in range(len(arrays)):
+          array_values[i].append(rank_buffer[rank_offsets[i]:rank_offsets[i+1]])
+
+    if not is_receiver:
+      return None
+    result = {}
+    for (name, kind, values), begin, end in zip(fixed, fixed_offsets[:-1], fixed_offsets[1:]):
+      result[name] = self._unpack(combined[begin:end], values)
+    for (name, kind, values), pieces in zip(arrays, array_values):
+      concatenated = np.concatenate(pieces) if pieces else np.zeros(0)
+      result[name] = self._unpack(concatenated, np.empty(len(concatenated), dtype=values.dtype))
+    return result
+
 class mpi_helper(object):
   def __init__(self):
     self.MPI = MPI
-    self.comm = self.MPI.COMM_WORLD
+    # counts the collectives issued on the communicator, reported per step in the timing log
+    self.comm = counting_comm(self.MPI.COMM_WORLD, measure_bytes=False)
     self.rank = self.comm.Get_rank()
     self.size = self.comm.Get_size()
     self.error = (None,None) # (rank,description)
 
+  def reduction(self):
+    """
+    Start a set of named statistics to be combined across ranks in one collective, see rank_reduction.
+    """
+    return rank_reduction(self)
+
   def time(self):
     return self.MPI.Wtime()
 
@@ -125,3 +228,55 @@ class mpi_helper(object):
     with adaptive_collective(self.comm.Gatherv, self.comm.Allgatherv) as gather_v:
       gather_v(sendbuf=send_arrays, recvbuf=(gathered_array, lengths), root=root)
     return gathered_array
+
+  def alltoall_reflection_tables(self, tables, comm=None):
+    """
+    Exchange reflection tables between ranks without pickling: tables[i] is sent to rank i, and the list of
+    tables received from each rank is returned, as with comm.alltoall(tables). Each table is serialized into
+    its columnar msgpack representation and packed into one send buffer, the per-destination buffer sizes are
+    exchanged first, and all data are then moved in a single Alltoallv on contiguous numpy buffers. Besides the
+    tables themselves, the peak memory is the send and receive buffers plus one serialized table.
+    """
+    from dials.array_family import flex
+    comm = comm if comm is not None else self.comm
+    size = comm.Get_size()
+    assert len(tables) == size
+    if size == 1:
+      return list(tables)
+
+    # serialize the tables one at a time and append each to one buffer of 8-byte words, padding it to a whole word,
+    # which keeps the Alltoallv counts (C ints) well below their limit for any realistic per-rank data size. Only one
+    # serialized table exists besides the packed buffer at any time.
+    word = np.dtype(np.uint64).itemsize
+    send_bytes = np.empty(size, dtype=np.int64)
+    packed = bytearray()
+    for i, table in enumerate(tables):
+      serialized = table.as_msgpack()
+      send_bytes[i] = len(serialized)
+      packed += serialized
+      del serialized
+      packed += bytes(-len(packed) % word)
+    send_buffer = np.frombuffer(packed, dtype=np.uint64)
+    send_words = (send_bytes + word - 1) // word
+    send_displs = np.concatenate(([0], np.cumsum(send_words)[:-1]))
+
+    # exchange buffer sizes, then the buffers
+    recv_bytes = np.empty(size, dtype=np.int64)
+    comm.Alltoall(send_bytes, recv_bytes)
+    recv_words = (recv_bytes + word - 1) // word
+    recv_displs = np.concatenate(([0], np.cumsum(recv_words)[:-1]))
+    assert max(send_words.max(), recv_words.max(), send_displs[-1], recv_displs[-1]) < 2**31, \
+      "Reflection table chunk too large for a single Alltoallv, use a larger number of all-to-all slices"
+    recv_buffer = np.empty(int(recv_words.sum()), dtype=np.uint64)
+    comm.Alltoallv([send_buffer, (send_words.astype(np.int32), send_displs.astype(np.int32)), self.MPI.UINT64_T],
+                   [recv_buffer, (recv_words.astype(np.int32), recv_displs.astype(np.int32)), self.MPI.UINT64_T])
+    del send_buffer, packed
+
+    # rebuild the received tables. from_msgpack needs a bytes object, so each received table is copied once more
+    # while it is deserialized, one table at a time.
+    recv_buffer_bytes = recv_buffer.view(np.uint8)
+    received_tables = []
+    for i in range(size):
+      start = recv_displs[i] * word
+      received_tables.append(flex.reflection_table.from_msgpack(recv_buffer_bytes[start:start + recv_bytes[i]].tobytes()))
+    return received_tables
@@ -85,6 +85,15 @@ class mpi_logger(object):
     self.main_log_buffer = ''
     log_file_handle.close()
 
+  def timing_log(self, message):
+    '''Write a line to the timing log file, if timing is enabled'''
+    if self.timing_file_path == None:
+      return
+
+    log_file = open(self.timing_file_path,'a')
+    log_file.write("RANK %d %s\n"%(self.mpi_helper.rank, message))
+    log_file.close()
+
   def log_step_time(self, step, step_finished=False):
     '''Log elapsed time for an execution step'''
 
@@ -98,6 +107,7 @@ class mpi_logger(object):
                                       )
       else: # if a step is executed repeatedly - re-use the existent step key
         self.timing_table[step]['single_step']['start'] = self.mpi_helper.time()
+      self.timing_table[step]['single_step']['collectives_start'] = self.mpi_helper.comm.n_collectives
       return
 
     # a step has finished - calculate its elapsed and cumulative time (the latter is needed when the step is executed repeatedly)
@@ -114,6 +124,10 @@ class mpi_logger(object):
     if self.timing_file_path == None:
       return
 
+    # collectives issued on mpi_helper.comm during the step, if any
+    collectives = self.mpi_helper.comm.n_collectives - self.timing_table[step]['single_step']['collectives_start']
+    collectives_text = " %d collectives"%collectives if collectives > 0 else ""
+
     log_file = open(self.timing_file_path,'a')
-    log_file.write("RANK %d %s: %f s %f s\n"%(self.mpi_helper.rank, step, self.timing_table[step]['single_step']['elapsed'], self.timing_table[step]['cumulative']))
+    log_file.write("RANK %d %s: %f s %f s%s\n"%(self.mpi_helper.rank, step, self.timing_table[step]['single_step']['elapsed'], self.timing_table[step]['cumulative'], collectives_text))
     log_file.close()
@@ -11,6 +11,19 @@ dispatch {
   step_list = None
     .type = strings
     .help = List of steps to use. None means use the full set of steps to merge.
+  checkpoint {
+    save_after = None
+      .type = strings
+      .help = Names of steps (entries of step_list) after which every rank writes its experiments, reflections and the model
+      .help = state derived by the steps so far (reference intensities, Miller set, average unit cell, etc.) to a checkpoint.
+    resume_at = None
+      .type = str
+      .help = Name of a step of step_list to start at, from the checkpoint written after the preceding step. The run must use
+      .help = the same number of ranks and the same parameters for the preceding steps as the run that wrote the checkpoint.
+    directory = None
+      .type = path
+      .help = Directory for the checkpoints, one subdirectory per step. None means output_dir/checkpoints.
+  }
 }
 """
 
@@ -43,6 +56,11 @@ input {
   keep_imagesets = True
     .type = bool
     .help = If True, keep imagesets attached to experiments
+  experiment_summary = False
+    .type = bool
+    .help = If True and keep_imagesets is False, the input step keeps a compact, array-backed summary of each \
+            experiment (identifier, crystal, beam) instead of full experiment models, and the balance step exchanges \
+            the summary. Experiment models (crystal and beam only) are rebuilt before the first step that needs them.
   read_image_headers = False
     .type = bool
     .help = If True, when loading data also read image headers. Not needed when merging integrated data.
@@ -61,12 +79,49 @@ input {
     .type = str
     .help = Find file names with this suffix for experiments
 
+  cache {
+    directory = None
+      .type = path
+      .help = If set, the input step caches each rank's pruned, id-remapped reflections (one memory-mappable .npy
+      .help = file per column), its experiments and a compact experiment summary (A matrix, wavelength, unit cell,
+      .help = identifiers) under this directory. The cache is keyed by the input file list with file sizes and
+      .help = modification times, the number of ranks and the input parameters, so a later run over the same
+      .help = input with the same number of ranks loads from the cache instead of the input files.
+  }
+  read_ahead {
+    nthreads = 0
+      .type = int(value_min=0)
+      .help = Number of threads per rank used to fetch and decode experiments/reflections file pairs ahead of
+      .help = the loader, overlapping file I/O with identifier and id bookkeeping. 0 (default) reads the files
+      .help = sequentially.
+    depth = 4
+      .type = int(value_min=1)
+      .help = Maximum number of file pairs read ahead of the loader, which bounds the extra memory used.
+  }
+
   parallel_file_load {
-    method = *uniform node_memory
+    method = *uniform node_memory cost_model
       .type = choice
       .help = uniform: distribute input experiments/reflections files uniformly over all available ranks
       .help = node_memory: distribute input experiments/reflections files over the nodes such that the node memory limit is not exceeded.
       .help = Within each node distribute the input files uniformly over all ranks of that node.
+      .help = cost_model: estimate the load cost of every file pair from its reflection and experiment counts, read from the
+      .help = reflection file header or estimated from the file sizes, and assign file pairs to ranks by longest-processing-time
+      .help = bin packing. The predicted and actual LOAD times per rank are written to the timing log.
+    cost_model {
+      experiment_cost = 500
+        .type = float
+        .help = cost of loading one experiment, in units of the cost of loading one reflection
+      bytes_per_reflection = 250
+        .type = float
+        .help = used to estimate the reflection count from the reflection file size if the file header can't be read
+      bytes_per_experiment = 8000
+        .type = float
+        .help = used to estimate the experiment count from the experiment file size if the reflection file header can't be read
+      pickle_cost_factor = 2.0
+        .type = float
+        .help = cost multiplier for reflection files in pickle format
+    }
     node_memory {
       architecture = "Cori KNL"
         .type = str
@@ -108,6 +163,12 @@ mp {
     cProfile = False
       .type = bool
       .help = Enable code profiling. Use (for example) runsnake to visualize processing performance
+    profile_steps = False
+      .type = bool
+      .help = For every step and rank, record wall and CPU time, peak memory growth, the number, size and duration of the
+      .help = MPI collectives, and the experiment and reflection counts before and after the step. The records are written
+      .help = to profile_*.json and profile_*.csv files in the output directory. Use cctbx.xfel.merge_profile to summarize
+      .help = them into a load-imbalance report.
   }
 }
 """
@@ -285,6 +346,19 @@ modify
       .multiple = True
       .help = Rotation corresponding to a value of twin_axis. Given as an \
           n-fold rotation, e.g. 2 denotes a twofold rotation.
+    rij
+      .help = Construction of the Rij (correlation) and Wij (weight) matrices of the cosym target
+      {
+      nproc = 1
+        .type = int(value_min=1)
+        .help = Number of processes computing the lattice rows of Rij and Wij. Processes are forked from the
+        .help = MPI rank; make sure the MPI implementation supports fork before using nproc > 1.
+      sparse = False
+        .type = bool
+        .help = Keep Rij and Wij as sparse matrices and evaluate the cosym functional, gradients and curvatures
+        .help = over their nonzero entries, instead of densifying them. Memory then scales with the number of
+        .help = correlated lattice pairs rather than (lattices x symops) squared, allowing larger tranches.
+      }
     single_cb_op_to_minimum = False
       .type = bool
       .help = Internally the lattices are transformed to a primitive cell \
@@ -422,6 +496,11 @@ scaling {
             "due to partiality is proportional to Icalc; this term is added to"
             "the sigma(Iobs) determined in integration so that sigma ="
             "sqrt(Icalc**2 + sigma(Iobs)**2)."
+  batched = False
+    .type = bool
+    .help = If True, match all reflections on a rank to the model HKLs at once and solve the per-experiment
+    .help = slopes and correlations of the mark0 fit in closed form with grouped reductions, instead of
+    .help = matching and fitting one experiment at a time.
 }
 """
 
@@ -483,6 +562,10 @@ postrefinement {
     .type = bool
     .help = each-image trumpet plot showing before-after plot. Spot color warmth indicates I/sigma
     .help = Spot radius for lower plot reflects partiality. Only implemented for rs_hybrid
+  nproc = 1
+    .type = int(value_min=1)
+    .help = Number of processes used by each MPI rank to post-refine its experiments in parallel (rs and eta_deff).
+    .help = Processes are forked from the rank; make sure the MPI implementation supports fork before using nproc > 1.
 }
 """
 merging_phil = """
@@ -656,6 +739,11 @@ statistics {
     verbose = False
       .type = bool
       .help = If True, include the ΔCC½ for every lattice in the main log.
+    method = *dense sparse
+      .type = choice
+      .help = dense: leave-one-out sums in arrays of all experiments x HKLs on each rank.
+      .help = sparse: per-HKL sums plus corrections for the HKLs each experiment measured. Memory scales with
+      .help = the number of observations instead of experiments x HKLs; the results are the same.
   }
   predictions_to_edge {
     apply = False
@@ -687,6 +775,21 @@ parallel {
     .help = memory reduction factor for MPI alltoall.
     .help = Use a2a > 1, when available RAM is insufficient for doing MPI alltoall on all data at once.
     .help = The data will be split into a2a parts and, correspondingly, alltoall will be performed in a2a iterations.
+  a2a_memory_budget = None
+    .type = float(value_min=0)
+    .expert_level = 2
+    .help = Per-rank memory budget, in MB, for the reflections sent in one round of the group step alltoall.
+    .help = If set, the number of alltoall rounds is increased above a2a as needed, so that no rank sends more
+    .help = than this amount of data per round. The budget covers the send side only: a rank still holds its
+    .help = data left to send, which shrinks every round, and the table its received slices are written into,
+    .help = which is allocated for all of its hkls up front.
+  a2a_method = *pickle buffer
+    .type = choice
+    .expert_level = 2
+    .help = How reflection tables are exchanged in the MPI alltoall steps (group and balance).
+    .help = pickle: mpi4py alltoall on lists of reflection tables, which pickles every chunk.
+    .help = buffer: serialize every chunk into a contiguous columnar (msgpack) buffer, exchange the buffer sizes
+    .help = and then the data with a single MPI Alltoallv, and rebuild the tables on the receiving side without pickling.
 }
 """
 
@@ -0,0 +1,124 @@
+from __future__ import absolute_import, division, print_function
+import sys, time
+import numpy as np
+from dials.array_family import flex
+from cctbx import miller
+from cctbx.crystal import symmetry
+from scitbx import matrix
+from libtbx import group_args
+from xfel.merging.application.reflection_table_utils import experiment_index
+from xfel.merging.application.postrefine.postrefinement_rs import postrefinement_rs, postrefine_experiment, \
+  init_postrefinement_pool, postrefine_experiment_in_pool
+
+"""
+Benchmark the post-refinement front end (matching observations to the model) and the per-experiment refinement
+on synthetic still lattices.
+Usage: libtbx.python benchmark_postrefinement_rs.py [n_lattices] [nproc]
+"""
+
+def synthetic_lattices(n_lattices, seed=0):
+  '''A model miller array and a reflection table of partially recorded observations from randomly oriented lattices'''
+  rng = np.random.default_rng(seed)
+  flex.set_random_seed(seed)
+  symm = symmetry(unit_cell=(78.,78.,37.,90.,90.,90.), space_group_symbol='P43212')
+  miller_set = symm.build_miller_set(anomalous_flag=True, d_min=2.0)
+  i_model = miller_set.array(data=flex.double(rng.gamma(1., 1000., miller_set.size())),
+                             sigmas=flex.double(miller_set.size(), 1.))
+  all_indices = symm.build_miller_set(anomalous_flag=True, d_min=1.6).expand_to_p1().indices()
+  B = matrix.sqr(symm.unit_cell().fractionalization_matrix()).transpose()
+  wavelength = 1.3
+  lookup = dict(zip(i_model.indices(), i_model.data()))
+
+  crystals = []
+  reflections = flex.reflection_table()
+  for i in range(n_lattices):
+    A = matrix.sqr(flex.random_double_r3_rotation_matrix()) * B
+    Xhkl = flex.mat3_double(len(all_indices), A) * all_indices.as_vec3_double()
+    Rh = (Xhkl + (0., 0., -1./wavelength)).norms() - 1./wavelength
+    rs = 0.002
+    partiality = rs**2 / (2. * Rh * Rh + rs**2)
+    observed = partiality > 0.05
+    indices = all_indices.select(observed)
+    asu = miller.set(symm, indices, True).map_to_asu().indices()
+    I_ref = flex.double([lookup.get(hkl, 100.) for hkl in asu])
+    I_obs = I_ref * partiality.select(observed) * rng.uniform(0.5, 2.) + flex.double(rng.normal(0., 10., len(asu)))
+    table = flex.reflection_table()
+    table['miller_index'] = indices
+    table['miller_index_asymmetric'] = asu
+    table['intensity.sum.value'] = I_obs
+    table['intensity.sum.variance'] = flex.double(len(asu), 100.)
+    table['id'] = flex.int(len(asu), i)
+    reflections.extend(table)
+    crystals.append(group_args(A=A.elems, MOSAICITY_DEG=0.05, DOMAIN_SIZE_A=2000., WAVE=wavelength))
+  return miller_set, i_model, crystals, reflections
+
+def front_end_per_experiment(index, miller_set, i_model):
+  '''The original front end: match and gather the observations of one experiment at a time'''
+  symm = miller_set.crystal_symmetry()
+  gathered = []
+  for expt_id in range(len(index)):
+    exp_reflections = index[expt_id]
+    observations = miller.array(miller.set(symm, exp_reflections['miller_index_asymmetric'], True),
+                                exp_reflections['intensity.sum.value'], flex.sqrt(exp_reflections['intensity.sum.variance']))
+    matches = miller.match_multi_indices(miller_indices_unique = miller_set.indices(), miller_indices = observations.indices())
+    pair1 = flex.int([pair[1] for pair in matches.pairs()])
+    MILLER = flex.miller_index([exp_reflections['miller_index'][p] for p in pair1])
+    I_observed = flex.double([observations.data()[p] for p in pair1])
+    I_reference = flex.double([i_model.data()[pair[0]] for pair in matches.pairs()])
+    gathered.append((MILLER, I_observed, I_reference))
+  return gathered
+
+def front_end_batched(index, miller_set, i_model):
+  '''The batched front end used by postrefinement_rs.run'''
+  matched_rows, matched_model_rows, matched_offsets = postrefinement_rs.match_observations_to_model(index, miller_set)
+  gathered = []
+  for expt_id in range(len(index)):
+    rows = flex.size_t(matched_rows[matched_offsets[expt_id]:matched_offsets[expt_id+1]].astype(np.uint64))
+    model_rows = flex.size_t(matched_model_rows[matched_offsets[expt_id]:matched_offsets[expt_id+1]].astype(np.uint64))
+    gathered.append((index.reflections['miller_index'].select(rows),
+                     index.reflections['intensity.sum.value'].select(rows),
+                     i_model.data().select(model_rows)))
+  return gathered
+
+if __name__ == '__main__':
+  n_lattices = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  nproc = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+  miller_set, i_model, crystals, reflections = synthetic_lattices(n_lattices)
+  index = experiment_index(reflections, n_experiments=n_lattices)
+  print("Synthetic data: %d lattices, %d observations, %d model HKLs"%(n_lattices, len(reflections), len(miller_set.indices())))
+
+  t0 = time.time()
+  reference = front_end_per_experiment(index, miller_set, i_model)
+  t1 = time.time()
+  batched = front_end_batched(index, miller_set, i_model)
+  t2 = time.time()
+  print("Front end, per experiment: %.3f s"%(t1 - t0))
+  print("Front end, batched:        %.3f s"%(t2 - t1))
+  for ref, new in zip(reference, batched):
+    assert (ref[0] == new[0]).count(False) == 0
+    assert np.array_equal(ref[1].as_numpy_array(), new[1].as_numpy_array())
+    assert np.array_equal(ref[2].as_numpy_array(), new[2].as_numpy_array())
+
+  from xfel.merging.application.phil.phil import phil_scope
+  params = phil_scope.extract()
+  params.postrefinement.algorithm = 'rs'
+  tasks = [group_args(A=crystal.A, WAVE=crystal.WAVE, MOSAICITY_DEG=crystal.MOSAICITY_DEG, DOMAIN_SIZE_A=crystal.DOMAIN_SIZE_A,
+                      MILLER=MILLER, I_observed=I_observed, I_reference=I_reference, I_invalid=flex.bool(len(MILLER), False))
+           for crystal, (MILLER, I_observed, I_reference) in zip(crystals, batched)]
+
+  t0 = time.time()
+  sequential = [postrefine_experiment(params, task) for task in tasks]
+  t1 = time.time()
+  from concurrent.futures import ProcessPoolExecutor
+  with ProcessPoolExecutor(max_workers=nproc, initializer=init_postrefinement_pool, initargs=(params,)) as executor:
+    pooled = list(executor.map(postrefine_experiment_in_pool, tasks, chunksize=max(1, n_lattices//(4*nproc))))
+  t2 = time.time()
+  print("Refinement, sequential:     %.3f s"%(t1 - t0))
+  print("Refinement, %2d processes:   %.3f s"%(nproc, t2 - t1))
+  for seq, pool in zip(sequential, pooled):
+    assert seq.reason == pool.reason
+    if seq.reason is None:
+      assert np.allclose(seq.scaler.as_numpy_array(), pool.scaler.as_numpy_array())
+  print("Rejected: %d of %d"%(sum(result.reason is not None for result in sequential), n_lattices))
+  print("OK")
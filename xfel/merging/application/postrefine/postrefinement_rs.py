@@ -7,12 +7,12 @@ import math
 from xfel.merging.application.worker import worker
 from libtbx import adopt_init_args, group_args
 from dials.array_family import flex
+from xfel.merging.application.reflection_table_utils import experiment_index, hkl_lookup
 from dxtbx.model.experiment_list import ExperimentList
-from cctbx import miller
-from cctbx.crystal import symmetry
 from scitbx import matrix
 from scitbx.math.tests.tst_weighted_correlation import simple_weighted_correlation
 from cctbx.crystal_orientation import crystal_orientation, basis_type
+import numpy as np
 
 class postrefinement_rs(worker):
 
@@ -30,7 +30,6 @@ class postrefinement_rs(worker):
         self.logger.main_log("No post-refinement was done")
       return experiments, reflections
 
-    target_symm = symmetry(unit_cell = self.params.scaling.unit_cell, space_group_info = self.params.scaling.space_group)
     i_model = self.params.scaling.i_model
     miller_set = self.params.scaling.miller_set
 
@@ -49,176 +48,75 @@ class postrefinement_rs(worker):
 
     experiments_rejected_by_reason = Counter()  # reason:how_many_rejected
 
-    for expt_id, experiment in enumerate(experiments):
+    # index the reflections by experiment once instead of selecting on the id column for every experiment
+    index = experiment_index(reflections, n_experiments=len(experiments))
+    indexed_reflections = index.reflections
+
+    # Match the observations of all experiments to the model in one lookup. For every experiment, the matched rows of
+    # indexed_reflections are in the order of the pairs returned by match_multi_indices for that experiment.
+    self.logger.log_step_time("POSTREFINEMENT_MATCH")
+    matched_rows, matched_model_rows, matched_offsets = self.match_observations_to_model(index, miller_set)
+    all_I_observed = indexed_reflections['intensity.sum.value']
+    all_sigmas = flex.sqrt(indexed_reflections['intensity.sum.variance'])
+    self.logger.log_step_time("POSTREFINEMENT_MATCH", True)
+
+    def tasks():
+      for expt_id, experiment in enumerate(experiments):
+        rows = flex.size_t(matched_rows[matched_offsets[expt_id]:matched_offsets[expt_id+1]].astype(np.uint64))
+        model_rows = flex.size_t(matched_model_rows[matched_offsets[expt_id]:matched_offsets[expt_id+1]].astype(np.uint64))
+        yield group_args(
+          A = experiment.crystal.get_A(),
+          WAVE = experiment.beam.get_wavelength(),
+          MOSAICITY_DEG = experiment.crystal.get_half_mosaicity_deg(),
+          DOMAIN_SIZE_A = experiment.crystal.get_domain_size_ang(),
+          MILLER = indexed_reflections['miller_index'].select(rows), # original miller indices of the matched observations
+          I_observed = all_I_observed.select(rows),
+          I_reference = i_model.data().select(model_rows),
+          I_invalid = i_model.sigmas().select(model_rows) < 0.)
+
+    def collect(results):
+      for expt_id, (experiment, result) in enumerate(zip(experiments, results)):
+        if self.params.output.log_level == 0:
+          for message in result.log:
+            self.logger.log(message)
+
+        if result.reason is not None:
+          experiments_rejected_by_reason[result.reason] += 1
+          continue
 
-      exp_reflections = reflections.select(reflections['id'] == expt_id)
-
-      # Build a miller array with _original_ miller indices of the experiment reflections
-      exp_miller_indices_original = miller.set(target_symm, exp_reflections['miller_index'], not self.params.merging.merge_anomalous)
-      observations_original_index = miller.array(exp_miller_indices_original, exp_reflections['intensity.sum.value'], flex.sqrt(exp_reflections['intensity.sum.variance']))
-
-      assert exp_reflections.size() == exp_miller_indices_original.size()
-      assert observations_original_index.size() == exp_miller_indices_original.size()
-
-      # Build a miller array with _asymmetric_ miller indices of the experiment reflections
-      exp_miller_indices_asu = miller.set(target_symm, exp_reflections['miller_index_asymmetric'], True)
-      observations = miller.array(exp_miller_indices_asu, exp_reflections['intensity.sum.value'], flex.sqrt(exp_reflections['intensity.sum.variance']))
-
-      matches = miller.match_multi_indices(miller_indices_unique = miller_set.indices(), miller_indices = observations.indices())
-
-      pair1 = flex.int([pair[1] for pair in matches.pairs()]) # refers to the observations
-      pair0 = flex.int([pair[0] for pair in matches.pairs()]) # refers to the model
-
-      # narrow things down to the set that matches, only
-      observations_pair1_selected = observations.customized_copy(indices = flex.miller_index([observations.indices()[p] for p in pair1]),
-                                                                 data = flex.double([observations.data()[p] for p in pair1]),
-                                                                 sigmas = flex.double([observations.sigmas()[p] for p in pair1]))
-
-      observations_original_index_pair1_selected = observations_original_index.customized_copy(indices = flex.miller_index([observations_original_index.indices()[p] for p in pair1]),
-                                                                                               data = flex.double([observations_original_index.data()[p] for p in pair1]),
-                                                                                               sigmas = flex.double([observations_original_index.sigmas()[p] for p in pair1]))
-      I_observed = observations_pair1_selected.data()
-      MILLER = observations_original_index_pair1_selected.indices()
-
-      ORI = crystal_orientation(experiment.crystal.get_A(), basis_type.reciprocal)
-      Astar = matrix.sqr(ORI.reciprocal_matrix())
-      Astar_from_experiment = matrix.sqr(experiment.crystal.get_A())
-      assert Astar == Astar_from_experiment
-
-      WAVE = experiment.beam.get_wavelength()
-      BEAM = matrix.col((0.0,0.0,-1./WAVE))
-      BFACTOR = 0.
-      MOSAICITY_DEG = experiment.crystal.get_half_mosaicity_deg()
-      DOMAIN_SIZE_A = experiment.crystal.get_domain_size_ang()
-
-      # calculation of correlation here
-      I_reference = flex.double([i_model.data()[pair[0]] for pair in matches.pairs()])
-      I_invalid = flex.bool([i_model.sigmas()[pair[0]] < 0. for pair in matches.pairs()])
-      use_weights = False # New facility for getting variance-weighted correlation
-
-      if use_weights:
-        # variance weighting
-        I_weight = flex.double([1./(observations_pair1_selected.sigmas()[pair[1]])**2 for pair in matches.pairs()])
-      else:
-        I_weight = flex.double(len(observations_pair1_selected.sigmas()), 1.)
-
-      I_weight.set_selected(I_invalid, 0.)
-
-      """Explanation of 'include_negatives' semantics as originally implemented in cxi.merge postrefinement:
-         include_negatives = True
-         + and - reflections both used for Rh distribution for initial estimate of RS parameter
-         + and - reflections both used for calc/obs correlation slope for initial estimate of G parameter
-         + and - reflections both passed to the refinery and used in the target function (makes sense if
-                             you look at it from a certain point of view)
-
-         include_negatives = False
-         + and - reflections both used for Rh distribution for initial estimate of RS parameter
-         +       reflections only used for calc/obs correlation slope for initial estimate of G parameter
-         + and - reflections both passed to the refinery and used in the target function (makes sense if
-                             you look at it from a certain point of view)
-
-         NOTE: by the new design, "include negatives" is always True
-      """
-
-      SWC = simple_weighted_correlation(I_weight, I_reference, I_observed)
-      if self.params.output.log_level == 0:
-        self.logger.log("Old correlation is: %f"%SWC.corr)
-
-      if self.params.postrefinement.algorithm == "rs":
-
-        Rhall = flex.double()
-
-        for mill in MILLER:
-          H = matrix.col(mill)
-          Xhkl = Astar*H
-          Rh = ( Xhkl + BEAM ).length() - (1./WAVE)
-          Rhall.append(Rh)
-
-        Rs = math.sqrt(flex.mean(Rhall*Rhall))
-
-        RS = 1./10000. # reciprocal effective domain size of 1 micron
-        RS = Rs        # try this empirically determined approximate, monochrome, a-mosaic value
-        current = flex.double([SWC.slope, BFACTOR, RS, 0., 0.])
-
-        parameterization_class = rs_parameterization
-        refinery = rs_refinery(ORI=ORI, MILLER=MILLER, BEAM=BEAM, WAVE=WAVE, ICALCVEC = I_reference, IOBSVEC = I_observed)
-
-      elif self.params.postrefinement.algorithm == "eta_deff":
-
-        eta_init = 2. * MOSAICITY_DEG * math.pi/180.
-        D_eff_init = 2. * DOMAIN_SIZE_A
-        current = flex.double([SWC.slope, BFACTOR, eta_init, 0., 0., D_eff_init])
-
-        parameterization_class = eta_deff_parameterization
-        refinery = eta_deff_refinery(ORI=ORI, MILLER=MILLER, BEAM=BEAM, WAVE=WAVE, ICALCVEC = I_reference, IOBSVEC = I_observed)
-
-      func = refinery.fvec_callable(parameterization_class(current))
-      functional = flex.sum(func * func)
-
-      if self.params.output.log_level == 0:
-        self.logger.log("functional: %f"%functional)
-
-      self.current = current;
-      self.parameterization_class = parameterization_class
-      self.refinery = refinery;
-
-      self.observations_pair1_selected = observations_pair1_selected;
-      self.observations_original_index_pair1_selected = observations_original_index_pair1_selected
-
-      error_detected = False
-
-      try:
-        self.run_plain()
-
-        result_observations_original_index, result_observations, result_matches = self.result_for_cxi_merge()
-
-        assert result_observations_original_index.size() == result_observations.size()
-        assert result_matches.pairs().size() == result_observations_original_index.size()
-        # Calculate the correlation of each frame after corrections.
-        # This is used in the MM24 error model to determine a per frame level of error
-        # These are the added to the reflection table
-        I_observed = result_observations.data()
-        matches = miller.match_multi_indices(
-          miller_indices_unique = miller_set.indices(),
-          miller_indices = result_observations.indices()
-        )
-        I_reference = flex.double([i_model.data()[pair[0]] for pair in matches.pairs()])
-        I_invalid = flex.bool([i_model.sigmas()[pair[0]] < 0. for pair in matches.pairs()])
-        I_weight = flex.double(len(result_observations.sigmas()), 1.)
-        I_weight.set_selected(I_invalid, 0.)
-        SWC_after_post = simple_weighted_correlation(I_weight, I_reference, I_observed)
-      except (AssertionError, ValueError, RuntimeError) as e:
-        error_detected = True
-        reason = repr(e)
-        if not reason:
-          reason = "Unknown error"
-        experiments_rejected_by_reason[reason] += 1
-
-      if not error_detected:
         new_experiments.append(experiment)
 
+        # rows of the input reflections that survived the post-refinement, in the order of the matched observations
+        exp_rows = flex.size_t(matched_rows[matched_offsets[expt_id]:matched_offsets[expt_id+1]].astype(np.uint64))
+        result_rows = exp_rows.select(result.fat_selection)
+        exp_reflections_match_results = indexed_reflections.select(result_rows)
+
         new_exp_reflections = flex.reflection_table()
-        new_exp_reflections['miller_index_asymmetric']  = result_observations.indices()
-        new_exp_reflections['intensity.sum.value']      = result_observations.data()
-        new_exp_reflections['intensity.sum.variance']   = flex.pow(result_observations.sigmas(),2)
+        new_exp_reflections['miller_index_asymmetric']  = exp_reflections_match_results['miller_index_asymmetric']
+        new_exp_reflections['intensity.sum.value']      = (all_I_observed.select(exp_rows)/result.scaler).select(result.fat_selection)
+        new_exp_reflections['intensity.sum.variance']   = flex.pow((all_sigmas.select(exp_rows)/result.scaler).select(result.fat_selection),2)
         new_exp_reflections['id']                       = flex.int(len(new_exp_reflections), len(new_experiments)-1)
         new_exp_reflections.experiment_identifiers()[len(new_experiments)-1] = experiment.identifier
 
         # The original reflection table, i.e. the input to this run() method, has more columns than those used
-        # for the postrefinement ("data" and "sigma" in the miller arrays). The problems is: some of the input reflections may have been rejected by now.
-        # So to bring those extra columns over to the new reflection table, we have to create a subset of the original exp_reflections table,
-        # which would match (by original miller indices) the miller array results of the postrefinement.
-        match_original_indices = miller.match_multi_indices(miller_indices_unique = exp_miller_indices_original.indices(), miller_indices = result_observations_original_index.indices())
-        exp_reflections_match_results = exp_reflections.select(match_original_indices.pairs().column(0))
-        assert (exp_reflections_match_results['intensity.sum.value'] == result_observations_original_index.data()).count(False) == 0
+        # for the postrefinement. Bring the extra columns of the surviving reflections over to the new reflection table.
         new_exp_reflections['intensity.sum.value.unmodified'] = exp_reflections_match_results['intensity.sum.value.unmodified']
         new_exp_reflections['intensity.sum.variance.unmodified'] = exp_reflections_match_results['intensity.sum.variance.unmodified']
         for key in self.params.input.persistent_refl_cols:
           if not key in new_exp_reflections.keys() and key in exp_reflections_match_results.keys():
             new_exp_reflections[key] = exp_reflections_match_results[key]
-        new_exp_reflections["correlation_after_post"] = flex.double(len(new_exp_reflections), SWC_after_post.corr)
+        new_exp_reflections["correlation_after_post"] = flex.double(len(new_exp_reflections), result.correlation_after_post)
         new_reflections.extend(new_exp_reflections)
 
+    nproc = self.params.postrefinement.nproc
+    if nproc > 1 and len(experiments) > 1:
+      from concurrent.futures import ProcessPoolExecutor
+      self.logger.log("Post-refining %d experiments with %d processes"%(len(experiments), nproc))
+      with ProcessPoolExecutor(max_workers=nproc, initializer=init_postrefinement_pool, initargs=(self.params,)) as pool:
+        collect(pool.map(postrefine_experiment_in_pool, tasks(), chunksize=max(1, len(experiments)//(4*nproc))))
+    else:
+      collect(postrefine_experiment(self.params, task) for task in tasks())
+
     # report rejected experiments, reflections
     experiments_rejected_by_postrefinement = len(experiments) - len(new_experiments)
     reflections_rejected_by_postrefinement = reflections.size() - new_reflections.size()
@@ -231,13 +129,17 @@ class postrefinement_rs(worker):
 
     # Now that each rank has all reasons from all ranks, we can treat the reasons in a uniform way.
     total_experiments_rejected_by_reason = self.mpi_helper.count(experiments_rejected_by_reason)
-    total_accepted_experiment_count = self.mpi_helper.sum(len(new_experiments))
 
     # how many reflections have we rejected due to post-refinement?
     rejected_reflections = len(reflections) - len(new_reflections);
-    total_rejected_reflections = self.mpi_helper.sum(rejected_reflections)
+    reduction = self.mpi_helper.reduction()
+    reduction.add_sum('accepted_experiments', len(new_experiments))
+    reduction.add_sum('rejected_reflections', rejected_reflections)
+    totals = reduction.flush()
 
     if self.mpi_helper.rank == 0:
+      total_accepted_experiment_count = totals['accepted_experiments']
+      total_rejected_reflections = totals['rejected_reflections']
       for reason, count in six.iteritems(total_experiments_rejected_by_reason):
         self.logger.main_log("Total experiments rejected due to %s: %d"%(reason,count))
       self.logger.main_log("Total experiments accepted: %d"%total_accepted_experiment_count)
@@ -251,68 +153,139 @@ class postrefinement_rs(worker):
 
     return new_experiments, new_reflections
 
-  def run_plain(self):
-
+  @staticmethod
+  def match_observations_to_model(index, miller_set):
+    '''Match the asu miller indices of all reflections in an experiment_index to miller_set at once. Returns the matched
+       rows of index.reflections (ascending, hence grouped by experiment), the miller_set position of each matched row
+       and, for each experiment, the offsets of its matched rows.'''
+    model_rows = hkl_lookup(miller_set.indices()).lookup(index.reflections['miller_index_asymmetric'])
+    matched_rows = np.flatnonzero(model_rows >= 0)
+    matched_offsets = np.searchsorted(matched_rows, index.offsets)
+    return matched_rows, model_rows[matched_rows], matched_offsets
+
+_pool_params = None
+
+def init_postrefinement_pool(params):
+  global _pool_params
+  _pool_params = params
+
+def postrefine_experiment_in_pool(task):
+  return postrefine_experiment(_pool_params, task)
+
+def postrefine_experiment(params, task):
+  '''Post-refine one experiment (rs or eta_deff algorithm). The task holds the crystal setting matrix A, the wavelength,
+     the mosaicity, and the original miller indices, observed and reference intensities of the observations matched to
+     the model, so it can be sent to a process pool. Returns the rejection reason (None if accepted), the selection of
+     near-full observations, the scale factors of all matched observations, the correlation with the reference after
+     post-refinement, and the log messages.'''
+  log = []
+  result = group_args(reason = None, fat_selection = None, scaler = None, correlation_after_post = None, log = log)
+  MILLER = task.MILLER
+  I_observed = task.I_observed
+  I_reference = task.I_reference
+
+  ORI = crystal_orientation(task.A, basis_type.reciprocal)
+  Astar = matrix.sqr(ORI.reciprocal_matrix())
+  Astar_from_experiment = matrix.sqr(task.A)
+  assert Astar == Astar_from_experiment
+
+  WAVE = task.WAVE
+  BEAM = matrix.col((0.0,0.0,-1./WAVE))
+  BFACTOR = 0.
+
+  # calculation of correlation here
+  I_weight = flex.double(len(I_observed), 1.)
+  I_weight.set_selected(task.I_invalid, 0.)
+
+  """Explanation of 'include_negatives' semantics as originally implemented in cxi.merge postrefinement:
+     include_negatives = True
+     + and - reflections both used for Rh distribution for initial estimate of RS parameter
+     + and - reflections both used for calc/obs correlation slope for initial estimate of G parameter
+     + and - reflections both passed to the refinery and used in the target function (makes sense if
+                         you look at it from a certain point of view)
+
+     include_negatives = False
+     + and - reflections both used for Rh distribution for initial estimate of RS parameter
+     +       reflections only used for calc/obs correlation slope for initial estimate of G parameter
+     + and - reflections both passed to the refinery and used in the target function (makes sense if
+                         you look at it from a certain point of view)
+
+     NOTE: by the new design, "include negatives" is always True
+  """
+
+  SWC = simple_weighted_correlation(I_weight, I_reference, I_observed)
+  log.append("Old correlation is: %f"%SWC.corr)
+
+  if params.postrefinement.algorithm == "rs":
+
+    Xhkl = flex.mat3_double(len(MILLER), Astar) * MILLER.as_vec3_double()
+    Rhall = (Xhkl + BEAM).norms() - (1./WAVE)
+
+    Rs = math.sqrt(flex.mean(Rhall*Rhall))
+
+    RS = 1./10000. # reciprocal effective domain size of 1 micron
+    RS = Rs        # try this empirically determined approximate, monochrome, a-mosaic value
+    current = flex.double([SWC.slope, BFACTOR, RS, 0., 0.])
+
+    parameterization_class = rs_parameterization
+    refinery = rs_refinery(ORI=ORI, MILLER=MILLER, BEAM=BEAM, WAVE=WAVE, ICALCVEC = I_reference, IOBSVEC = I_observed)
+
+  elif params.postrefinement.algorithm == "eta_deff":
+
+    eta_init = 2. * task.MOSAICITY_DEG * math.pi/180.
+    D_eff_init = 2. * task.DOMAIN_SIZE_A
+    current = flex.double([SWC.slope, BFACTOR, eta_init, 0., 0., D_eff_init])
+
+    parameterization_class = eta_deff_parameterization
+    refinery = eta_deff_refinery(ORI=ORI, MILLER=MILLER, BEAM=BEAM, WAVE=WAVE, ICALCVEC = I_reference, IOBSVEC = I_observed)
+
+  func = refinery.fvec_callable(parameterization_class(current))
+  functional = flex.sum(func * func)
+  log.append("functional: %f"%functional)
+
+  try:
     out = StringIO()
-    self.MINI = lbfgs_minimizer_base(self.params,
-                                     current_x = self.current,
-                                     parameterization = self.parameterization_class,
-                                     refinery = self.refinery,
-                                     out = out)
-    if self.params.output.log_level == 0:
-      self.logger.log("\n" + out.getvalue())
-
-  def result_for_cxi_merge(self):
-
-    scaler = self.refinery.scaler_callable(self.parameterization_class(self.MINI.x))
-
-    if self.params.postrefinement.algorithm == "rs":
-      fat_selection = (self.refinery.lorentz_callable(self.parameterization_class(self.MINI.x)) > self.params.postrefinement.partiality_threshold_hcfix)
-      fats = self.refinery.lorentz_callable(self.parameterization_class(self.MINI.x))
+    MINI = lbfgs_minimizer_base(params,
+                                current_x = current,
+                                parameterization = parameterization_class,
+                                refinery = refinery,
+                                out = out)
+    log.append("\n" + out.getvalue())
+
+    values = parameterization_class(MINI.x)
+    scaler = refinery.scaler_callable(values)
+
+    if params.postrefinement.algorithm == "rs":
+      fat_selection = (refinery.lorentz_callable(values) > params.postrefinement.partiality_threshold_hcfix)
     else:
-      fat_selection = (self.refinery.lorentz_callable(self.parameterization_class(self.MINI.x)) < 0.9)
+      fat_selection = (refinery.lorentz_callable(values) < 0.9)
 
     fat_count = fat_selection.count(True)
 
     # reject an experiment with insufficient number of near-full reflections
     if fat_count < 3:
-
-      if self.params.output.log_level == 0:
-        self.logger.log("Rejected experiment, because: On total %5d the fat selection is %5d"%(len(self.observations_pair1_selected.indices()), fat_count))
-
-      '''
-      # debugging
-      rejected_fat_max = 0.0
-      for fat in fats:
-        if fat <= 0.2:
-          if fat > rejected_fat_max:
-            rejected_fat_max = fat
-      self.logger.log("MAXIMUM FAT VALUE AMONG REJECTED REFLECTIONS IS: %f"%rejected_fat_max)
-      '''
-
+      log.append("Rejected experiment, because: On total %5d the fat selection is %5d"%(len(MILLER), fat_count))
       raise ValueError("< 3 near-fulls after refinement")
 
-    if self.params.output.log_level == 0:
-      self.logger.log("On total %5d the fat selection is %5d"%(len(self.observations_pair1_selected.indices()), fat_count))
-
-    observations_original_index = self.observations_original_index_pair1_selected.select(fat_selection)
-
-    observations = self.observations_pair1_selected.customized_copy(indices = self.observations_pair1_selected.indices().select(fat_selection),
-                                                                    data = (self.observations_pair1_selected.data()/scaler).select(fat_selection),
-                                                                    sigmas = (self.observations_pair1_selected.sigmas()/scaler).select(fat_selection))
-
-    matches = miller.match_multi_indices(miller_indices_unique = self.params.scaling.miller_set.indices(),
-                                         miller_indices = observations.indices())
-
-    return observations_original_index, observations, matches
-
-  def get_parameter_values(self):
-    values = self.parameterization_class(self.MINI.x)
-    return values
-
-  def result_for_samosa(self):
-    values = self.parameterization_class(self.MINI.x)
-    return self.refinery.get_eff_Astar(values), values.RS
+    log.append("On total %5d the fat selection is %5d"%(len(MILLER), fat_count))
+
+    # Calculate the correlation of each frame after corrections.
+    # This is used in the MM24 error model to determine a per frame level of error
+    # These are the added to the reflection table
+    I_observed_after_post = (I_observed/scaler).select(fat_selection)
+    I_weight = I_weight.select(fat_selection)
+    SWC_after_post = simple_weighted_correlation(I_weight, I_reference.select(fat_selection), I_observed_after_post)
+  except (AssertionError, ValueError, RuntimeError) as e:
+    reason = repr(e)
+    if not reason:
+      reason = "Unknown error"
+    result.reason = reason
+    return result
+
+  result.fat_selection = fat_selection
+  result.scaler = scaler
+  result.correlation_after_post = SWC_after_post.corr
+  return result
 
 class refinery_base(group_args):
     def __init__(self, **kwargs):
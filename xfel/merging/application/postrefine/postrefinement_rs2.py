@@ -6,6 +6,7 @@ from collections import Counter
 import math
 from libtbx import adopt_init_args
 from dials.array_family import flex
+from xfel.merging.application.reflection_table_utils import experiment_index
 from dxtbx.model.experiment_list import ExperimentList
 from cctbx import miller
 from cctbx.crystal import symmetry
@@ -59,9 +60,12 @@ class postrefinement_rs2(postrefinement_rs):
 
     experiments_rejected_by_reason = Counter()  # reason:how_many_rejected
 
+    # index the reflections by experiment once instead of selecting on the id column for every experiment
+    index = experiment_index(reflections, n_experiments=len(experiments))
+
     for expt_id, experiment in enumerate(experiments):
 
-      exp_reflections = reflections.select(reflections['id'] == expt_id)
+      exp_reflections = index[expt_id]
 
       # Build a miller array with _original_ miller indices of the experiment reflections
       exp_miller_indices_original = miller.set(target_symm, exp_reflections['miller_index'], not self.params.merging.merge_anomalous)
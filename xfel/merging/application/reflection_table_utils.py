@@ -50,8 +50,124 @@ class reflection_table_utils(object):
     return table
 
   @staticmethod
-  def merge_reflections(reflections, min_multiplicity, nameprefix=None, thresh=None):
-    '''Merge intensities of multiply-measured symmetry-reduced HKLs. The input reflection table must be sorted by symmetry-reduced HKLs.'''
+  def miller_index_as_numpy(miller_indices):
+    '''Convert a flex.miller_index column to an (N,3) int64 numpy array'''
+    if len(miller_indices) == 0:
+      return np.empty((0,3), dtype=np.int64)
+    return miller_indices.as_vec3_double().as_double().as_numpy_array().reshape(-1,3).astype(np.int64)
+
+  @staticmethod
+  def miller_index_keys(miller_indices):
+    '''Encode a flex.miller_index column as one int64 per index, e.g. for sorting and searching'''
+    hkl = reflection_table_utils.miller_index_as_numpy(miller_indices) + (1 << 20)
+    return (hkl[:,0] << 42) | (hkl[:,1] << 21) | hkl[:,2]
+
+  @staticmethod
+  def get_hkl_group_offsets(reflections):
+    '''Compute the boundaries of runs of identical asu HKLs in an asu hkl-sorted reflection table.
+       Returns an array of group start offsets with the table size appended, i.e. group i spans rows offsets[i]:offsets[i+1].
+       Groups are identical to the slices yielded by get_next_hkl_reflection_table.'''
+    hkl = reflection_table_utils.miller_index_as_numpy(reflections['miller_index_asymmetric'])
+    n = len(hkl)
+    if n == 0:
+      return np.zeros(1, dtype=np.int64)
+    changes = np.flatnonzero(np.any(hkl[1:] != hkl[:-1], axis=1)) + 1
+    return np.concatenate(([0], changes, [n])).astype(np.int64)
+
+  @staticmethod
+  def _grouped_median(values, group_ids, offsets):
+    '''Median of values within each group. group_ids must be non-decreasing, offsets are the group boundaries.
+       Empty groups get a median of nan.'''
+    order = np.lexsort((values, group_ids))
+    sorted_values = values[order]
+    counts = np.diff(offsets)
+    medians = np.full(len(counts), np.nan)
+    nonempty = counts > 0
+    lo = offsets[:-1][nonempty] + (counts[nonempty] - 1) // 2
+    hi = offsets[:-1][nonempty] + counts[nonempty] // 2
+    medians[nonempty] = 0.5 * (sorted_values[lo] + sorted_values[hi])
+    return medians
+
+  @staticmethod
+  def _merge_hkl_groups(hkl_group_ids, n_groups, intensities, variances, min_multiplicity, thresh=None):
+    '''Grouped reduction behind merge_reflections. Inputs are numpy arrays of the observations to be merged (already
+       restricted to positive variances); hkl_group_ids is non-decreasing. Returns the indices of the merged groups and
+       their intensities, sigmas and multiplicities.'''
+    multiplicity = np.bincount(hkl_group_ids, minlength=n_groups)
+    merged = np.flatnonzero(multiplicity >= min_multiplicity)
+    if thresh is None:
+      weights = 1.0 / variances
+      sum_weights = np.bincount(hkl_group_ids, weights=weights, minlength=n_groups)[merged]
+      sum_weighted_intensities = np.bincount(hkl_group_ids, weights=intensities * weights, minlength=n_groups)[merged]
+      intensity = sum_weighted_intensities / sum_weights
+      sigma = 1.0 / np.sqrt(sum_weights)
+    else:
+      # Median absolute deviation outlier rejection, equivalent to simtbx.diffBragg.utils.is_outlier per HKL
+      offsets = np.concatenate(([0], np.cumsum(multiplicity)))
+      medians = reflection_table_utils._grouped_median(intensities, hkl_group_ids, offsets)
+      deviations = np.abs(intensities - medians[hkl_group_ids])
+      mads = reflection_table_utils._grouped_median(deviations, hkl_group_ids, offsets)
+      with np.errstate(divide='ignore', invalid='ignore'):
+        modified_z_score = 0.6745 * deviations / mads[hkl_group_ids]
+      good = ~(modified_z_score > thresh)
+      good_ids = hkl_group_ids[good]
+      num_good = np.bincount(good_ids, minlength=n_groups)[merged]
+      with np.errstate(divide='ignore', invalid='ignore'):
+        intensity = np.bincount(good_ids, weights=intensities[good], minlength=n_groups)[merged] / num_good
+        sigma = np.sqrt(np.bincount(good_ids, weights=variances[good], minlength=n_groups)[merged]) / num_good
+    return merged, intensity, sigma, multiplicity[merged]
+
+  @staticmethod
+  def merge_reflections(reflections, min_multiplicity, nameprefix=None, thresh=None, selections=None):
+    '''Merge intensities of multiply-measured symmetry-reduced HKLs. The input reflection table must be sorted by symmetry-reduced HKLs.
+       The asu HKL group boundaries are computed once and all groups are reduced in a single vectorized pass.
+       If selections (a list of flex.bool over the reflections) is provided, merge each selected subset using the same
+       group boundaries and return a list of merged tables, one per selection.'''
+    if selections is None:
+      return reflection_table_utils.merge_reflections(reflections, min_multiplicity, nameprefix=nameprefix,
+                                                      thresh=thresh, selections=[None])[0]
+
+    if reflections.size() == 0:
+      return [reflection_table_utils.merged_reflection_table() for selection in selections]
+
+    offsets = reflection_table_utils.get_hkl_group_offsets(reflections)
+    n_groups = len(offsets) - 1
+    group_ids = np.repeat(np.arange(n_groups), np.diff(offsets))
+    intensities = reflections['intensity.sum.value'].as_numpy_array()
+    variances = reflections['intensity.sum.variance'].as_numpy_array()
+    first_rows = flex.size_t(offsets[:-1].astype(np.uint64))
+    hkls = reflections['miller_index_asymmetric'].select(first_rows)
+
+    all_merged_reflections = []
+    for selection in selections:
+      keep = variances > 0.0
+      if selection is not None:
+        keep &= selection.as_numpy_array()
+      merged, intensity, sigma, multiplicity = reflection_table_utils._merge_hkl_groups(
+          group_ids[keep], n_groups, intensities[keep], variances[keep], min_multiplicity, thresh=thresh)
+      merged_reflections = reflection_table_utils.merged_reflection_table()
+      if len(merged) > 0:
+        merged_reflections = flex.reflection_table()
+        merged_reflections['miller_index'] = hkls.select(flex.size_t(merged.astype(np.uint64)))
+        merged_reflections['intensity'] = flex.double(intensity)
+        merged_reflections['sigma'] = flex.double(sigma)
+        merged_reflections['multiplicity'] = flex.int(multiplicity.astype(np.int32))
+      all_merged_reflections.append(merged_reflections)
+    return all_merged_reflections
+
+  @staticmethod
+  def merge_odd_even_all_reflections(reflections, min_multiplicity, col='id', thresh=None):
+    '''Merge reflections from experiments with odd ids, even ids and all experiments, sharing one pass over the asu HKL groups.
+       Like select_odd_experiment_reflections, store the is_odd_experiment flag in the reflection table.'''
+    odd = reflections[col] % 2 == 1
+    even = reflections[col] % 2 == 0
+    reflections["is_odd_experiment"] = odd
+    return reflection_table_utils.merge_reflections(reflections, min_multiplicity, thresh=thresh,
+                                                    selections=[odd, even, None])
+
+  @staticmethod
+  def merge_reflections_per_hkl(reflections, min_multiplicity, nameprefix=None, thresh=None):
+    '''Reference implementation of merge_reflections looping over asu HKL slices in Python. Kept for benchmarking and validation.'''
     merged_reflections = reflection_table_utils.merged_reflection_table()
     for i_refls,refls in enumerate(reflection_table_utils.get_next_hkl_reflection_table(reflections=reflections)):
       if refls.size() == 0:
@@ -139,3 +255,116 @@ class reflection_table_utils(object):
       empty_slices = max(0, n_slices - generated_slices)
       for i in range(empty_slices):
         yield reflection_table_stub(reflections)
+
+class hkl_lookup(object):
+  '''Map Miller indices to their positions in a list of unique Miller indices, e.g. the indices of a model miller
+     array, with a binary search over the sorted index keys instead of miller.match_multi_indices per experiment'''
+
+  def __init__(self, unique_miller_indices):
+    keys = reflection_table_utils.miller_index_keys(unique_miller_indices)
+    self.order = np.argsort(keys, kind='stable')
+    self.sorted_keys = keys[self.order]
+
+  def __len__(self):
+    return len(self.sorted_keys)
+
+  def lookup(self, miller_indices):
+    '''Position of each Miller index in the unique list, or -1 if it is not there'''
+    keys = reflection_table_utils.miller_index_keys(miller_indices)
+    result = np.full(len(keys), -1, dtype=np.int64)
+    if len(self.sorted_keys) == 0:
+      return result
+    pos = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+    found = self.sorted_keys[pos] == keys
+    result[found] = self.order[pos[found]]
+    return result
+
+class hkl_bin_lookup(hkl_lookup):
+  '''Resolution bin numbers of asu Miller indices (params.statistics.hkl_resolution_bins). Bins are looked up for a
+     whole flex.miller_index column with one binary search over the packed hkl keys, and the lookup pickles as a few
+     numpy arrays instead of a dict keyed by hkl tuples.'''
+
+  def __init__(self, unique_miller_indices, bin_numbers):
+    super(hkl_bin_lookup, self).__init__(unique_miller_indices)
+    assert not np.any(self.sorted_keys[1:] == self.sorted_keys[:-1]) # each hkl should be assigned a bin number only once
+    self.bin_numbers = np.asarray(bin_numbers, dtype=np.int32)
+    assert len(self.bin_numbers) == len(self.sorted_keys)
+
+  def bins(self, miller_indices):
+    '''Resolution bin number of each Miller index, or -1 if it has none'''
+    pos = self.lookup(miller_indices)
+    result = np.full(len(pos), -1, dtype=np.int32)
+    found = pos >= 0
+    result[found] = self.bin_numbers[pos[found]]
+    return result
+
+  def group_bins(self, reflections, offsets=None):
+    '''Resolution bin number of each asu hkl group of an asu hkl-sorted reflection table, or -1 if it has none.
+       Returns the group offsets (see reflection_table_utils.get_hkl_group_offsets) and the bin numbers.'''
+    if offsets is None:
+      offsets = reflection_table_utils.get_hkl_group_offsets(reflections)
+    if len(offsets) < 2:
+      return offsets, np.zeros(0, dtype=np.int32)
+    first_hkls = reflections['miller_index_asymmetric'].select(flex.size_t(offsets[:-1].astype(np.uint64)))
+    return offsets, self.bins(first_hkls)
+
+class experiment_index(object):
+  '''Group the reflections of a table by experiment id once (stable sort by id, store offsets), so that the reflections
+     of any experiment can be retrieved as a contiguous slice instead of reflections.select(reflections['id'] == expt_id).
+     Within each experiment the original reflection order is preserved.'''
+
+  def __init__(self, reflections, n_experiments=None, col='id'):
+    ids = reflections[col].as_numpy_array() if reflections.size() > 0 else np.empty(0, dtype=np.int32)
+    if n_experiments is None:
+      n_experiments = int(ids.max()) + 1 if len(ids) > 0 else 0
+    order = np.argsort(ids, kind='stable')
+    self.offsets = np.searchsorted(ids[order], np.arange(n_experiments + 1), side='left').astype(np.int64)
+    self.counts = np.diff(self.offsets)
+    self.col = col
+    self.reflections = reflections.select(flex.size_t(order[self.offsets[0]:self.offsets[-1]].astype(np.uint64)))
+    self.offsets -= self.offsets[0] # reflections with negative or out-of-range ids are not indexed
+
+  def __len__(self):
+    return len(self.counts)
+
+  def __getitem__(self, expt_id):
+    '''Reflections of a single experiment'''
+    return self.reflections[int(self.offsets[expt_id]):int(self.offsets[expt_id+1])]
+
+  def __iter__(self):
+    '''Generate (experiment id, experiment reflections) pairs in experiment order'''
+    for expt_id in range(len(self)):
+      yield expt_id, self[expt_id]
+
+  def rows(self, expt_id):
+    '''Row range of an experiment in the id-sorted table self.reflections'''
+    return int(self.offsets[expt_id]), int(self.offsets[expt_id+1])
+
+  def expand(self, per_experiment_values):
+    '''Broadcast one value per experiment to one value per row of the id-sorted table'''
+    return np.repeat(np.asarray(per_experiment_values), self.counts)
+
+  def select_experiments(self, keep, rows=None):
+    '''Return the reflections of the experiments flagged in keep (one bool per experiment) in a single selection.
+       If rows is given, only those rows of the id-sorted table self.reflections are returned, in the given order; they
+       must be grouped by experiment in ascending experiment order and belong to kept experiments.
+       Experiment ids are renumbered 0..n_kept-1 in experiment order and experiment identifiers are remapped accordingly,
+       i.e. the result is equivalent to extending a new table with each kept experiment and calling reset_ids().'''
+    keep = np.asarray(keep, dtype=bool)
+    assert len(keep) == len(self)
+    new_ids = np.cumsum(keep) - 1
+    if rows is None:
+      rows = np.flatnonzero(self.expand(keep))
+    rows = np.asarray(rows, dtype=np.int64)
+    selected = self.reflections.select(flex.size_t(rows.astype(np.uint64)))
+    old_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+    assert keep[old_ids].all()
+    selected[self.col] = flex.int(new_ids[old_ids].astype(np.int32))
+
+    identifiers = dict(self.reflections.experiment_identifiers())
+    for old_id in list(selected.experiment_identifiers().keys()):
+      del selected.experiment_identifiers()[old_id]
+    for old_id in np.flatnonzero(keep):
+      if int(old_id) in identifiers:
+        selected.experiment_identifiers()[int(new_ids[old_id])] = identifiers[int(old_id)]
+    return selected
@@ -0,0 +1,93 @@
+from __future__ import absolute_import, division, print_function
+import sys, time
+import numpy as np
+from dials.array_family import flex
+from cctbx import miller, sgtbx, uctbx
+from cctbx.crystal import symmetry
+from xfel.merging.application.reflection_table_utils import experiment_index
+from xfel.merging.application.scale.experiment_scaler import experiment_scaler, scaling_result
+
+"""
+Regression check and benchmark for the batched mark0 scaling fit: fit the same synthetic experiments with
+experiment_scaler.fit_experiments_to_reference_batched and, one experiment at a time, with fit_experiment_to_reference,
+for every scaling.weights choice, and compare the accept/reject flags, the correlations and the scale factors.
+Usage: libtbx.python benchmark_batched_scaling.py [n_experiments] [reflections_per_experiment]
+"""
+
+def synthetic_data(params, n_experiments, n_per_experiment, seed=0):
+  '''A model miller array and a reflection table of experiments with random scales and noise. Some experiments have
+     too few reflections matching the model, and some are uncorrelated with it.'''
+  rng = np.random.default_rng(seed)
+  target_symm = symmetry(unit_cell=params.scaling.unit_cell, space_group_info=params.scaling.space_group)
+  model_set = target_symm.build_miller_set(anomalous_flag=True, d_min=2.0)
+  model_data = rng.gamma(1., 1000., model_set.size())
+  model = miller.array(model_set, flex.double(model_data))
+
+  ids, rows, values = [], [], []
+  for expt_id in range(n_experiments):
+    n = 2 if expt_id % 50 == 0 else n_per_experiment
+    expt_rows = rng.choice(model_set.size(), size=n, replace=False)
+    if expt_id % 20 == 1:
+      expt_values = rng.gamma(1., 1000., n)  # uncorrelated with the model
+    else:
+      expt_values = model_data[expt_rows] * rng.uniform(0.2, 5.) + rng.normal(0, 200., n)
+    ids.append(np.full(n, expt_id, dtype=np.int32))
+    rows.append(expt_rows)
+    values.append(expt_values)
+  ids, rows, values = np.concatenate(ids), np.concatenate(rows), np.concatenate(values)
+  order = rng.permutation(len(ids)) # reflections of all experiments interleaved, as read from several files
+
+  reflections = flex.reflection_table()
+  reflections['id'] = flex.int(ids[order])
+  reflections['miller_index_asymmetric'] = model_set.indices().select(flex.size_t(rows[order].astype(np.uint64)))
+  reflections['intensity.sum.value'] = flex.double(values[order])
+  reflections['intensity.sum.variance'] = flex.double(np.abs(values[order]) + 100.)
+  return target_symm, model, reflections
+
+def fit_one_at_a_time(scaler, index, target_symm, weights):
+  '''The per-experiment path of experiment_scaler.run'''
+  model_intensities = scaler.params.scaling.i_model
+  results = []
+  for expt_id, exp_reflections in index:
+    exp_miller_indices = miller.set(target_symm, exp_reflections['miller_index_asymmetric'], True)
+    exp_intensities = miller.array(exp_miller_indices, exp_reflections['intensity.sum.value'], flex.sqrt(exp_reflections['intensity.sum.variance']))
+    matching_indices = miller.match_multi_indices(miller_indices_unique = model_intensities.indices(), miller_indices = exp_intensities.indices())
+    results.append(scaler.fit_experiment_to_reference(model_intensities, exp_intensities, matching_indices, weights))
+  return results
+
+def run(args, rtol=1e-6):
+  n_experiments = int(args[0]) if len(args) > 0 else 2000
+  n_per_experiment = int(args[1]) if len(args) > 1 else 300
+
+  from xfel.merging.application.phil.phil import phil_scope
+  params = phil_scope.extract()
+  params.scaling.unit_cell = uctbx.unit_cell((79.1, 79.1, 38.4, 90, 90, 90))
+  params.scaling.space_group = sgtbx.space_group_info('P 43 21 2')
+  target_symm, params.scaling.i_model, reflections = synthetic_data(params, n_experiments, n_per_experiment)
+  index = experiment_index(reflections, n_experiments=n_experiments)
+  scaler = experiment_scaler(params)
+  print("Synthetic data: %d experiments, %d reflections"%(n_experiments, len(reflections)))
+
+  for weights in ['unit', 'icalc', 'icalc_sigma']:
+    t0 = time.time()
+    reference = fit_one_at_a_time(scaler, index, target_symm, weights)
+    t1 = time.time()
+    batched, d_min = scaler.fit_experiments_to_reference_batched(index, target_symm, weights)
+    t2 = time.time()
+    n_accepted = 0
+    for expt_id, (expected, result) in enumerate(zip(reference, batched)):
+      assert expected.error == result.error, (weights, expt_id, expected.error, result.error)
+      assert expected.data_count == result.data_count, (weights, expt_id)
+      if result.error is None:
+        n_accepted += 1
+        assert np.isclose(expected.correlation, result.correlation, rtol=rtol), (weights, expt_id, expected.correlation, result.correlation)
+        assert np.isclose(expected.slope, result.slope, rtol=rtol), (weights, expt_id, expected.slope, result.slope)
+    n_low_signal = sum(result.error == scaling_result.err_low_signal for result in batched)
+    print("weights=%s: %d accepted, %d low signal, %d low correlation"%(
+      weights, n_accepted, n_low_signal, n_experiments - n_accepted - n_low_signal))
+    print("  one at a time: %.3f s"%(t1 - t0))
+    print("  batched:       %.3f s"%(t2 - t1))
+  print("OK")
+
+if __name__ == '__main__':
+  run(sys.argv[1:])
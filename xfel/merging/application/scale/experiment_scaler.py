@@ -1,5 +1,6 @@
 from __future__ import absolute_import, division, print_function
 from xfel.merging.application.worker import worker
+from xfel.merging.application.reflection_table_utils import experiment_index, hkl_lookup
 from dials.array_family import flex
 from dxtbx.model.experiment_list import ExperimentList
 from cctbx import miller
@@ -40,7 +41,12 @@ class experiment_scaler(worker):
       return experiments, reflections
 
     new_experiments = ExperimentList()
-    new_reflections = flex.reflection_table()
+
+    # index the reflections by experiment once; per-experiment scale factors and correlations are applied in bulk afterwards
+    index = experiment_index(reflections, n_experiments=len(experiments))
+    scaled_experiments = np.zeros(len(experiments), dtype=bool)
+    experiment_slopes = np.ones(len(experiments))
+    experiment_correlations = np.zeros(len(experiments))
 
     # scale experiments, one at a time. Reject experiments that do not correlate with the reference or fail to scale.
     results = []
@@ -51,21 +57,26 @@ class experiment_scaler(worker):
     experiments_rejected_because_of_low_correlation_with_reference = 0
 
     target_symm = symmetry(unit_cell = self.params.scaling.unit_cell, space_group_info = self.params.scaling.space_group)
+    if self.params.scaling.batched:
+      batched_results, batched_d_min = self.fit_experiments_to_reference_batched(index, target_symm, self.params.scaling.weights)
     for expt_id, experiment in enumerate(experiments):
-      exp_reflections = reflections.select(reflections['id'] == expt_id)
+      if self.params.scaling.batched:
+        result = batched_results[expt_id]
+      else:
+        exp_reflections = index[expt_id]
 
-      # Build a miller array for the experiment reflections
-      exp_miller_indices = miller.set(target_symm, exp_reflections['miller_index_asymmetric'], True)
-      exp_intensities = miller.array(exp_miller_indices, exp_reflections['intensity.sum.value'], flex.sqrt(exp_reflections['intensity.sum.variance']))
+        # Build a miller array for the experiment reflections
+        exp_miller_indices = miller.set(target_symm, exp_reflections['miller_index_asymmetric'], True)
+        exp_intensities = miller.array(exp_miller_indices, exp_reflections['intensity.sum.value'], flex.sqrt(exp_reflections['intensity.sum.variance']))
 
-      model_intensities = self.params.scaling.i_model
+        model_intensities = self.params.scaling.i_model
 
-      # Extract an array of HKLs from the model to match the experiment HKLs
-      matching_indices = miller.match_multi_indices(miller_indices_unique = model_intensities.indices(), miller_indices = exp_intensities.indices())
+        # Extract an array of HKLs from the model to match the experiment HKLs
+        matching_indices = miller.match_multi_indices(miller_indices_unique = model_intensities.indices(), miller_indices = exp_intensities.indices())
 
-      # Least squares
-      weights = self.params.scaling.weights
-      result = self.fit_experiment_to_reference(model_intensities, exp_intensities, matching_indices, weights)
+        # Least squares
+        weights = self.params.scaling.weights
+        result = self.fit_experiment_to_reference(model_intensities, exp_intensities, matching_indices, weights)
 
       if result.error == scaling_result.err_low_signal:
         experiments_rejected_because_of_low_signal += 1
@@ -81,21 +92,26 @@ class experiment_scaler(worker):
         self.logger.log("Experiment ID: %s; Slope: %f; Correlation %f"%(experiment.identifier, result.slope, result.correlation))
 
       # count high resolution experiments
-      if exp_intensities.d_min() <= self.params.merging.d_min:
+      exp_d_min = batched_d_min[expt_id] if self.params.scaling.batched else exp_intensities.d_min()
+      if exp_d_min <= self.params.merging.d_min:
         high_res_experiments += 1
 
-      # apply scale factors
+      scaled_experiments[expt_id] = True
+      experiment_slopes[expt_id] = result.slope
+      experiment_correlations[expt_id] = result.correlation
+      new_experiments.append(experiment)
+
+    # apply scale factors
+    indexed_reflections = index.reflections
+    if scaled_experiments.any():
       if (
           not self.params.postrefinement.enable or
           'postrefine' not in self.params.dispatch.step_list
       ):
-        exp_reflections['intensity.sum.value'] *= result.slope
-        exp_reflections['intensity.sum.variance'] *= (result.slope**2)
-      exp_reflections['correlation'] = flex.double(len(exp_reflections), result.correlation)
-      new_experiments.append(experiment)
-      new_reflections.extend(exp_reflections)
-
-    new_reflections.reset_ids()
+        indexed_reflections['intensity.sum.value'] *= flex.double(index.expand(experiment_slopes))
+        indexed_reflections['intensity.sum.variance'] *= flex.double(index.expand(experiment_slopes**2))
+      indexed_reflections['correlation'] = flex.double(index.expand(experiment_correlations))
+    new_reflections = index.select_experiments(scaled_experiments)
     rejected_experiments = len(experiments) - len(new_experiments)
     assert rejected_experiments == experiments_rejected_because_of_low_signal + \
                                     experiments_rejected_because_of_low_correlation_with_reference
@@ -110,17 +126,23 @@ class experiment_scaler(worker):
       self.logger.log("Note: scale factors were not applied, because postrefinement is enabled")
 
     # MPI-reduce all counts
-    comm = self.mpi_helper.comm
-    MPI = self.mpi_helper.MPI
-    total_experiments_rejected_because_of_low_signal                            = comm.reduce(experiments_rejected_because_of_low_signal, MPI.SUM, 0)
-    total_experiments_rejected_because_of_low_correlation_with_reference        = comm.reduce(experiments_rejected_because_of_low_correlation_with_reference, MPI.SUM, 0)
-    total_reflections_removed_because_of_rejected_experiments                   = comm.reduce(reflections_removed_because_of_rejected_experiments, MPI.SUM, 0)
-    total_high_res_experiments                                                  = comm.reduce(high_res_experiments, MPI.SUM, 0)
-    all_slopes                                                                  = comm.reduce(slopes, MPI.SUM, 0)
-    all_correlations                                                            = comm.reduce(correlations, MPI.SUM, 0)
+    reduction = self.mpi_helper.reduction()
+    reduction.add_sum('rejected_low_signal', experiments_rejected_because_of_low_signal)
+    reduction.add_sum('rejected_low_correlation', experiments_rejected_because_of_low_correlation_with_reference)
+    reduction.add_sum('reflections_removed', reflections_removed_because_of_rejected_experiments)
+    reduction.add_sum('high_res_experiments', high_res_experiments)
+    reduction.add_array('slopes', np.array(slopes, dtype=float))
+    reduction.add_array('correlations', np.array(correlations, dtype=float))
+    totals = reduction.flush()
 
     # rank 0: log data statistics
     if self.mpi_helper.rank == 0:
+      total_experiments_rejected_because_of_low_signal                          = totals['rejected_low_signal']
+      total_experiments_rejected_because_of_low_correlation_with_reference      = totals['rejected_low_correlation']
+      total_reflections_removed_because_of_rejected_experiments                 = totals['reflections_removed']
+      total_high_res_experiments                                                = totals['high_res_experiments']
+      all_slopes                                                                = totals['slopes']
+      all_correlations                                                          = totals['correlations']
       self.logger.main_log('Experiments rejected because of low signal: %d'%total_experiments_rejected_because_of_low_signal)
       self.logger.main_log('Experiments rejected because of low correlation with reference: %d'%total_experiments_rejected_because_of_low_correlation_with_reference)
       self.logger.main_log('Reflections rejected because of rejected experiments: %d'%total_reflections_removed_because_of_rejected_experiments)
@@ -194,6 +216,68 @@ class experiment_scaler(worker):
     result.slope = slope
     return result
 
+  def fit_experiments_to_reference_batched(self, index, target_symm, weights='unit'):
+    '''Closed-form equivalent of fit_experiment_to_reference for all experiments in an experiment_index at once.
+       All reflections are matched to the model HKLs in one lookup; the Pearson correlations and the slopes of the
+       proportional fit I_r = slope * I_o are computed with grouped sums. Returns a list of scaling_result, one per
+       experiment, and the d_min of each experiment's reflections.'''
+    model_intensities = self.params.scaling.i_model
+    reflections = index.reflections
+    n_expts = len(index)
+    reflection_expt_ids = index.expand(np.arange(n_expts))
+
+    # match all reflections to the model at once
+    model_rows = hkl_lookup(model_intensities.indices()).lookup(reflections['miller_index_asymmetric'])
+    matched = model_rows >= 0
+    ids = reflection_expt_ids[matched]
+    x = reflections['intensity.sum.value'].as_numpy_array()[matched]
+    y = model_intensities.data().as_numpy_array()[model_rows[matched]]
+    exp_sigmas = np.sqrt(reflections['intensity.sum.variance'].as_numpy_array()[matched])
+
+    def group_sum(values):
+      return np.bincount(ids, weights=values, minlength=n_expts)
+    data_count = np.bincount(ids, minlength=n_expts)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      # Pearson correlation from centered sums
+      dx = x - (group_sum(x) / data_count)[ids]
+      dy = y - (group_sum(y) / data_count)[ids]
+      correlation = group_sum(dx * dy) / np.sqrt(group_sum(dx * dx) * group_sum(dy * dy))
+
+      # weighted least squares for y = slope * x: slope = sum(w*x*y) / sum(w*x*x), w = 1/sigma**2
+      slope_unwt = group_sum(x * y) / group_sum(x * x)
+      if weights == 'unit':
+        slope = slope_unwt
+      else:
+        model_scaled = y / slope_unwt[ids]
+        if weights == 'icalc_sigma':
+          w = 1 / (model_scaled**2 + exp_sigmas**2)
+        elif weights == 'icalc':
+          w = 1 / model_scaled
+        slope = group_sum(w * x * y) / group_sum(w * x * x)
+
+    results = []
+    for expt_id in range(n_expts):
+      result = scaling_result()
+      result.data_count = int(data_count[expt_id])
+      if result.data_count < 3:
+        result.error = scaling_result.err_low_signal
+      elif correlation[expt_id] < self.params.filter.outlier.min_corr:
+        result.error = scaling_result.err_low_correlation
+      else:
+        result.correlation = float(correlation[expt_id])
+        result.slope = float(slope[expt_id])
+      results.append(result)
+
+    # resolution limit of each experiment
+    d_min = np.full(n_expts, np.inf)
+    nonempty = index.counts > 0
+    if nonempty.any():
+      d_spacings = target_symm.unit_cell().d(reflections['miller_index_asymmetric']).as_numpy_array()
+      d_min[nonempty] = np.minimum.reduceat(d_spacings, index.offsets[:-1][nonempty])
+
+    return results, d_min
+
 if __name__ == '__main__':
   from xfel.merging.application.worker import exercise_worker
   exercise_worker(experiment_scaler)
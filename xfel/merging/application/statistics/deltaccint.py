@@ -7,6 +7,7 @@ import numpy as np
 from scitbx.math import five_number_summary
 from xfel.merging.application.reflection_table_utils import reflection_table_utils
 from xfel.merging.application.worker import worker
+from xfel.merging.application.utils.memory_usage import get_memory_usage, get_peak_memory_usage, reset_peak_memory_usage
 
 
 class deltaccint(worker):
@@ -23,8 +24,83 @@ class deltaccint(worker):
 
     assert experiments == None, "Must be run after the group worker"
     # need at least 3 reflections to keep multiplicty > 2 when removing an image
-    filtered = flex.reflection_table()
     min_mult = max(3, self.params.merging.minimum_multiplicity)
+
+    self.logger.log("Memory usage before ΔCC½: %d MB"%get_memory_usage())
+    peak_reset = reset_peak_memory_usage()
+    if self.params.statistics.deltaccint.method == 'sparse':
+      all_expt_ids, n_filtered, total_i_n, total_semsq_sums, total_diff_sq_sum = self.compute_sums_sparse(reflections, min_mult)
+    else:
+      all_expt_ids, n_filtered, total_i_n, total_semsq_sums, total_diff_sq_sum = self.compute_sums_dense(reflections, min_mult)
+    if peak_reset:
+      self.logger.log("Peak memory usage during ΔCC½: %d MB"%get_peak_memory_usage())
+    else:
+      self.logger.log("Peak memory usage of the process after ΔCC½: %d MB"%get_memory_usage())
+
+    # Report
+    if self.mpi_helper.rank == 0:
+      sigma_sq_y = total_diff_sq_sum / (total_i_n-1) # variance of the average intensities
+      sigma_sq_e = 2 * total_semsq_sums / total_i_n    # average semsq of the intensities
+      deltaccint_st = (sigma_sq_y - (0.5 * sigma_sq_e)) / (sigma_sq_y + (0.5 * sigma_sq_e))
+
+      data = flex.double(deltaccint_st) * 100
+      sorted_data = data.select(flex.sort_permutation(data))
+
+      mini, q1, med, q3, maxi = five_number_summary(data)
+      self.logger.main_log("Five number summary")
+      self.logger.main_log("% 8.4f%% min"%mini)
+      self.logger.main_log("% 8.4f%% q1"%q1)
+      self.logger.main_log("% 8.4f%% median"%med)
+      self.logger.main_log("% 8.4f%% q3"%q3)
+      self.logger.main_log("% 8.4f%% max"%maxi)
+      self.logger.main_log("")
+
+      if self.params.statistics.deltaccint.verbose:
+        self.logger.main_log("Showing ΔCC½ for all lattices")
+        for e, identifier in enumerate(all_expt_ids):
+          self.logger.main_log("%s %f"%(identifier, data[e]))
+
+      n_worst = min(len(data), 30)
+      worst = sorted_data[-n_worst:]
+      iqr = q3-q1
+
+      self.logger.main_log("Showing ΔCC½ of the worst %d lattices and IQR ratio needed to remove them"%n_worst)
+      self.logger.main_log(" ΔCC½ (%) IQR ratio Lattices removed")
+      for i in range(len(worst)):
+        self.logger.main_log("% 8.4f % 10.1f %d"%(worst[i], (worst[i]-med)/iqr, n_worst-i))
+      self.logger.main_log("")
+
+      if self.params.statistics.deltaccint.iqr_ratio:
+        cut = q3 + iqr * self.params.statistics.deltaccint.iqr_ratio
+        sel = data > cut
+        worst_expts_ = flex.std_string(all_expt_ids).select(sel)
+
+        self.logger.main_log("Removing %d experiments out of %d using IQR ratio %.1f"%(len(worst_expts_), len(all_expt_ids), self.params.statistics.deltaccint.iqr_ratio))
+
+    # Broadcast the worst experiments to cut
+    else:
+      worst_expts_ = None
+
+    if self.params.statistics.deltaccint.iqr_ratio:
+      worst_expts = comm.bcast(worst_expts_, 0)
+      self.logger.log("Starting number of reflections: %d"%len(reflections))
+      self.logger.log("Reflections after filtering by minimum multiplicity of %d: %d"%(min_mult, n_filtered))
+      reflections.remove_on_experiment_identifiers(worst_expts)
+      reflections.reset_ids()
+      self.logger.log("Reflections after filtering by ΔCC½: %d"%len(reflections))
+
+    self.logger.log_step_time("STATISTICS_DELTA_CCINT", True)
+
+    return experiments, reflections
+
+  def compute_sums_dense(self, reflections, min_mult):
+    '''Leave-one-experiment-out sums with dense (all experiments x local HKLs) arrays. Returns the experiment
+       identifiers of all ranks, the number of local reflections passing the multiplicity filter, and the number of
+       HKLs, sum of semsq and sum of squared deviations from the average intensity with each experiment left out.'''
+    comm = self.mpi_helper.comm
+    MPI = self.mpi_helper.MPI
+
+    filtered = flex.reflection_table()
     for refls in reflection_table_utils.get_next_hkl_reflection_table(reflections=reflections):
       if len(set(refls['id'])) >= min_mult:
         filtered.extend(refls)
@@ -34,11 +110,7 @@ class deltaccint(worker):
     all_expt_ids = sorted(set(itertools.chain.from_iterable(comm.allgather(expt_map.values()))))
     all_expts_map = {v: k for k, v in enumerate(all_expt_ids)}
 
-    if self.mpi_helper.rank == 0:
-      self.logger.main_log("Beginning ΔCC½ analysis (σ-τ method from Assmann 2016)")
-      self.logger.main_log("Removing reflections with less than %d measurements"%min_mult)
-      self.logger.main_log("N experiments after filtering: %d"%len(all_expt_ids))
-      self.logger.main_log("")
+    self.log_start(min_mult, len(all_expt_ids))
 
     # We need to compute
     # 1) variance of the average intensities -> compute averages of all intensities and then compute variance per bin
@@ -46,7 +118,9 @@ class deltaccint(worker):
     # In reality for 2), we compute the average of the standard error of the mean squared instead of the variance (semsq)
 
     hkl_resolution_bins = self.params.statistics.hkl_resolution_bins
-    hkl_set = [hkl for hkl in set(filtered['miller_index_asymmetric']) if hkl in hkl_resolution_bins]
+    unique_hkls = list(set(filtered['miller_index_asymmetric']))
+    has_bin = hkl_resolution_bins.bins(flex.miller_index(unique_hkls)) >= 0
+    hkl_set = [hkl for hkl, binned in zip(unique_hkls, has_bin) if binned]
     n_hkl = len(hkl_set)
     hkl_map = {v: k for k, v in enumerate(hkl_set)}
 
@@ -123,61 +197,86 @@ class deltaccint(worker):
 
     total_diff_sq_sum = comm.reduce(diff_sq_sum, MPI.SUM, 0)
 
-    # Report
-    if self.mpi_helper.rank == 0:
-      sigma_sq_y = total_diff_sq_sum / (total_i_n-1) # variance of the average intensities
-      sigma_sq_e = 2 * total_semsq_sums / total_i_n    # average semsq of the intensities
-      deltaccint_st = (sigma_sq_y - (0.5 * sigma_sq_e)) / (sigma_sq_y + (0.5 * sigma_sq_e))
-
-      data = flex.double(deltaccint_st) * 100
-      sorted_data = data.select(flex.sort_permutation(data))
-
-      mini, q1, med, q3, maxi = five_number_summary(data)
-      self.logger.main_log("Five number summary")
-      self.logger.main_log("% 8.4f%% min"%mini)
-      self.logger.main_log("% 8.4f%% q1"%q1)
-      self.logger.main_log("% 8.4f%% median"%med)
-      self.logger.main_log("% 8.4f%% q3"%q3)
-      self.logger.main_log("% 8.4f%% max"%maxi)
-      self.logger.main_log("")
-
-      if self.params.statistics.deltaccint.verbose:
-        self.logger.main_log("Showing ΔCC½ for all lattices")
-        for e, identifier in enumerate(all_expt_ids):
-          self.logger.main_log("%s %f"%(identifier, data[e]))
-
-      n_worst = min(len(data), 30)
-      worst = sorted_data[-n_worst:]
-      iqr = q3-q1
+    return all_expt_ids, len(filtered), total_i_n, total_semsq_sums, total_diff_sq_sum
 
-      self.logger.main_log("Showing ΔCC½ of the worst %d lattices and IQR ratio needed to remove them"%n_worst)
-      self.logger.main_log(" ΔCC½ (%) IQR ratio Lattices removed")
-      for i in range(len(worst)):
-        self.logger.main_log("% 8.4f % 10.1f %d"%(worst[i], (worst[i]-med)/iqr, n_worst-i))
-      self.logger.main_log("")
+  def compute_sums_sparse(self, reflections, min_mult):
+    '''Same as compute_sums_dense, but with memory proportional to the number of observations. The per-HKL sums are
+       computed once; leaving out an experiment only changes the HKLs it measured, so the per-experiment sums are
+       the unmodified sums plus sparse corrections over the measured (experiment, HKL) pairs. Only per-experiment
+       accumulators are reduced across ranks. The reflections must be sorted by asu HKL (group worker).'''
+    comm = self.mpi_helper.comm
+    MPI = self.mpi_helper.MPI
 
-      if self.params.statistics.deltaccint.iqr_ratio:
-        cut = q3 + iqr * self.params.statistics.deltaccint.iqr_ratio
-        sel = data > cut
-        worst_expts_ = flex.std_string(all_expt_ids).select(sel)
+    # group the observations by asu HKL and keep HKLs measured by at least min_mult experiments
+    offsets = reflection_table_utils.get_hkl_group_offsets(reflections)
+    n_groups = len(offsets) - 1
+    counts = np.diff(offsets)
+    group_ids = np.repeat(np.arange(n_groups), counts)
+    ids = reflections['id'].as_numpy_array() if len(reflections) else np.empty(0, dtype=np.int32)
+    id_range = int(ids.max()) + 1 if len(ids) else 1
+    distinct_pairs = np.unique(group_ids.astype(np.int64) * id_range + ids)
+    passed = np.bincount(distinct_pairs // id_range, minlength=n_groups) >= min_mult
+    n_filtered = int(counts[passed].sum())
+
+    expt_map = reflections.experiment_identifiers() if passed.any() else {}
+    all_expt_ids = sorted(set(itertools.chain.from_iterable(comm.allgather(list(expt_map.values())))))
+    all_expts_map = {v: k for k, v in enumerate(all_expt_ids)}
+    n_expts = len(all_expt_ids)
+    self.log_start(min_mult, n_expts)
 
-        self.logger.main_log("Removing %d experiments out of %d using IQR ratio %.1f"%(len(worst_expts_), len(all_expt_ids), self.params.statistics.deltaccint.iqr_ratio))
+    hkl_resolution_bins = self.params.statistics.hkl_resolution_bins
+    keep = passed & (hkl_resolution_bins.group_bins(reflections, offsets)[1] >= 0)
+    n_hkl = int(keep.sum())
+
+    # observations of the kept HKLs: HKL index g, global experiment index e, intensity I
+    keep_rows = keep[group_ids]
+    g = (np.cumsum(keep) - 1)[group_ids[keep_rows]]
+    global_expt_index = np.zeros(id_range, dtype=np.int64)
+    for local_id, identifier in expt_map:
+      global_expt_index[local_id] = all_expts_map[identifier]
+    e = global_expt_index[ids[keep_rows]]
+    I = reflections['intensity.sum.value'].as_numpy_array()[keep_rows]
+
+    # unmodified per-HKL mean, sum of squared deviations and semsq
+    N = np.bincount(g, minlength=n_hkl)
+    S = np.bincount(g, weights=I, minlength=n_hkl)
+    mean = S / N
+    D = np.bincount(g, weights=(I - mean[g])**2, minlength=n_hkl)
+    semsq = D / (N - 1) / N
+
+    # the same quantities with experiment pe left out, for every measured (experiment, HKL) pair
+    pairs, pair_of_obs = np.unique(g * n_expts + e, return_inverse=True)
+    pg = pairs // n_expts
+    pe = pairs % n_expts
+    n_left = N[pg] - np.bincount(pair_of_obs)
+    mean_left = (S[pg] - np.bincount(pair_of_obs, weights=I)) / n_left
+    D_left = D[pg] - np.bincount(pair_of_obs, weights=(I - mean[g])**2) - n_left * (mean_left - mean[pg])**2
+    D_left = np.where(D_left < 0, D[pg], D_left)
+    semsq_left = D_left / (n_left - 1) / n_left
+
+    # per-experiment sums over the local HKLs: unmodified sums plus corrections
+    all_i_sums = np.sum(mean) + np.bincount(pe, weights=mean_left - mean[pg], minlength=n_expts)
+    all_semsq_sums = np.sum(semsq) + np.bincount(pe, weights=semsq_left - semsq[pg], minlength=n_expts)
 
-    # Broadcast the worst experiments to cut
-    else:
-      worst_expts_ = None
+    total_i_sums     = comm.allreduce(all_i_sums, op=MPI.SUM)
+    total_i_n        = comm.allreduce(n_hkl, op=MPI.SUM)
+    total_semsq_sums = comm.reduce(all_semsq_sums, op=MPI.SUM)
+    total_i_average  = total_i_sums / total_i_n
 
-    if self.params.statistics.deltaccint.iqr_ratio:
-      worst_expts = comm.bcast(worst_expts_, 0)
-      self.logger.log("Starting number of reflections: %d"%len(reflections))
-      self.logger.log("Reflections after filtering by minimum multiplicity of %d: %d"%(min_mult, len(filtered)))
-      reflections.remove_on_experiment_identifiers(worst_expts)
-      reflections.reset_ids()
-      self.logger.log("Reflections after filtering by ΔCC½: %d"%len(reflections))
+    # sum over HKLs of (mean - average)**2, with the unmodified part computed around the local mean of the means
+    center = np.mean(mean) if n_hkl else 0.
+    diff_sq_sum = np.sum((mean - center)**2) + n_hkl * (center - total_i_average)**2 + \
+      np.bincount(pe, weights=(mean_left - total_i_average[pe])**2 - (mean[pg] - total_i_average[pe])**2, minlength=n_expts)
+    total_diff_sq_sum = comm.reduce(diff_sq_sum, MPI.SUM, 0)
 
-    self.logger.log_step_time("STATISTICS_DELTA_CCINT", True)
+    return all_expt_ids, n_filtered, total_i_n, total_semsq_sums, total_diff_sq_sum
 
-    return experiments, reflections
+  def log_start(self, min_mult, n_expts):
+    if self.mpi_helper.rank == 0:
+      self.logger.main_log("Beginning ΔCC½ analysis (σ-τ method from Assmann 2016)")
+      self.logger.main_log("Removing reflections with less than %d measurements"%min_mult)
+      self.logger.main_log("N experiments after filtering: %d"%n_expts)
+      self.logger.main_log("")
 
 if __name__ == '__main__':
   from xfel.merging.application.worker import exercise_worker
@@ -1,9 +1,9 @@
 from __future__ import absolute_import, division, print_function
 from six.moves import range
 from dials.array_family import flex
+import numpy as np
 from libtbx import table_utils
 from xfel.merging.application.worker import worker
-from xfel.merging.application.reflection_table_utils import reflection_table_utils
 
 class experiment_resolution_statistics(worker):
   '''Calculates experiments accepted vs resolution bins'''
@@ -34,9 +34,13 @@ class experiment_resolution_statistics(worker):
       Experiment_Table_text = self.get_formatted_table(self.experiment_count_per_resolution_bins, len(experiments))
       self.logger.log(Experiment_Table_text)
 
-    # Accumulate statistics from all ranks
-    all_ranks_experiment_count_per_resolution_bins = self.mpi_helper.cumulative_flex(self.experiment_count_per_resolution_bins, flex.int)
-    all_ranks_total_experiment_count = self.mpi_helper.sum(len(experiments))
+    # Accumulate statistics from all ranks: the per-bin counts and the experiment count in one reduction
+    counts = np.append(self.experiment_count_per_resolution_bins.as_numpy_array(), len(experiments)).astype(np.int64)
+    all_ranks_counts = np.empty_like(counts) if self.mpi_helper.rank == 0 else None
+    self.mpi_helper.comm.Reduce(counts, all_ranks_counts, op=self.mpi_helper.MPI.SUM, root=0)
+    if self.mpi_helper.rank == 0:
+      all_ranks_experiment_count_per_resolution_bins = flex.int(all_ranks_counts[:-1].tolist())
+      all_ranks_total_experiment_count = int(all_ranks_counts[-1])
 
     # Format and output all-rank total statistics
     if self.mpi_helper.rank == 0:
@@ -71,30 +75,16 @@ class experiment_resolution_statistics(worker):
   def count_experiments_per_resolution_bins(self, reflections):
     '''For each resolution bin, count experiments that contributed reflections to that bin'''
 
-    # Sort all reflections on asu hkls
-    self.logger.log_step_time("SORT")
-    self.logger.log("Sorting reflection table...")
-    reflections.sort('miller_index_asymmetric')
-    self.logger.log_step_time("SORT", True)
-
-    # Initialize a dictionary to store unique experiment ids in resolution bins
-    experiments_per_resolution_bins = {}
-    for i_bin in range(self.n_bins):
-      experiments_per_resolution_bins[i_bin] = set()
-
-    # Accumulate experiment ids in the resolution bins where those experiments contributed reflections
-    for refls in reflection_table_utils.get_next_hkl_reflection_table(reflections=reflections):
-      if refls.size() == 0:
-        break # unless the input "reflections" list is empty, generated "refls" lists cannot be empty
-      hkl = refls[0]['miller_index_asymmetric']
-      if hkl in self.hkl_resolution_bins:
-        i_bin = self.hkl_resolution_bins[hkl]
-        for refl in refls.rows():
-          experiments_per_resolution_bins[i_bin].add(refls.experiment_identifiers()[refl['id']])
-
-    # For each bin, reduce the sets of unique experiment ids to their count
-    for i_bin in range(self.resolution_binner.n_bins_all()):
-      self.experiment_count_per_resolution_bins[i_bin] = len(experiments_per_resolution_bins[i_bin])
+    # Resolution bin of every reflection, -1 if its asu hkl has none
+    bins = self.hkl_resolution_bins.bins(reflections['miller_index_asymmetric'])
+    ids = reflections['id'].as_numpy_array()
+    binned = bins >= 0
+
+    # Distinct (bin, experiment id) pairs; the ids map one-to-one to the experiment identifiers
+    id_range = int(ids.max()) + 1 if len(ids) else 1
+    distinct_pairs = np.unique(bins[binned].astype(np.int64) * id_range + ids[binned])
+    experiment_count = np.bincount(distinct_pairs // id_range, minlength=self.n_bins)
+    self.experiment_count_per_resolution_bins = flex.int(experiment_count.tolist())
 
 if __name__ == '__main__':
   from xfel.merging.application.worker import exercise_worker
@@ -3,10 +3,11 @@ from six.moves import range
 from xfel.merging.application.worker import worker
 from dials.array_family import flex
 import math
+import numpy as np
 from libtbx import adopt_init_args
 from libtbx.str_utils import format_value
 from libtbx import table_utils
-from xfel.merging.application.reflection_table_utils import reflection_table_utils
+from xfel.merging.application.reflection_table_utils import reflection_table_utils, hkl_lookup
 from six.moves import cStringIO as StringIO
 from cctbx.crystal import symmetry
 from cctbx import miller
@@ -270,38 +271,37 @@ class intensity_resolution_statistics(worker):
     self.cc_sum_y     = flex.double(n_bins, 0.0)
 
     # Find matching indices in the two data sets
-    matching_indices = miller.match_multi_indices(miller_indices_unique = miller_array_1.indices(),
-                                                  miller_indices = miller_array_2.indices())
+    pair_1 = hkl_lookup(miller_array_1.indices()).lookup(miller_array_2.indices())
+    matched = pair_1 >= 0
 
     # Perform binned summations for all components of the cross-correlation formula
-    for pair in matching_indices.pairs():
-
-      hkl = miller_array_1.indices()[pair[0]]
-      assert hkl == miller_array_2.indices()[pair[1]]
-
-      if hkl in self.hkl_resolution_bins:
-        i_bin = self.hkl_resolution_bins[hkl]
-
-        I_x = miller_array_1.data()[pair[0]]
-        I_y = miller_array_2.data()[pair[1]]
-
-        self.cc_N[i_bin]        += 1
-        self.cc_sum_xx[i_bin]   += I_x**2
-        self.cc_sum_yy[i_bin]   += I_y**2
-        self.cc_sum_xy[i_bin]   += I_x * I_y
-        self.cc_sum_x[i_bin]    += I_x
-        self.cc_sum_y[i_bin]    += I_y
+    pair_bins = self.hkl_resolution_bins.bins(miller_array_2.indices())
+    binned = matched & (pair_bins >= 0)
+    pair_bins = pair_bins[binned]
+    I_x = miller_array_1.data().as_numpy_array()[pair_1[binned]]
+    I_y = miller_array_2.data().as_numpy_array()[binned]
+
+    self.cc_N         += flex.int(np.bincount(pair_bins, minlength=n_bins).tolist())
+    self.cc_sum_xx    += flex.double(np.bincount(pair_bins, weights=I_x**2, minlength=n_bins))
+    self.cc_sum_yy    += flex.double(np.bincount(pair_bins, weights=I_y**2, minlength=n_bins))
+    self.cc_sum_xy    += flex.double(np.bincount(pair_bins, weights=I_x * I_y, minlength=n_bins))
+    self.cc_sum_x     += flex.double(np.bincount(pair_bins, weights=I_x, minlength=n_bins))
+    self.cc_sum_y     += flex.double(np.bincount(pair_bins, weights=I_y, minlength=n_bins))
 
     # Accumulate binned counts (cc_N) and sums (cc_sum) from all ranks
-    all_ranks_cc_N          = self.mpi_helper.cumulative_flex(self.cc_N,      flex.int)
-    all_ranks_cc_sum_xx     = self.mpi_helper.cumulative_flex(self.cc_sum_xx, flex.double)
-    all_ranks_cc_sum_yy     = self.mpi_helper.cumulative_flex(self.cc_sum_yy, flex.double)
-    all_ranks_cc_sum_xy     = self.mpi_helper.cumulative_flex(self.cc_sum_xy, flex.double)
-    all_ranks_cc_sum_x      = self.mpi_helper.cumulative_flex(self.cc_sum_x,  flex.double)
-    all_ranks_cc_sum_y      = self.mpi_helper.cumulative_flex(self.cc_sum_y,  flex.double)
+    reduction = self.mpi_helper.reduction()
+    for name in ['cc_N', 'cc_sum_xx', 'cc_sum_yy', 'cc_sum_xy', 'cc_sum_x', 'cc_sum_y']:
+      reduction.add_sum(name, getattr(self, name).as_numpy_array())
+    totals = reduction.flush()
 
     # Reduce all binned counts (cc_N) and sums (cc_sum) from all ranks
     if self.mpi_helper.rank == 0:
+      all_ranks_cc_N          = flex.int(totals['cc_N'].tolist())
+      all_ranks_cc_sum_xx     = flex.double(totals['cc_sum_xx'])
+      all_ranks_cc_sum_yy     = flex.double(totals['cc_sum_yy'])
+      all_ranks_cc_sum_xy     = flex.double(totals['cc_sum_xy'])
+      all_ranks_cc_sum_x      = flex.double(totals['cc_sum_x'])
+      all_ranks_cc_sum_y      = flex.double(totals['cc_sum_y'])
       return self.build_cross_correlation_table(
                                                 all_ranks_cc_N,
                                                 all_ranks_cc_sum_xx,
@@ -344,21 +344,25 @@ class intensity_resolution_statistics(worker):
       self.logger.log(Intensity_Table.get_table_text(), rank_prepend=False)
 
     # Accumulate statistics from all ranks
-    all_ranks_I_sum       = self.mpi_helper.cumulative_flex(self.I_sum, flex.double)
-    all_ranks_Isig_sum    = self.mpi_helper.cumulative_flex(self.Isig_sum, flex.double)
-    all_ranks_n_sum       = self.mpi_helper.cumulative_flex(self.n_sum, flex.int)
-    all_ranks_m_sum       = self.mpi_helper.cumulative_flex(self.m_sum, flex.int)
-    all_ranks_mm_sum      = self.mpi_helper.cumulative_flex(self.mm_sum, flex.int)
+    reduction = self.mpi_helper.reduction()
+    for name in ['I_sum', 'Isig_sum', 'n_sum', 'm_sum', 'mm_sum']:
+      reduction.add_sum(name, getattr(self, name).as_numpy_array())
+    for bin_id in range(n_bins):
+      reduction.add_array('Isig_%d'%bin_id, self.Isig_list[bin_id].as_numpy_array())
+    totals = reduction.flush()
+    if self.mpi_helper.rank == 0:
+      all_ranks_I_sum       = flex.double(totals['I_sum'])
+      all_ranks_Isig_sum    = flex.double(totals['Isig_sum'])
+      all_ranks_n_sum       = flex.int(totals['n_sum'].tolist())
+      all_ranks_m_sum       = flex.int(totals['m_sum'].tolist())
+      all_ranks_mm_sum      = flex.int(totals['mm_sum'].tolist())
 
     all_ranks_unmerged_meanIsig = []
     all_ranks_unmerged_stddevIsig = []
     all_ranks_unmerged_skewIsig = []
     for bin_id in range(n_bins):
-      all_ranks_isigi_list = self.mpi_helper.comm.gather(self.Isig_list[bin_id], 0)
       if self.mpi_helper.rank == 0:
-        all_isigi = flex.double()
-        for ranklist in all_ranks_isigi_list:
-          all_isigi.extend(ranklist)
+        all_isigi = flex.double(totals['Isig_%d'%bin_id])
         stats = basic_statistics(all_isigi)
         all_ranks_unmerged_meanIsig.append(stats.mean)
         all_ranks_unmerged_stddevIsig.append(stats.bias_corrected_standard_deviation)
@@ -397,15 +401,15 @@ class intensity_resolution_statistics(worker):
     # How many bins do we have?
     n_bins = self.resolution_binner.n_bins_all() # (self.params.statistics.n_bins + 2), 2 - to account for the HKLs outside of the binner resolution range
 
+    # Resolution bin of each asu hkl group, -1 if the hkl has none
+    _, group_bins = self.hkl_resolution_bins.group_bins(reflections)
+
     # Calculate auxiliary per-bin sums needed for the intensity statistics
-    for refls in reflection_table_utils.get_next_hkl_reflection_table(reflections=reflections):
+    for refls, i_bin in zip(reflection_table_utils.get_next_hkl_reflection_table(reflections=reflections), group_bins.tolist()):
       if refls.size() == 0:
         break # unless the input "reflections" list is empty, generated "refls" lists cannot be empty
 
-      hkl = refls[0]['miller_index_asymmetric']
-      if hkl in self.hkl_resolution_bins:
-
-        i_bin = self.hkl_resolution_bins[hkl]
+      if i_bin >= 0:
 
         if i_bin > 0 and i_bin < n_bins - 1:
           zero_intensity_count_resolution_limited     += (refls['intensity.sum.value'] == 0.0).count(True)
@@ -432,17 +436,18 @@ class intensity_resolution_statistics(worker):
     # Accumulate intensities, which were used in the above statistics table, from all ranks
     #all_used_intensities = self.mpi_helper.extend_flex(used_reflections['intensity.sum.value'], flex.double)
 
-    total_zero_intensity_count_all = self.mpi_helper.sum(zero_intensity_count_all)
-    total_zero_intensity_count_resolution_limited = self.mpi_helper.sum(zero_intensity_count_resolution_limited)
-
-    total_positive_intensity_count_all = self.mpi_helper.sum(positive_intensity_count_all)
-    total_positive_intensity_count_resolution_limited = self.mpi_helper.sum(positive_intensity_count_resolution_limited)
-
-    total_negative_intensity_count_all = self.mpi_helper.sum(negative_intensity_count_all)
-    total_negative_intensity_count_resolution_limited = self.mpi_helper.sum(negative_intensity_count_resolution_limited)
+    reduction = self.mpi_helper.reduction()
+    reduction.add_sum('all', [zero_intensity_count_all, positive_intensity_count_all, negative_intensity_count_all])
+    reduction.add_sum('resolution_limited', [zero_intensity_count_resolution_limited,
+                                             positive_intensity_count_resolution_limited,
+                                             negative_intensity_count_resolution_limited])
+    totals = reduction.flush()
 
     # Build a histogram of all intensities
     if self.mpi_helper.rank == 0:
+      total_zero_intensity_count_all, total_positive_intensity_count_all, total_negative_intensity_count_all = totals['all']
+      total_zero_intensity_count_resolution_limited, total_positive_intensity_count_resolution_limited, \
+        total_negative_intensity_count_resolution_limited = totals['resolution_limited']
 
       self.logger.main_log("Total reflections (I == 0.0): \t\t%d"%(total_zero_intensity_count_all))
       self.logger.main_log("Total reflections (I > 0.0): \t\t%d"%(total_positive_intensity_count_all))
@@ -0,0 +1,152 @@
+from __future__ import absolute_import, division, print_function
+import hashlib, json, os, pickle
+
+"""
+Checkpoints between the steps of cctbx.xfel.merge (dispatch.checkpoint). After a step named in save_after, every rank
+writes its experiments and reflections, and the model state that the steps inject into the parameters (reference
+intensities, full Miller set, resolution binner, average unit cell, etc.), to <directory>/<step>. A later run with
+the same number of ranks can start at any step with resume_at, from the checkpoint of the preceding step. The
+checkpoint records a fingerprint of the parameters read by the steps up to and including the checkpointed step, and a
+run resuming from it must have the same fingerprint, so that only parameters of the remaining steps can be changed.
+"""
+
+# Parameter scopes read by the steps, by step factory name. Steps not listed here are fingerprinted with all
+# parameters except the dispatch, output and mp scopes.
+step_parameters = {
+  'input':      ['input'],
+  'balance':    ['input.parallel_file_load'],
+  'model':      ['scaling', 'merging.d_min', 'merging.d_max', 'merging.merge_anomalous', 'merging.set_average_unit_cell',
+                 'statistics.n_bins', 'statistics.cciso'],
+  'modify':     ['modify', 'merging.merge_anomalous'],
+  'filter':     ['filter', 'select', 'filter_global'],
+  'select':     ['select'],
+  'scale':      ['scaling', 'filter.outlier', 'merging.d_min', 'postrefinement.enable'],
+  'postrefine': ['postrefinement', 'scaling', 'merging.merge_anomalous'],
+  'statistics': ['statistics', 'merging.d_min', 'merging.d_max'],
+  'group':      ['group'],
+  'errors':     ['merging'],
+  'merge':      ['merging'],
+}
+unfingerprinted_scopes = ['dispatch', 'output', 'mp']
+
+# Attributes set or injected into the parameters by the steps, restored from the checkpoint on resume
+derived_state = ['scaling.i_model', 'scaling.miller_set', 'scaling.space_group', 'scaling.unit_cell',
+                 'statistics.resolution_binner', 'statistics.hkl_resolution_bins', 'statistics.average_wavelength',
+                 'statistics.average_unit_cell', 'filter.unit_cell.value.target_unit_cell',
+                 'filter.unit_cell.value.target_space_group']
+
+def get_scope(params, path):
+  for name in path.split('.'):
+    params = getattr(params, name)
+  return params
+
+class checkpoint(object):
+  '''Saves and loads the per-rank checkpoints of a merging run'''
+
+  def __init__(self, params, mpi_helper, mpi_logger):
+    self.mpi_helper = mpi_helper
+    self.logger = mpi_logger
+    self.directory = params.dispatch.checkpoint.directory or os.path.join(params.output.output_dir, 'checkpoints')
+    self.step_list = list(params.dispatch.step_list)
+    for step in params.dispatch.checkpoint.save_after or []:
+      if step not in self.step_list:
+        from libtbx.utils import Sorry
+        raise Sorry("Cannot save a checkpoint after step %s: it is not in dispatch.step_list"%step)
+    # The fingerprints must be computed from the parameters as given, before any step modifies them
+    from xfel.merging.application.phil.phil import phil_scope
+    self.working_phil = phil_scope.format(python_object=params)
+
+  def fingerprint(self, upstream_steps):
+    '''A hash of the names of the given steps and of the parameters they read'''
+    paths = []
+    for step in upstream_steps:
+      factory_name = step.split('_')[0]
+      if factory_name in step_parameters:
+        paths.extend(step_parameters[factory_name])
+      else:
+        paths.extend(obj.name for obj in self.working_phil.objects if obj.name not in unfingerprinted_scopes)
+    digest = hashlib.sha256()
+    digest.update(','.join(upstream_steps).encode())
+    for path in sorted(set(paths)):
+      digest.update(path.encode())
+      digest.update(self.working_phil.get(path).as_str().encode())
+    return digest.hexdigest()
+
+  def step_directory(self, step):
+    return os.path.join(self.directory, step)
+
+  def rank_file_path(self, step, suffix):
+    return os.path.join(self.step_directory(step), 'rank_%06d%s'%(self.mpi_helper.rank, suffix))
+
+  def save(self, step, experiments, reflections, params):
+    '''Write this rank's experiments, reflections and the derived model state after the given step'''
+    self.logger.log_step_time("SAVE_CHECKPOINT")
+    step_directory = self.step_directory(step)
+    os.makedirs(step_directory, exist_ok=True)
+
+    state = {}
+    for path in derived_state:
+      scope_path, name = path.rsplit('.', 1)
+      scope = get_scope(params, scope_path)
+      if name in scope.__dict__:
+        state[path] = getattr(scope, name)
+    with open(self.rank_file_path(step, '.state.pickle'), 'wb') as f:
+      pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # experiments may be an experiment list or an experiment summary, both pickle as compact binary data
+    with open(self.rank_file_path(step, '.expt.pickle'), 'wb') as f:
+      pickle.dump(experiments, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if reflections is not None:
+      reflections.as_file(self.rank_file_path(step, '.refl'))
+
+    if self.mpi_helper.rank == 0:
+      upstream_steps = self.step_list[:self.step_list.index(step) + 1]
+      manifest = dict(step=step, upstream_steps=upstream_steps, size=self.mpi_helper.size,
+                      fingerprint=self.fingerprint(upstream_steps))
+      with open(os.path.join(step_directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    self.logger.log("Saved checkpoint after step %s to %s"%(step, step_directory))
+    self.logger.log_step_time("SAVE_CHECKPOINT", True)
+
+  def load(self, resume_step, params):
+    '''Load this rank's experiments and reflections from the checkpoint of the step preceding resume_step, validate
+       the checkpoint against the current run and restore the derived model state into params'''
+    from libtbx.utils import Sorry
+    from dials.array_family import flex
+    self.logger.log_step_time("LOAD_CHECKPOINT")
+    if resume_step not in self.step_list or self.step_list.index(resume_step) == 0:
+      raise Sorry("Cannot resume at step %s: it must be a step of dispatch.step_list other than the first"%resume_step)
+    upstream_steps = self.step_list[:self.step_list.index(resume_step)]
+    step = upstream_steps[-1]
+
+    manifest_path = os.path.join(self.step_directory(step), 'manifest.json')
+    if not os.path.exists(manifest_path):
+      raise Sorry("No checkpoint found after step %s: %s doesn't exist"%(step, manifest_path))
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+    if manifest['size'] != self.mpi_helper.size:
+      raise Sorry("The checkpoint after step %s was written by %d ranks, but this run has %d"%(step, manifest['size'], self.mpi_helper.size))
+    if manifest['upstream_steps'] != upstream_steps:
+      raise Sorry("The checkpoint after step %s was written with steps %s, but this run has %s"%(
+        step, ','.join(manifest['upstream_steps']), ','.join(upstream_steps)))
+    if manifest['fingerprint'] != self.fingerprint(upstream_steps):
+      raise Sorry("The parameters of steps %s differ from those the checkpoint after step %s was written with"%(','.join(upstream_steps), step))
+
+    with open(self.rank_file_path(step, '.state.pickle'), 'rb') as f:
+      state = pickle.load(f)
+    for path, value in state.items():
+      scope_path, name = path.rsplit('.', 1)
+      scope = get_scope(params, scope_path)
+      if name in scope.__dict__:
+        scope.__setattr__(name, value)
+      else:
+        scope.__inject__(name, value)
+    with open(self.rank_file_path(step, '.expt.pickle'), 'rb') as f:
+      experiments = pickle.load(f)
+    reflections_path = self.rank_file_path(step, '.refl')
+    reflections = flex.reflection_table.from_file(reflections_path) if os.path.exists(reflections_path) else None
+
+    self.logger.log("Loaded checkpoint after step %s from %s: %d experiments, %d reflections"%(
+      step, self.step_directory(step), len(experiments) if experiments is not None else 0,
+      len(reflections) if reflections is not None else 0))
+    self.logger.log_step_time("LOAD_CHECKPOINT", True)
+    return experiments, reflections
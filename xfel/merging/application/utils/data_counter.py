@@ -61,23 +61,18 @@ class data_counter(object):
       image_count = 0
 
     # MPI-reduce all counts
-    comm = self.mpi_helper.comm
-    MPI = self.mpi_helper.MPI
-
-    total_experiment_count  = comm.reduce(experiment_count, MPI.SUM)
-    min_experiment_count    = comm.reduce(experiment_count, MPI.MIN)
-    max_experiment_count    = comm.reduce(experiment_count, MPI.MAX)
-
-    total_image_count       = comm.reduce(image_count, MPI.SUM)
-    min_image_count         = comm.reduce(image_count, MPI.MIN)
-    max_image_count         = comm.reduce(image_count, MPI.MAX)
-
-    total_reflection_count  = comm.reduce(reflection_count, MPI.SUM)
-    min_reflection_count    = comm.reduce(reflection_count, MPI.MIN)
-    max_reflection_count    = comm.reduce(reflection_count, MPI.MAX)
+    reduction = self.mpi_helper.reduction()
+    counts = [experiment_count, image_count, reflection_count]
+    reduction.add_sum('total', counts)
+    reduction.add_min('min', counts)
+    reduction.add_max('max', counts)
+    totals = reduction.flush()
 
     # rank 0: log data statistics
     if self.mpi_helper.rank == 0:
+      total_experiment_count, total_image_count, total_reflection_count = totals['total']
+      min_experiment_count, min_image_count, min_reflection_count = totals['min']
+      max_experiment_count, max_image_count, max_reflection_count = totals['max']
       self.logger.main_log('Experiments: (total,min,max): %d, %d, %d'%(total_experiment_count, min_experiment_count, max_experiment_count))
       self.logger.main_log('Images:      (total,min,max): %d, %d, %d'%(total_image_count, min_image_count, max_image_count))
       self.logger.main_log('Reflections: (total,min,max): %d, %d, %d'%(total_reflection_count, min_reflection_count, max_reflection_count))
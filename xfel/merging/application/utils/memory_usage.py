@@ -1,7 +1,10 @@
 from __future__ import absolute_import, division, print_function
 
-def get_memory_usage():
-  '''Return memory used by the process in MB'''
+# peak memory of the process before the last reset_peak_memory_usage, in MB
+peak_before_reset = 0
+
+def get_rusage_peak():
+  '''Return the peak memory reported by getrusage in MB'''
   import resource
   import platform
   # getrusage returns kb on linux, bytes on mac
@@ -9,3 +12,26 @@ def get_memory_usage():
   if platform.system() == "Darwin":
     units_per_mb = 1024*1024
   return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / units_per_mb
+
+def get_memory_usage():
+  '''Return memory used by the process in MB'''
+  return max(peak_before_reset, get_rusage_peak())
+
+def reset_peak_memory_usage():
+  '''Reset the peak resident memory tracked by the kernel to the current resident memory, so that
+     get_peak_memory_usage reports the peak reached from now on, e.g. the transient peak of one step.
+     get_memory_usage still reports the peak of the whole process. Only supported on Linux; returns False if the
+     peak could not be reset.'''
+  global peak_before_reset
+  peak = get_memory_usage()
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+  except (IOError, OSError):
+    return False
+  peak_before_reset = peak
+  return True
+
+def get_peak_memory_usage():
+  '''Return the peak memory used by the process in MB since the last reset_peak_memory_usage'''
+  return get_rusage_peak()
@@ -0,0 +1,138 @@
+from __future__ import absolute_import, division, print_function
+import csv, json, os, pickle, time
+from libtbx.mpi4py import MPI
+import numpy as np
+
+"""
+Per-step, per-rank profiling of cctbx.xfel.merge (mp.debug.profile_steps=True). For every worker step the profiler
+records wall and CPU time, the growth of the peak resident memory, the number, outgoing size and duration of the MPI
+collectives issued through mpi_helper.comm, and the experiment and reflection counts before and after the step.
+Each rank writes its records as JSON and CSV files to the output directory; cctbx.xfel.merge_profile aggregates the
+JSON files of all ranks into a load-imbalance report.
+"""
+
+# Collectives whose first argument (or the named keyword argument) is the outgoing message
+object_collectives = {'bcast':'obj', 'gather':'sendobj', 'allgather':'sendobj', 'scatter':'sendobj',
+                      'alltoall':'sendobj', 'reduce':'sendobj', 'allreduce':'sendobj'}
+buffer_collectives = {'Bcast':'buf', 'Gather':'sendbuf', 'Gatherv':'sendbuf', 'Allgather':'sendbuf',
+                      'Allgatherv':'sendbuf', 'Scatter':'sendbuf', 'Scatterv':'sendbuf', 'Alltoall':'sendbuf',
+                      'Alltoallv':'sendbuf', 'Reduce':'sendbuf', 'Allreduce':'sendbuf'}
+synchronizing_collectives = ['barrier', 'Barrier']
+
+def buffer_nbytes(buf):
+  '''Size of an MPI buffer specification: an array-like, or a list/tuple starting with one'''
+  if isinstance(buf, (list, tuple)):
+    buf = buf[0] if len(buf) > 0 else None
+  if buf is None or buf is getattr(MPI, 'IN_PLACE', None):
+    return 0
+  try:
+    return memoryview(buf).nbytes
+  except TypeError:
+    return np.asarray(buf).nbytes
+
+def object_nbytes(obj):
+  '''Size of a pickled message, as sent by the lowercase mpi4py collectives'''
+  if obj is None:
+    return 0
+  return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+def peak_rss_mb():
+  '''High-water mark of the resident memory of the process in MB'''
+  from xfel.merging.application.utils.memory_usage import get_memory_usage
+  return get_memory_usage()
+
+class counting_comm(object):
+  """
+  A wrapper around an MPI communicator, which counts the collectives called on it, the bytes each rank sends with
+  them and the time spent in them. All other attributes are delegated to the wrapped communicator. The size of the
+  messages sent with the lowercase (pickle-based) collectives is measured by pickling them once more, so measuring
+  bytes adds some serialization cost to those calls; with measure_bytes=False only the calls and time are counted.
+  """
+  def __init__(self, comm, measure_bytes=True):
+    self.comm = comm
+    self.measure_bytes = measure_bytes
+    self.n_collectives = 0
+    self.collective_bytes = 0
+    self.collective_time = 0.0
+
+  def __getattr__(self, name):
+    attribute = getattr(self.comm, name)
+    if name in object_collectives:
+      return self._counted(attribute, object_collectives[name], object_nbytes)
+    if name in buffer_collectives:
+      return self._counted(attribute, buffer_collectives[name], buffer_nbytes)
+    if name in synchronizing_collectives:
+      return self._counted(attribute, None, None)
+    return attribute
+
+  def _counted(self, collective, message_keyword, message_nbytes):
+    def counted_collective(*args, **kwargs):
+      if self.measure_bytes and message_nbytes is not None:
+        message = args[0] if len(args) > 0 else kwargs.get(message_keyword)
+        self.collective_bytes += message_nbytes(message)
+      self.n_collectives += 1
+      start = time.time()
+      try:
+        return collective(*args, **kwargs)
+      finally:
+        self.collective_time += time.time() - start
+    return counted_collective
+
+  def counters(self):
+    return self.n_collectives, self.collective_bytes, self.collective_time
+
+class step_profiler(object):
+  '''Records per-step statistics on one rank. Installing the profiler turns on byte counting in mpi_helper.comm.'''
+
+  fields = ['step', 'name', 'rank', 'wall_time', 'cpu_time', 'collective_time', 'peak_rss_mb', 'peak_rss_delta_mb',
+            'collectives', 'collective_bytes', 'experiments_in', 'experiments_out', 'reflections_in', 'reflections_out']
+
+  def __init__(self, mpi_helper):
+    self.mpi_helper = mpi_helper
+    if not isinstance(mpi_helper.comm, counting_comm):
+      mpi_helper.comm = counting_comm(mpi_helper.comm)
+    mpi_helper.comm.measure_bytes = True
+    self.comm = mpi_helper.comm
+    self.records = []
+    self.current = None
+
+  @staticmethod
+  def count(data):
+    return len(data) if data is not None else 0
+
+  def start(self, name, experiments, reflections):
+    '''Start recording a step, given the step input'''
+    n_collectives, collective_bytes, collective_time = self.comm.counters()
+    self.current = dict(step=len(self.records) + 1, name=name, rank=self.mpi_helper.rank,
+                        experiments_in=self.count(experiments), reflections_in=self.count(reflections))
+    self.start_counters = (time.time(), time.process_time(), peak_rss_mb(), n_collectives, collective_bytes, collective_time)
+
+  def stop(self, experiments, reflections):
+    '''Finish recording the current step, given the step output'''
+    assert self.current is not None, "A step has finished, but hasn't been started"
+    wall_start, cpu_start, rss_start, n_collectives_start, collective_bytes_start, collective_time_start = self.start_counters
+    n_collectives, collective_bytes, collective_time = self.comm.counters()
+    rss = peak_rss_mb()
+    self.current.update(wall_time=time.time() - wall_start,
+                        cpu_time=time.process_time() - cpu_start,
+                        collective_time=collective_time - collective_time_start,
+                        peak_rss_mb=rss,
+                        peak_rss_delta_mb=rss - rss_start,
+                        collectives=n_collectives - n_collectives_start,
+                        collective_bytes=collective_bytes - collective_bytes_start,
+                        experiments_out=self.count(experiments),
+                        reflections_out=self.count(reflections))
+    self.records.append(self.current)
+    self.current = None
+
+  def write(self, params):
+    '''Write the records of this rank as JSON and CSV files to the output directory. Returns the JSON file path.'''
+    aux_filename_prefix = params.output.prefix + "_" if params.output.prefix else ""
+    file_path = os.path.join(params.output.output_dir, aux_filename_prefix + 'profile_%06d_%06d'%(self.mpi_helper.size, self.mpi_helper.rank))
+    with open(file_path + '.json', 'w') as f:
+      json.dump(dict(rank=self.mpi_helper.rank, size=self.mpi_helper.size, steps=self.records), f, indent=1)
+    with open(file_path + '.csv', 'w') as f:
+      writer = csv.DictWriter(f, fieldnames=self.fields)
+      writer.writeheader()
+      writer.writerows(self.records)
+    return file_path + '.json'
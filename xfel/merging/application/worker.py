@@ -6,6 +6,10 @@ Base classes for the merging application
 
 class worker(object):
   """ Base class for the worker objects. Performs validation and does work using the run method """
+
+  # False if run accepts an experiment_summary in place of an ExperimentList (see input.experiment_summary)
+  needs_experiment_models = True
+
   def __init__(self, params, mpi_helper=None, mpi_logger=None):
     self.params = params
 
@@ -16,6 +16,8 @@ if os.environ.get("CCTBX_NO_UUID", None) is not None:
 
 from xfel.merging.application.mpi_helper import mpi_helper
 from xfel.merging.application.mpi_logger import mpi_logger
+from xfel.merging.application.experiment_summary import experiment_summary
+from xfel.merging.application.utils.memory_usage import get_memory_usage
 from libtbx.mpi4py import mpi_abort_on_exception
 
 # Note, when modifying this list, be sure to modify the README in xfel/merging
@@ -44,7 +46,7 @@ class Script(object):
 
   def __init__(self):
     self.mpi_helper = mpi_helper()
-    self.mpi_logger = mpi_logger()
+    self.mpi_logger = mpi_logger(mpi_helper=self.mpi_helper)
 
   def __del__(self):
     self.mpi_helper.finalize()
@@ -131,6 +133,7 @@ class Script(object):
     self._resolve_persistent_columns()
 
     workers = []
+    worker_steps = [] # the step_list entry each worker was created for
     self.params.dispatch.step_list = self.params.dispatch.step_list or default_steps
     for step in self.params.dispatch.step_list:
       step_factory_name = step
@@ -160,18 +163,38 @@ class Script(object):
         # reset the path
         sys.path = sys_path
 
-      workers.extend(factory.factory.from_parameters(self.params, step_additional_info, mpi_helper=self.mpi_helper, mpi_logger=self.mpi_logger))
+      step_workers = factory.factory.from_parameters(self.params, step_additional_info, mpi_helper=self.mpi_helper, mpi_logger=self.mpi_logger)
+      workers.extend(step_workers)
+      worker_steps.extend([step] * len(step_workers))
 
     # Perform phil validation up front
     for worker in workers:
       worker.validate()
     self.mpi_logger.log_step_time("CREATE_WORKERS", True)
 
+    # Checkpoints are fingerprinted with the parameters as given, so set them up before any step modifies them
+    checkpoint_params = self.params.dispatch.checkpoint
+    save_after = checkpoint_params.save_after or []
+    if save_after or checkpoint_params.resume_at:
+      from xfel.merging.application.utils.checkpoint import checkpoint
+      self.checkpoint = checkpoint(self.params, self.mpi_helper, self.mpi_logger)
+
+    if self.params.mp.debug.profile_steps:
+      from xfel.merging.application.utils.step_profiler import step_profiler
+      profiler = step_profiler(self.mpi_helper)
+
     # Do the work
     experiments = reflections = None
+    if checkpoint_params.resume_at:
+      experiments, reflections = self.checkpoint.load(checkpoint_params.resume_at, self.params)
+      resume_index = self.params.dispatch.step_list.index(checkpoint_params.resume_at)
+      while worker_steps and self.params.dispatch.step_list.index(worker_steps[0]) < resume_index:
+        workers.pop(0)
+        worker_steps.pop(0)
     step = 0
     while(workers):
       worker = workers.pop(0)
+      worker_step = worker_steps.pop(0)
       self.mpi_logger.log_step_time("STEP_" + worker.__repr__())
       # Log worker name, i.e. execution step name
       step += 1
@@ -185,13 +208,27 @@ class Script(object):
           self.mpi_logger.main_log('')
         self.mpi_logger.main_log(step_desc)
 
+      # Rebuild experiment models from the experiment summary before the first step that needs them
+      if worker.needs_experiment_models and isinstance(experiments, experiment_summary):
+        experiments = self.materialize_experiments(experiments)
+
       # Execute worker
+      if self.params.mp.debug.profile_steps:
+        profiler.start(worker.__repr__(), experiments, reflections)
       experiments, reflections = worker.run(experiments, reflections)
+      if self.params.mp.debug.profile_steps:
+        profiler.stop(experiments, reflections)
       self.mpi_logger.log_step_time("STEP_" + worker.__repr__(), True)
       if experiments:
         self.mpi_logger.log("Ending step with %d experiments"%len(experiments))
 
+      # Save a checkpoint after the last worker of a step
+      if worker_step in save_after and (not worker_steps or worker_steps[0] != worker_step):
+        self.checkpoint.save(worker_step, experiments, reflections, self.params)
+
     if self.params.output.save_experiments_and_reflections:
+      if isinstance(experiments, experiment_summary):
+        experiments = self.materialize_experiments(experiments)
       if self.mpi_helper.size == 1:
         filename_suffix = ""
       else:
@@ -205,10 +242,24 @@ class Script(object):
 
     self.mpi_logger.log_step_time("TOTAL", True)
 
+    if self.params.mp.debug.profile_steps:
+      profile_file_path = profiler.write(self.params)
+      self.mpi_logger.log("Wrote step profile to %s"%profile_file_path)
+
     if self.params.mp.debug.cProfile:
       pr.disable()
       pr.dump_stats(os.path.join(self.params.output.output_dir, "cpu_%s_%d.prof"%(self.params.output.prefix, self.mpi_helper.rank)))
 
+  def materialize_experiments(self, summary):
+    '''Rebuild experiment models from an experiment summary, reporting the time and memory it takes'''
+    self.mpi_logger.log_step_time("MATERIALIZE_EXPERIMENTS")
+    self.mpi_logger.log("Materializing %d experiments from a %.1f MB experiment summary"%(len(summary), summary.nbytes/1024**2))
+    self.mpi_logger.log("Memory usage before materializing experiments: %d MB"%get_memory_usage())
+    experiments = summary.to_experiment_list()
+    self.mpi_logger.log("Memory usage after materializing experiments: %d MB"%get_memory_usage())
+    self.mpi_logger.log_step_time("MATERIALIZE_EXPERIMENTS", True)
+    return experiments
+
   def _resolve_persistent_columns(self):
     if self.params.output.expanded_bookkeeping:
       if self.params.input.persistent_refl_cols is None:
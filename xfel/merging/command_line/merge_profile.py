@@ -0,0 +1,178 @@
+from __future__ import absolute_import, division, print_function
+# LIBTBX_SET_DISPATCHER_NAME cctbx.xfel.merge_profile
+
+import csv, glob, json, os, re, sys
+import numpy as np
+
+help_message = """
+Summarize the per-step, per-rank profiles written by cctbx.xfel.merge with mp.debug.profile_steps=True into a
+load-imbalance report. For every step, the compute time of a rank is its wall time minus the time it spent in MPI
+collectives, i.e. waiting for the other ranks. The rank with the longest compute time is the straggler of the step,
+and the difference between its compute time and the mean over ranks is the time the other ranks lose waiting for it.
+
+Profiles of different runs in the same directory, i.e. with a different output prefix or number of ranks, are
+reported separately; --prefix selects the runs written with one output prefix.
+
+Usage: cctbx.xfel.merge_profile <output directory or profile_*.json files> [--prefix P] [--csv summary.csv] [--top N]
+"""
+
+profile_file_pattern = re.compile(r'^(?:(?P<prefix>.*)_)?profile_(?P<size>\d{6})_(?P<rank>\d{6})\.json$')
+
+def find_profile_files(paths, prefix=None):
+  '''
+  Group the profile files by run: a run is identified by its directory, output prefix and number of ranks, as
+  in <prefix>_profile_<size>_<rank>.json. If prefix is given, only the runs with that output prefix are returned.
+  Returns a list of ((directory, prefix, size), files) sorted by run.
+  '''
+  candidates = []
+  for path in paths:
+    if os.path.isdir(path):
+      candidates.extend(sorted(glob.glob(os.path.join(path, '*profile_[0-9]*_[0-9]*.json'))))
+    else:
+      candidates.append(path)
+  runs = {}
+  for file_path in candidates:
+    match = profile_file_pattern.match(os.path.basename(file_path))
+    if match is None:
+      print("Warning: skipping %s, which is not named like <prefix>_profile_<size>_<rank>.json"%file_path)
+      continue
+    run_prefix = match.group('prefix') or ""
+    if prefix is not None and run_prefix != prefix:
+      continue
+    key = (os.path.dirname(os.path.abspath(file_path)), run_prefix, int(match.group('size')))
+    runs.setdefault(key, []).append(file_path)
+  return sorted(runs.items())
+
+def load_profiles(files):
+  '''Return the rank profiles, sorted by rank, and check that all ranks ran the same steps'''
+  profiles = []
+  for file_path in files:
+    with open(file_path) as f:
+      profiles.append(json.load(f))
+  profiles.sort(key=lambda profile: profile['rank'])
+  assert len(profiles) > 0, "No profile files found"
+  steps = [(record['step'], record['name']) for record in profiles[0]['steps']]
+  for profile in profiles:
+    assert [(record['step'], record['name']) for record in profile['steps']] == steps, \
+      "Rank %d ran different steps than rank %d"%(profile['rank'], profiles[0]['rank'])
+  if len(profiles) != profiles[0]['size']:
+    print("Warning: found profiles of %d ranks out of %d"%(len(profiles), profiles[0]['size']))
+  return profiles
+
+def summarize_steps(profiles):
+  '''Per-step statistics over ranks'''
+  ranks = np.array([profile['rank'] for profile in profiles])
+  summaries = []
+  for i_step, first_record in enumerate(profiles[0]['steps']):
+    records = [profile['steps'][i_step] for profile in profiles]
+    def column(key):
+      return np.array([record[key] for record in records], dtype=float)
+    wall = column('wall_time')
+    compute = wall - column('collective_time')
+    i_straggler = int(np.argmax(compute))
+    summaries.append(dict(
+      step = first_record['step'],
+      name = first_record['name'],
+      wall_max = wall.max(),
+      compute_min = compute.min(),
+      compute_mean = compute.mean(),
+      compute_max = compute.max(),
+      imbalance = compute.max() / compute.mean() if compute.mean() > 0 else 1.0,
+      lost_time = compute.max() - compute.mean(),
+      straggler_rank = int(ranks[i_straggler]),
+      straggler_reflections_in = int(records[i_straggler]['reflections_in']),
+      mean_reflections_in = column('reflections_in').mean(),
+      cpu_to_wall = column('cpu_time').sum() / wall.sum() if wall.sum() > 0 else 0.0,
+      collectives = int(column('collectives').max()),
+      collective_mb = column('collective_bytes').sum() / 1024**2,
+      peak_rss_mb = column('peak_rss_mb').max(),
+      peak_rss_delta_mb = column('peak_rss_delta_mb').max(),
+      reflections_in = int(column('reflections_in').sum()),
+      reflections_out = int(column('reflections_out').sum()),
+    ))
+  return summaries
+
+def summarize_ranks(profiles, summaries):
+  '''Per-rank compute time summed over the steps and its excess over the per-step means'''
+  rank_summaries = []
+  for profile in profiles:
+    compute = np.array([record['wall_time'] - record['collective_time'] for record in profile['steps']])
+    excess = compute - np.array([summary['compute_mean'] for summary in summaries])
+    rank_summaries.append(dict(rank = profile['rank'],
+                               compute = compute.sum(),
+                               excess = excess.sum(),
+                               straggler_steps = sum(summary['straggler_rank'] == profile['rank'] for summary in summaries),
+                               peak_rss_mb = max([record['peak_rss_mb'] for record in profile['steps']] or [0])))
+  return sorted(rank_summaries, key=lambda rank_summary: rank_summary['excess'], reverse=True)
+
+def format_report(profiles, summaries, rank_summaries, top=5):
+  lines = ["Step profile of %d ranks"%len(profiles), ""]
+  header = "%4s %-32s %9s %9s %9s %6s %9s %9s %12s %6s %10s %9s"%(
+    "Step", "Name", "Wall", "Cmp mean", "Cmp max", "Imbal", "Lost", "Straggler", "Refls (s/avg)", "Coll", "Coll MB", "RSS MB")
+  lines.append(header)
+  lines.append("-" * len(header))
+  for s in summaries:
+    lines.append("%4d %-32s %9.2f %9.2f %9.2f %6.2f %9.2f %9d %6d/%-6d %5d %10.1f %9.0f"%(
+      s['step'], s['name'][:32], s['wall_max'], s['compute_mean'], s['compute_max'], s['imbalance'], s['lost_time'],
+      s['straggler_rank'], s['straggler_reflections_in'], int(round(s['mean_reflections_in'])), s['collectives'],
+      s['collective_mb'], s['peak_rss_mb']))
+  lines.append("")
+
+  if summaries:
+    worst = max(summaries, key=lambda s: s['lost_time'])
+    lines.append("Most time lost to load imbalance: step %d (%s), %.2f s, straggler rank %d"%(
+      worst['step'], worst['name'], worst['lost_time'], worst['straggler_rank']))
+    lines.append("Total time lost to load imbalance: %.2f s"%sum(s['lost_time'] for s in summaries))
+    lines.append("")
+
+  lines.append("Slowest ranks (compute time in excess of the per-step mean, summed over steps):")
+  lines.append("%6s %12s %12s %16s %9s"%("Rank", "Compute (s)", "Excess (s)", "Straggler steps", "RSS MB"))
+  for r in rank_summaries[:top]:
+    lines.append("%6d %12.2f %12.2f %16d %9.0f"%(r['rank'], r['compute'], r['excess'], r['straggler_steps'], r['peak_rss_mb']))
+  return "\n".join(lines)
+
+def write_csv(file_path, summaries):
+  with open(file_path, 'w') as f:
+    writer = csv.DictWriter(f, fieldnames=list(summaries[0].keys()) if summaries else ['step'])
+    writer.writeheader()
+    writer.writerows(summaries)
+
+def run(args):
+  if not args or '-h' in args or '--help' in args:
+    print(help_message)
+    return
+  csv_path = None
+  top = 5
+  prefix = None
+  paths = []
+  args = list(args)
+  while args:
+    arg = args.pop(0)
+    if arg == '--csv':
+      csv_path = args.pop(0)
+    elif arg == '--top':
+      top = int(args.pop(0))
+    elif arg == '--prefix':
+      prefix = args.pop(0)
+    else:
+      paths.append(arg)
+
+  runs = find_profile_files(paths, prefix=prefix)
+  assert len(runs) > 0, "No profile files found"
+  for i_run, ((directory, run_prefix, size), files) in enumerate(runs):
+    if len(runs) > 1:
+      print("%sRun %s with %d ranks in %s"%("\n" if i_run > 0 else "", run_prefix or "without prefix", size, directory))
+    profiles = load_profiles(files)
+    summaries = summarize_steps(profiles)
+    rank_summaries = summarize_ranks(profiles, summaries)
+    print(format_report(profiles, summaries, rank_summaries, top=top))
+    if csv_path:
+      run_csv_path = csv_path
+      if len(runs) > 1:
+        root, ext = os.path.splitext(csv_path)
+        run_csv_path = "%s_%s%06d%s"%(root, run_prefix + "_" if run_prefix else "", size, ext)
+      write_csv(run_csv_path, summaries)
+      print("\nWrote step summary to %s"%run_csv_path)
+
+if __name__ == '__main__':
+  run(sys.argv[1:])
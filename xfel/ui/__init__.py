@@ -123,6 +123,22 @@ db {
   logging_batch_size = 3
     .type = int
     .help = Number of images to log at once. Increase if using many (thousands) of processors.
+  pool_size = 4
+    .type = int
+    .expert_level = 2
+    .help = Number of idle database connections each process keeps open for reuse, shared by all its threads. \
+            Queries that find no idle connection open a new one.
+  replica {
+    host = None
+      .type = str
+      .expert_level = 2
+      .help = Host name of a read-only replica of the database. If set, the monitoring threads of the GUI send \
+              their read-only queries to the replica, taking load off the main server.
+    port = None
+      .type = int
+      .expert_level = 2
+      .help = Port number of the replica. Defaults to db.port.
+  }
   server {
     basedir = None
       .type = path
@@ -37,9 +37,9 @@ def run(args):
   ratio_cutoff = 1
 
   app = xfel_db_application(params)
+  trial = app.get_trial(trial_number=params.trial)
 
   if params.run is None or len(params.run) == 0:
-    trial = app.get_trial(trial_number=params.trial)
     runs = []
     run_ids = []
     rungroups = []
@@ -58,27 +58,43 @@ def run(args):
     runs = params.run
     assert params.rungroup is not None
     rungroups = [params.rungroup] * len(runs)
+    run_ids = []
+    for run_no in runs:
+      try:
+        run_ids.append(app.get_run(run_number=run_no).id)
+      except Exception as e:
+        run_ids.append(None)
+
+  # Count the events of every run and rungroup in one query, so that runs without events skip the per-event queries
+  keys, counts = app.count_events_by(('run', 'rungroup'), trial=trial, only_indexed=False)
+  n_events = {(run_id, rungroup_id): count for (run_id, rungroup_id), count in zip(keys.tolist(), counts.tolist())}
 
-  for run_no, rungroup_id in sorted(zip(runs, rungroups), key=lambda x: x[0]):
+  for run_no, run_id, rungroup_id in sorted(zip(runs, run_ids, rungroups), key=lambda x: x[0]):
     if params.rungroup and params.rungroup != rungroup_id: continue
-    try:
-      timestamps, two_theta_low, two_theta_high, n_strong, average_i_sigi, n_lattices = HitrateStats(app, run_no, params.trial, rungroup_id, params.d_min, params.i_sigi_cutoff)()
-    except Exception as e:
+    if run_id is None:
       print("Couldn't get run", run_no)
       continue
+    if n_events.get((run_id, rungroup_id), 0) == 0:
+      n_drop_hits = n_hit = n_indexed = n_lattices = n_high_quality = n_total = 0
+    else:
+      try:
+        timestamps, two_theta_low, two_theta_high, n_strong, average_i_sigi, n_lattices = HitrateStats(app, run_no, params.trial, rungroup_id, params.d_min, params.i_sigi_cutoff)()
+      except Exception as e:
+        print("Couldn't get run", run_no)
+        continue
 
-    n_hit = (n_strong >= params.n_strong_cutoff).count(True)
-    n_indexed = (n_lattices > 0).count(True)
-    n_lattices = flex.sum(n_lattices)
-    n_total = len(timestamps)
-    n_high_quality = ((average_i_sigi > 0) & (n_strong >= params.n_strong_cutoff)).count(True)
+      n_hit = (n_strong >= params.n_strong_cutoff).count(True)
+      n_indexed = (n_lattices > 0).count(True)
+      n_lattices = flex.sum(n_lattices)
+      n_total = len(timestamps)
+      n_high_quality = ((average_i_sigi > 0) & (n_strong >= params.n_strong_cutoff)).count(True)
 
-    invalid = (two_theta_low <= 0) or (two_theta_high < 0) # <= to prevent /0
-    numerator = two_theta_high.set_selected(invalid, 0)
-    denominator = two_theta_low.set_selected(two_theta_low == 0, 1) # prevent /0
-    drop_ratios = numerator/denominator
-    drop_hits = drop_ratios >= ratio_cutoff
-    n_drop_hits = drop_hits.count(True)
+      invalid = (two_theta_low <= 0) or (two_theta_high < 0) # <= to prevent /0
+      numerator = two_theta_high.set_selected(invalid, 0)
+      denominator = two_theta_low.set_selected(two_theta_low == 0, 1) # prevent /0
+      drop_ratios = numerator/denominator
+      drop_hits = drop_ratios >= ratio_cutoff
+      n_drop_hits = drop_hits.count(True)
 
     try:
       print("% 20s      % 7d % 5.1f  % 7d % 5.1f   % 7d % 5.1f    % 7d     % 7d % 5.1f % 5.1f    % 7d " % (run_no, n_drop_hits, 100*n_drop_hits/n_total, n_hit, 100*n_hit/n_total, n_indexed, 100*n_indexed/n_total, n_lattices, n_high_quality, 100*n_high_quality/n_total, 100*n_high_quality/n_indexed, n_total))
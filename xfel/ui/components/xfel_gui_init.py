@@ -30,6 +30,7 @@ import xfel.ui.components.xfel_gui_plotter as pltr
 from xfel.ui import load_cached_settings, save_cached_settings
 from xfel.ui.db import get_run_path
 from xfel.ui.db.xfel_db import xfel_db_application
+from xfel.ui.db.stats import CellBinSummary
 
 from prime.postrefine.mod_gui_frames import PRIMEInputWindow, PRIMERunWindow
 from prime.postrefine.mod_input import master_phil
@@ -443,6 +444,7 @@ class ProgressSentinel(Thread):
     self.number_of_pickles = 0
     self.info = {}
     self.noiso_cells = []
+    self.summary = None # cell x bin counts, updated from the events logged since the previous poll
 
     # on initialization (and restart), make sure stats drawn from scratch
     self.parent.run_window.status_tab.redraw_windows = True
@@ -454,7 +456,7 @@ class ProgressSentinel(Thread):
   def run(self):
     # one time post for an initial update
     self.post_refresh()
-    db = xfel_db_application(self.parent.params)
+    db = xfel_db_application(self.parent.params, read_replica = True)
 
     while self.active:
       try:
@@ -468,7 +470,10 @@ class ProgressSentinel(Thread):
 
           tags = self.parent.run_window.status_tab.selected_tags
           tag_ids = [tag.id for tag in tags]
-          cells = db.get_stats(trial=trial, tags=tags, isigi_cutoff = self.parent.run_window.status_tab.isigi_cutoff)()
+          isigi_cutoff = self.parent.run_window.status_tab.isigi_cutoff
+          if self.summary is None or (self.summary.trial_id, self.summary.isigi_cutoff) != (trial.id, isigi_cutoff):
+            self.summary = CellBinSummary(db, trial, isigi_cutoff)
+          cells = db.get_stats(trial=trial, tags=tags, isigi_cutoff = isigi_cutoff, summary = self.summary)()
 
           if self.parent.run_window.status_tab.tag_trial_changed:
             self.parent.run_window.status_tab.redraw_windows = True
@@ -488,7 +493,10 @@ class ProgressSentinel(Thread):
                   run_numbers.append(run.run)
                   runs.append(run)
           if not trial_has_isoforms:
-            n_img = len(db.get_all_events(trial, runs))
+            n_img = db.count_events(trial, runs)
+          else:
+            isoform_ids, isoform_counts = db.count_events_by('isoform', trial = trial, runs = runs)
+            n_img_by_isoform = dict(zip(isoform_ids.tolist(), isoform_counts.tolist()))
 
           for cell in cells:
             # Check for cell isoform
@@ -525,7 +533,7 @@ class ProgressSentinel(Thread):
               else:
                 process_percent = trial.process_percent
 
-              n_img = len(db.get_all_events(trial, runs, isoform = cell.isoform))
+              n_img = n_img_by_isoform.get(cell.isoform.id, 0)
 
               # Generate multiplicity graph for isoforms
               mult_all = sum(counts_all) / sum(totals_all) / (process_percent / 100)
@@ -602,6 +610,7 @@ class RunStatsSentinel(Thread):
     self.stats = []
     self.run_tags = []
     self.run_statuses = []
+    self.summaries = {} # per-event hit rate rows by run, updated from the events logged since the previous poll
 
   def post_refresh(self):
     evt = RefreshRunStats(tp_EVT_RUNSTATS_REFRESH, -1, self.info)
@@ -610,7 +619,7 @@ class RunStatsSentinel(Thread):
   def run(self):
     # one time post for an initial update
     self.post_refresh()
-    self.db = xfel_db_application(self.parent.params)
+    self.db = xfel_db_application(self.parent.params, read_replica = True)
 
     while self.active:
       try:
@@ -629,7 +638,7 @@ class RunStatsSentinel(Thread):
 
   def refresh_stats(self):
     #from xfel.ui.components.timeit import duration
-    from xfel.ui.db.stats import HitrateStats
+    from xfel.ui.db.stats import HitrateStats, HitrateSummary
     import copy, time
     t1 = time.time()
     if self.parent.run_window.runstats_tab.trial_no is not None:
@@ -643,6 +652,9 @@ class RunStatsSentinel(Thread):
       self.trgr = {}
       self.run_tags = []
       self.run_statuses = []
+      i_sigi_cutoff = self.parent.run_window.runstats_tab.i_sigi
+      d_min = self.parent.run_window.runstats_tab.d_min
+      summaries = {}
       for rg in trial.rungroups:
         for run in rg.runs:
           if run.run not in self.run_numbers and run.run in selected_runs:
@@ -650,10 +662,14 @@ class RunStatsSentinel(Thread):
             trial_ids.append(trial.id)
             rungroup_ids.append(rg.id)
             self.trgr[run.run] = (trial, rg, run)
+            key = (trial.id, run.id, rg.id, d_min, i_sigi_cutoff)
+            summaries[key] = self.summaries.get(key) or HitrateSummary(self.db, *key)
             self.stats.append(HitrateStats(self.db, run.run, trial.trial, rg.id,
-                                           i_sigi_cutoff=self.parent.run_window.runstats_tab.i_sigi,
-                                           d_min=self.parent.run_window.runstats_tab.d_min)())
+                                           i_sigi_cutoff=i_sigi_cutoff,
+                                           d_min=d_min,
+                                           summary=summaries[key])())
             self.run_tags.append([tag.name for tag in run.tags])
+      self.summaries = summaries # drop the summaries of runs no longer shown
 
       jobs = self.db.get_all_jobs()
       for idx in range(len(self.run_numbers)):
@@ -793,7 +809,7 @@ class SpotfinderSentinel(Thread):
   def run(self):
     # one time post for an initial update
     self.post_refresh()
-    self.db = xfel_db_application(self.parent.params)
+    self.db = xfel_db_application(self.parent.params, read_replica = True)
 
     while self.active:
       try:
@@ -912,6 +928,7 @@ class UnitCellSentinel(Thread):
     Thread.__init__(self)
     self.parent = parent
     self.active = active
+    self.summary = None # cell x bin counts, updated from the events logged since the previous poll
 
   def post_refresh(self):
     evt = RefreshUnitCell(tp_EVT_UNITCELL_REFRESH, -1)
@@ -931,7 +948,7 @@ class UnitCellSentinel(Thread):
 
     # one time post for an initial update
     self.post_refresh()
-    self.db = xfel_db_application(self.parent.params)
+    self.db = xfel_db_application(self.parent.params, read_replica = True)
 
     while self.active:
       try:
@@ -944,10 +961,13 @@ class UnitCellSentinel(Thread):
         legend_list = []
         for tag_set in tag_sets:
           legend_list.append(str(tag_set))
+          if self.summary is None or self.summary.trial_id != trial.id:
+            self.summary = CellBinSummary(self.db, trial, isigi_cutoff=1.0)
           cells = self.db.get_stats(trial=trial,
                                     tags=tag_set.tags,
                                     isigi_cutoff=1.0,
-                                    tag_selection_mode=tag_set.mode)()
+                                    tag_selection_mode=tag_set.mode,
+                                    summary=self.summary)()
           info = []
           for cell in cells:
             info.append({'a':cell.cell_a,
@@ -1061,7 +1081,7 @@ class FramesSentinel(Thread):
   def run(self):
     # one time post for an initial update
     self.post_refresh()
-    db = xfel_db_application(self.parent.parent.params)
+    db = xfel_db_application(self.parent.parent.params, read_replica = True)
 
     while self.active:
       try:
@@ -1072,7 +1092,7 @@ class FramesSentinel(Thread):
           runs = None
         else:
           print("runs", ", ".join(sorted([str(r.run) for r in runs])), end=' ')
-        print(":", len(db.get_all_events(trial, runs)))
+        print(":", db.count_events(trial, runs))
         self.post_refresh()
         time.sleep(2)
       except Exception as e:
@@ -1215,7 +1235,7 @@ class MergingStatsSentinel(Thread):
   def run(self):
     # one time post for an initial update
     self.post_refresh()
-    self.db = xfel_db_application(self.parent.params)
+    self.db = xfel_db_application(self.parent.params, read_replica = True)
 
     while self.active:
       try:
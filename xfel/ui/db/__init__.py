@@ -1,8 +1,11 @@
 from __future__ import absolute_import, division, print_function
 from libtbx.utils import Sorry
-import six
+import six, threading, time
 from six.moves import zip
 
+# Idle connections older than this many seconds are not reused
+CACHED_CONNECT_TIMEOUT = 300
+
 try:
   import MySQLdb
 except ImportError as e:
@@ -58,12 +61,18 @@ def write_xtc_locator(locator_path, params, run, rungroup):
 
   locator.close()
 
-def get_db_connection(params, block=True, autocommit=True):
+def get_db_connection(params, block=True, autocommit=True, replica=False):
   if params.db.password is None:
     password = ""
   else:
     password = params.db.password
 
+  host, port = params.db.host, params.db.port
+  if replica:
+    host = params.db.replica.host
+    if params.db.replica.port is not None:
+      port = params.db.replica.port
+
   retry_count = 0
   retry_max = 20
   sleep_time = 0.1
@@ -72,9 +81,9 @@ def get_db_connection(params, block=True, autocommit=True):
       dbobj=MySQLdb.connect(
           passwd=password,
           user=params.db.user,
-          host=params.db.host,
+          host=host,
           db=params.db.name,
-          port=params.db.port,
+          port=port,
           autocommit=autocommit
       )
       return dbobj
@@ -94,6 +103,96 @@ def get_db_connection(params, block=True, autocommit=True):
       sleep_time *= 2
   raise Sorry("Couldn't execute connect to MySQL. Too many reconnects.")
 
+def close_quietly(dbobj):
+  try:
+    dbobj.close()
+  except Exception:
+    pass
+
+class connection_pool(object):
+  """
+  A thread-safe pool of connections to one database server, shared by all the db_applications and threads of a
+  process that connect with the same parameters. A connection is taken from the pool for one query or transaction
+  and given back afterwards. At most size idle connections are kept, and idle connections older than max_idle_time
+  seconds are closed instead of reused, as the server may have dropped them. The pool also counts the connections it
+  opens and the queries run on them, for the verbose timing output.
+  """
+  def __init__(self, params, autocommit = True, replica = False, size = 4, max_idle_time = CACHED_CONNECT_TIMEOUT):
+    self.params = params
+    self.autocommit = autocommit
+    self.replica = replica
+    self.size = size
+    self.max_idle_time = max_idle_time
+    self.lock = threading.Lock()
+    self.idle = [] # (connection, time it was returned)
+    self.n_opened = 0
+    self.n_in_use = 0
+    self.max_in_use = 0
+    self.n_queries = 0
+    self.query_time = 0
+    self.max_query_time = 0
+
+  def acquire(self):
+    with self.lock:
+      self.n_in_use += 1
+      self.max_in_use = max(self.max_in_use, self.n_in_use)
+      while len(self.idle) > 0:
+        dbobj, returned = self.idle.pop()
+        if time.time() - returned < self.max_idle_time:
+          return dbobj
+        close_quietly(dbobj)
+    try:
+      dbobj = get_db_connection(self.params, autocommit=self.autocommit, replica=self.replica)
+    except Exception:
+      with self.lock:
+        self.n_in_use -= 1
+      raise
+    with self.lock:
+      self.n_opened += 1
+    return dbobj
+
+  def release(self, dbobj, keep = True, query_time = None):
+    ''' Give a connection back. Connections that are broken, or not to be kept (keep=False), are closed. '''
+    with self.lock:
+      self.n_in_use -= 1
+      if query_time is not None:
+        self.n_queries += 1
+        self.query_time += query_time
+        self.max_query_time = max(self.max_query_time, query_time)
+      if keep and len(self.idle) < self.size:
+        self.idle.append((dbobj, time.time()))
+        return
+    close_quietly(dbobj)
+
+  def stats(self):
+    with self.lock:
+      return "%s%s: %d connections opened, %d in use (max %d), %d idle, %d queries, mean %.4f s, max %.4f s"%(
+        "replica " if self.replica else "", "autocommit" if self.autocommit else "transactions", self.n_opened,
+        self.n_in_use, self.max_in_use, len(self.idle), self.n_queries,
+        self.query_time / self.n_queries if self.n_queries > 0 else 0, self.max_query_time)
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(params, autocommit = True, replica = False):
+  ''' The connection pool of this process for the database server of params (or its replica) '''
+  if replica:
+    host, port = params.db.replica.host, params.db.replica.port or params.db.port
+  else:
+    host, port = params.db.host, params.db.port
+  key = (host, port, params.db.name, params.db.user, autocommit)
+  with _connection_pools_lock:
+    pool = _connection_pools.get(key)
+    if pool is None:
+      pool = _connection_pools[key] = connection_pool(params, autocommit = autocommit, replica = replica,
+                                                      size = getattr(params.db, 'pool_size', 4))
+  return pool
+
+def connection_pool_stats():
+  with _connection_pools_lock:
+    pools = list(_connection_pools.values())
+  return [pool.stats() for pool in pools]
+
 class db_proxy(object):
   def __init__(self, app, table_name, id = None, **kwargs):
     self._db_dict = {}
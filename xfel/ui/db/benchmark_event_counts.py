@@ -0,0 +1,141 @@
+from __future__ import absolute_import, division, print_function
+
+"""
+Benchmark of the aggregate event queries of xfel_db_application (count_events, count_events_by and
+get_event_columns) against counting the Event objects built by get_all_events. The database is an in-memory SQLite
+stand-in for the MySQL schema, holding only the tables and columns these queries touch, filled with synthetic
+events, so the benchmark runs without a database server. Usage:
+
+  libtbx.python benchmark_event_counts.py [n_events]
+"""
+
+import sqlite3, sys, time
+from types import SimpleNamespace
+import numpy as np
+
+from xfel.ui.db.xfel_db import xfel_db_application, dummy_cursor
+
+tables = {
+  'trial':          ['trial INT'],
+  'rungroup':       ['active BOOLEAN'],
+  'run':            ['run TEXT'],
+  'event':          ['timestamp TEXT', 'run_id INT', 'trial_id INT', 'rungroup_id INT', 'n_strong INT',
+                     'two_theta_low DOUBLE', 'two_theta_high DOUBLE'],
+  'imageset':       [],
+  'imageset_event': ['imageset_id INT', 'event_id INT', 'event_run_id INT'],
+  'experiment':     ['imageset_id INT', 'crystal_id INT'],
+  'crystal':        ['cell_id INT'],
+  'isoform':        ['name TEXT', 'trial_id INT'],
+  'cell':           ['cell_a DOUBLE', 'isoform_id INT'],
+  'bin':            ['cell_id INT', 'd_min DOUBLE', 'd_max DOUBLE'],
+}
+
+class sqlite_db_application(xfel_db_application):
+  '''An xfel_db_application whose queries run against an in-memory SQLite database'''
+  def __init__(self, params):
+    self.params = params
+    self.mode = 'execute'
+    self.connection = sqlite3.connect(':memory:')
+    tag = params.experiment_tag
+    for name, columns in tables.items():
+      id_column = [] if name == 'imageset_event' else ['id INTEGER PRIMARY KEY']
+      self.connection.execute("CREATE TABLE `%s_%s` (%s)"%(tag, name, ", ".join(id_column + columns)))
+    self.connection.execute("CREATE INDEX event_run ON `%s_event` (trial_id, run_id, rungroup_id)"%tag)
+    self.connection.execute("CREATE INDEX is_e_event ON `%s_imageset_event` (event_id)"%tag)
+    self.connection.execute("CREATE INDEX expt_imageset ON `%s_experiment` (imageset_id)"%tag)
+    self.columns_dict = {"%s_%s"%(tag, name): [c.split()[0] for c in columns] for name, columns in tables.items()}
+
+  def execute_query(self, query, commit=True):
+    return dummy_cursor(self.connection.execute(query))
+
+  def stream_query(self, query, chunk_size = 10000):
+    cursor = self.connection.execute(query)
+    while True:
+      rows = cursor.fetchmany(chunk_size)
+      if len(rows) == 0:
+        return
+      yield rows
+
+  def fill(self, n_events, n_runs, n_isoforms, indexed_fraction=0.3, seed=0):
+    '''Synthetic events spread over runs, a fraction of them indexed with one lattice each, whose cells are
+       assigned to the isoforms or left without one'''
+    tag = self.params.experiment_tag
+    rng = np.random.default_rng(seed)
+    db = self.connection
+    db.execute("INSERT INTO `%s_trial` (id, trial) VALUES (1, 1)"%tag)
+    db.execute("INSERT INTO `%s_rungroup` (id, active) VALUES (1, 1)"%tag)
+    db.executemany("INSERT INTO `%s_run` (id, run) VALUES (?, ?)"%tag, [(i, str(i)) for i in range(1, n_runs + 1)])
+    db.executemany("INSERT INTO `%s_isoform` (id, name, trial_id) VALUES (?, ?, 1)"%tag,
+                   [(i, "isoform_%d"%i) for i in range(1, n_isoforms + 1)])
+    run_ids = rng.integers(1, n_runs + 1, n_events)
+    db.executemany("INSERT INTO `%s_event` (id, timestamp, run_id, trial_id, rungroup_id, n_strong, two_theta_low, two_theta_high) VALUES (?, ?, ?, 1, 1, ?, ?, ?)"%tag,
+                   [(i + 1, "%020d"%i, int(run_ids[i]), int(n), float(l), float(h)) for i, (n, l, h) in
+                    enumerate(zip(rng.integers(0, 200, n_events), rng.random(n_events), rng.random(n_events)))])
+    indexed = np.flatnonzero(rng.random(n_events) < indexed_fraction) + 1
+    isoform_ids = rng.integers(0, n_isoforms + 1, len(indexed))
+    rows = [(int(i), int(e)) for i, e in enumerate(indexed, 1)]
+    db.executemany("INSERT INTO `%s_imageset` (id) VALUES (?)"%tag, [(i,) for i, e in rows])
+    db.executemany("INSERT INTO `%s_imageset_event` (imageset_id, event_id, event_run_id) VALUES (?, ?, ?)"%tag,
+                   [(i, e, int(run_ids[e - 1])) for i, e in rows])
+    db.executemany("INSERT INTO `%s_cell` (id, cell_a, isoform_id) VALUES (?, 79.1, ?)"%tag,
+                   [(i, int(isoform_ids[i - 1]) or None) for i, e in rows])
+    db.executemany("INSERT INTO `%s_crystal` (id, cell_id) VALUES (?, ?)"%tag, [(i, i) for i, e in rows])
+    db.executemany("INSERT INTO `%s_experiment` (id, imageset_id, crystal_id) VALUES (?, ?, ?)"%tag,
+                   [(i, i, i) for i, e in rows])
+    db.commit()
+
+def timed(function, *args, **kwargs):
+  start = time.time()
+  result = function(*args, **kwargs)
+  return result, time.time() - start
+
+def run(args):
+  n_events = int(args[0]) if len(args) > 0 else 200000
+  n_runs, n_isoforms = 20, 3
+  params = SimpleNamespace(experiment_tag='bench', db=SimpleNamespace(verbose=False))
+  app = sqlite_db_application(params)
+  app.fill(n_events, n_runs, n_isoforms)
+
+  rungroup = SimpleNamespace(id=1)
+  runs = [SimpleNamespace(id=i, run=str(i)) for i in range(1, n_runs + 1)]
+  isoforms = [SimpleNamespace(id=i) for i in range(1, n_isoforms + 1)]
+  trial = SimpleNamespace(id=1, trial=1, runs=runs, rungroups=[rungroup], isoforms=isoforms)
+  print("Benchmark of event counting on %d events, %d runs and %d isoforms (SQLite stand-in)"%(n_events, n_runs, n_isoforms))
+  print("%-44s %10s %10s %8s"%("Query", "Objects", "Aggregate", "Speedup"))
+
+  def report(name, t_objects, t_aggregate):
+    print("%-44s %9.3fs %9.3fs %7.1fx"%(name, t_objects, t_aggregate, t_objects / max(t_aggregate, 1e-9)))
+
+  n_old, t_old = timed(lambda: len(app.get_all_events(trial, runs)))
+  n_new, t_new = timed(app.count_events, trial, runs)
+  assert n_old == n_new, (n_old, n_new)
+  report("indexed events (%d)"%n_new, t_old, t_new)
+
+  n_old, t_old = timed(lambda: len(app.get_all_events(trial, runs, only_indexed=False)))
+  n_new, t_new = timed(app.count_events, trial, runs, only_indexed=False)
+  assert n_old == n_new, (n_old, n_new)
+  report("all events (%d)"%n_new, t_old, t_new)
+
+  old, t_old = timed(lambda: [len(app.get_all_events(trial, runs, isoform=isoform)) for isoform in isoforms])
+  (keys, counts), t_new = timed(app.count_events_by, 'isoform', trial, runs)
+  new = dict(zip(keys.tolist(), counts.tolist()))
+  assert old == [new.get(isoform.id, 0) for isoform in isoforms], (old, new)
+  report("indexed events per isoform", t_old, t_new)
+
+  def per_run_objects():
+    counts = {}
+    for event in app.get_all_events(trial, runs, only_indexed=False):
+      counts[event.run_id] = counts.get(event.run_id, 0) + 1
+    return counts
+  old, t_old = timed(per_run_objects)
+  (keys, counts), t_new = timed(app.count_events_by, 'run', trial, runs, only_indexed=False)
+  assert old == dict(zip(keys.tolist(), counts.tolist()))
+  report("events per run", t_old, t_new)
+
+  old, t_old = timed(lambda: np.array([e.n_strong for e in app.get_all_events(trial, runs, only_indexed=False)]))
+  new, t_new = timed(app.get_event_columns, ['n_strong'], trial, runs, only_indexed=False)
+  assert (np.sort(old) == np.sort(new['n_strong'])).all()
+  report("n_strong column", t_old, t_new)
+
+if __name__ == '__main__':
+  run(sys.argv[1:])
@@ -0,0 +1,240 @@
+from __future__ import absolute_import, division, print_function
+
+"""
+Benchmark of frame logging throughput: logs synthetic indexed frames to a database, first with the SQL string path
+of log_frame (one INSERT and one SELECT LAST_INSERT_ID() per row, in a single multi-statement query per batch), then
+with frame_log_batch (per-table multi-row inserts and executemany), and reports rows/s for both. Run it against a
+scratch database on a local server, for example:
+
+  libtbx.python benchmark_frame_logging.py db.host=localhost db.name=scratch db.user=me experiment_tag=bench \\
+    input.trial=1 input.run_num=1 n_frames=2000
+
+The trial and run must exist (create them with the XFEL GUI, or db.create_trial/create_run). All rows written are
+tagged with the given experiment tag, so use a tag that holds no real data.
+
+With --sqlite, neither a database server nor indexing results are needed: synthetic frame rows are logged to SQLite
+database files in a temporary directory, first one INSERT and one id query per row, as the SQL string path does, then
+with frame_log_batch.write. The benchmark checks that both databases hold the same rows. SQLite runs in process, so
+the per-row path pays no network round trips here, and the speedup is a lower bound of the one against a MySQL
+server. Only n_frames, n_lattices and batch_size apply, for example:
+
+  libtbx.python benchmark_frame_logging.py --sqlite n_frames=5000 batch_size=20
+"""
+
+import os, random, shutil, sqlite3, sys, tempfile, time
+from libtbx.phil import parse
+from xfel.ui import db_phil_str
+from xfel.ui.db.dxtbx_db import log_frame, frame_log_batch, row_ref, sql_value, dxtbx_xfel_db_application
+
+phil_str = """
+  input {
+    trial = None
+      .type = int
+    run_num = None
+      .type = str
+    rungroup = None
+      .type = int
+  }
+  n_frames = 1000
+    .type = int
+  n_lattices = 1
+    .type = int
+    .help = Number of experiments per frame
+  n_reflections = 500
+    .type = int
+    .help = Number of reflections per experiment
+  batch_size = None
+    .type = int
+    .help = Frames per transaction. Defaults to db.logging_batch_size.
+"""
+phil_scope = parse(phil_str + db_phil_str)
+
+def synthetic_frame(n_lattices, n_reflections, rng):
+  from dxtbx.model import BeamFactory, DetectorFactory, Crystal, ExperimentList, Experiment
+  from dials.array_family import flex
+  beam = BeamFactory.simple(1.3)
+  detector = DetectorFactory.simple('PAD', 150, (100, 100), '+x', '-y', (0.1, 0.1), (2000, 2000))
+  experiments = ExperimentList()
+  reflections = flex.reflection_table()
+  for i in range(n_lattices):
+    a, b, c = [rng.uniform(60, 120) for j in range(3)]
+    crystal = Crystal((a, 0, 0), (0, b, 0), (0, 0, c), space_group_symbol = 'P 21 21 21')
+    experiments.append(Experiment(beam = beam, detector = detector, crystal = crystal))
+    refls = flex.reflection_table()
+    refls['id'] = flex.int(n_reflections, i)
+    refls['miller_index'] = flex.miller_index([(rng.randint(1, 30), rng.randint(1, 30), rng.randint(1, 30))
+                                               for j in range(n_reflections)])
+    refls['intensity.sum.value'] = flex.double([rng.gauss(100, 200) for j in range(n_reflections)])
+    refls['intensity.sum.variance'] = flex.double([rng.uniform(1, 400) for j in range(n_reflections)])
+    reflections.extend(refls)
+  return experiments, reflections
+
+def log_with_sql_strings(app, params, frames, run, trial):
+  ''' The SQL string path: concatenated INSERTs with @variables, patched and sent as one query '''
+  inserts = "BEGIN;\n"
+  for experiments, reflections in frames:
+    inserts += log_frame(experiments, reflections, params, run, len(reflections), timestamp = "benchmark",
+                         app = app, trial = trial)
+  inserts += "COMMIT;\n"
+  newinserts = []
+  for line in inserts.split('\n'):
+    if '@' in line:
+      line = ' '.join([word.replace("'", "") if '@' in word else word for word in line.split(' ')])
+    newinserts.append(line)
+  app.execute_query('\n'.join(newinserts), commit=False)
+
+def log_with_batches(app, params, frames, run, trial):
+  batch = frame_log_batch(params)
+  for experiments, reflections in frames:
+    batch.add_frame(experiments, reflections, run, trial, len(reflections), timestamp = "benchmark")
+  return app.execute_transaction(batch.write)
+
+sqlite_tag = 'bench'
+
+def add_synthetic_frame(batch, rng, n_lattices, run_id = 1, trial_id = 1, n_bins = 10):
+  ''' Add the rows frame_log_batch.add_frame adds for a frame of n_lattices experiments, with random values '''
+  event = batch.add_row('event', timestamp = "%020d"%batch.n_frames, run_id = run_id, trial_id = trial_id,
+                        n_strong = rng.randint(0, 500), two_theta_low = None, two_theta_high = None)
+  batch.n_frames += 1
+  for i in range(n_lattices):
+    imageset = batch.add_row('imageset')
+    beam = batch.add_row('beam', direction_1 = 0., direction_2 = 0., direction_3 = -1., wavelength = 1.3)
+    detector = batch.add_row('detector', distance = 150.)
+    cell_columns = dict(('cell_%s'%key, rng.uniform(60, 120)) for key in ['a', 'b', 'c'])
+    cell_columns.update(cell_alpha = 90., cell_beta = 90., cell_gamma = 90., lookup_symbol = 'P 21 21 21')
+    cell = batch.add_row('cell', isoform_id = None, **cell_columns)
+    crystal_columns = dict(('ori_%d'%(j + 1), rng.uniform(-1, 1)) for j in range(9))
+    crystal = batch.add_row('crystal', cell_id = cell, mosaic_block_rotation = rng.uniform(0, 0.1),
+                            mosaic_block_size = rng.uniform(500, 5000), **crystal_columns)
+    batch.add_row('experiment', imageset_id = imageset, beam_id = beam, detector_id = detector,
+                  crystal_id = crystal, crystal_cell_id = cell)
+    batch.add_row('imageset_event', imageset_id = imageset, event_id = event, event_run_id = run_id)
+    for j in range(n_bins):
+      db_bin = batch.add_row('bin', number = j + 1, d_min = 2. + j, d_max = 3. + j, total_hkl = rng.randint(100, 2000),
+                             cell_id = cell)
+      n_refls = rng.randint(0, 50)
+      batch.add_row('cell_bin', count = n_refls, bin_id = db_bin, crystal_id = crystal,
+                    avg_intensity = rng.uniform(1, 1000) if n_refls > 0 else None,
+                    avg_sigma = rng.uniform(1, 30) if n_refls > 0 else None,
+                    avg_i_sigi = rng.uniform(0, 20) if n_refls > 0 else None)
+
+class sqlite_cursor(object):
+  ''' Runs the MySQLdb statements of frame_log_batch.write on an SQLite cursor '''
+  def __init__(self, cursor):
+    self.cursor = cursor
+    self.lastrowid = None
+    self.results = None
+
+  def execute(self, query, args = None):
+    if query == "SELECT @@auto_increment_increment":
+      self.results = [(1,)]
+      return
+    insert, values = query.split(" VALUES ", 1)
+    n_rows = values.count("(")
+    if insert.endswith(" ()"): # rows without columns
+      for i in range(n_rows):
+        self.cursor.execute(insert[:-3] + " DEFAULT VALUES")
+    else:
+      self.cursor.execute(query.replace("%s", "?"), args or ())
+    # SQLite reports the id of the last row of a multi-row INSERT, MySQL the id of the first one
+    self.lastrowid = self.cursor.lastrowid - (n_rows - 1)
+
+  def executemany(self, query, values):
+    self.cursor.executemany(query.replace("%s", "?"), values)
+
+  def fetchall(self):
+    return self.results
+
+def write_row_by_row(batch, cursor):
+  ''' The statements of the SQL string path of log_frame: one INSERT per row, each followed by a query of its id '''
+  ids = {}
+  for table, has_ids in batch.tables:
+    ids[table] = []
+    for row in batch.rows[table]:
+      keys = list(row)
+      values = [ids[v.table][v.index] if isinstance(v, row_ref) else sql_value(v) for v in row.values()]
+      if len(keys) > 0:
+        cursor.execute("INSERT INTO `%s_%s` (%s) VALUES (%s)"%(sqlite_tag, table, ", ".join(keys), ", ".join(["?"] * len(keys))),
+                       values)
+      else:
+        cursor.execute("INSERT INTO `%s_%s` DEFAULT VALUES"%(sqlite_tag, table))
+      ids[table].append(cursor.execute("SELECT last_insert_rowid()").fetchone()[0])
+  return len(batch)
+
+def create_database(path, batch):
+  connection = sqlite3.connect(path)
+  for table, has_ids in batch.tables:
+    columns = list(batch.rows[table][0]) if len(batch.rows[table]) > 0 else []
+    connection.execute("CREATE TABLE `%s_%s` (%s)"%(sqlite_tag, table, ", ".join((['id INTEGER PRIMARY KEY'] if has_ids else []) + columns)))
+  connection.commit()
+  return connection
+
+def run_sqlite(params):
+  n_frames, n_lattices = params.n_frames, params.n_lattices
+  batch_size = params.batch_size or params.db.logging_batch_size
+  params.experiment_tag = sqlite_tag
+  params.input.rungroup = None
+
+  rng = random.Random(0)
+  batches = []
+  for start in range(0, n_frames, batch_size):
+    batch = frame_log_batch(params)
+    for i in range(min(batch_size, n_frames - start)):
+      add_synthetic_frame(batch, rng, n_lattices)
+    batches.append(batch)
+  n_rows = sum(len(batch) for batch in batches)
+  print("Logging %d frames of %d lattices, %d rows, in transactions of %d frames (SQLite %s)"%(
+    n_frames, n_lattices, n_rows, batch_size, sqlite3.sqlite_version))
+
+  directory = tempfile.mkdtemp()
+  try:
+    contents = []
+    for name, write in [("Row by row", lambda batch, cursor: write_row_by_row(batch, cursor)),
+                        ("Batched inserts", lambda batch, cursor: batch.write(sqlite_cursor(cursor)))]:
+      connection = create_database(os.path.join(directory, "%d.db"%len(contents)), batches[0])
+      start = time.time()
+      for batch in batches:
+        write(batch, connection.cursor())
+        connection.commit()
+      elapsed = time.time() - start
+      print("%-16s %8.2f s %10.0f rows/s %8.1f frames/s"%(name, elapsed, n_rows / elapsed, n_frames / elapsed))
+      contents.append({table: connection.execute("SELECT * FROM `%s_%s` ORDER BY rowid"%(sqlite_tag, table)).fetchall()
+                       for table, has_ids in frame_log_batch.tables})
+      connection.close()
+    assert contents[0] == contents[1], "The two paths wrote different rows"
+  finally:
+    shutil.rmtree(directory)
+  print("OK")
+
+def run(args):
+  sqlite = '--sqlite' in args
+  params = phil_scope.fetch(sources=[parse(arg) for arg in args if arg != '--sqlite']).extract()
+  if sqlite:
+    return run_sqlite(params)
+  assert params.experiment_tag is not None and params.input.trial is not None and params.input.run_num is not None
+  batch_size = params.batch_size or params.db.logging_batch_size
+  app = dxtbx_xfel_db_application(params, cache_connection=True)
+  db_run = app.get_run(run_number=params.input.run_num)
+  db_trial = app.get_trial(trial_number=params.input.trial)
+
+  rng = random.Random(0)
+  frames = [synthetic_frame(params.n_lattices, params.n_reflections, rng) for i in range(params.n_frames)]
+  batches = [frames[i:i + batch_size] for i in range(0, len(frames), batch_size)]
+  n_rows = 0
+  for batch in batches:
+    counter = frame_log_batch(params)
+    for experiments, reflections in batch:
+      counter.add_frame(experiments, reflections, db_run, db_trial, len(reflections))
+    n_rows += len(counter)
+  print("Logging %d frames of %d lattices, %d rows, in transactions of %d frames"%(
+    len(frames), params.n_lattices, n_rows, batch_size))
+
+  for name, log in [("SQL strings", log_with_sql_strings), ("Batched inserts", log_with_batches)]:
+    start = time.time()
+    for batch in batches:
+      log(app, params, batch, db_run, db_trial)
+    elapsed = time.time() - start
+    print("%-16s %8.2f s %10.0f rows/s %8.1f frames/s"%(name, elapsed, n_rows / elapsed, len(frames) / elapsed))
+
+if __name__ == "__main__":
+  run(sys.argv[1:])
@@ -1,8 +1,92 @@
 from __future__ import absolute_import, division, print_function
 from xfel.ui.db.xfel_db import xfel_db_application
 from xfel.ui.db.experiment import Imageset, Experiment, Event, Bin, Cell_Bin, Cell, Detector, Crystal, Beam
+from xfel.ui.db.experiment import beam_columns, detector_columns, crystal_columns, cell_columns
 from scitbx.array_family import flex
 
+# Asymmetric unit Miller indices by Hall symbol and d_min, generated for the first cell seen with a resolution margin of
+# index_cell_margin, so they cover every cell whose indices down to d_min fall within that margin
+index_cell_margin = 0.05
+max_index_sets = 100
+_index_sets = {}
+
+def reciprocal_metric(unit_cell):
+  import numpy as np
+  aa, bb, cc, ab, ac, bc = unit_cell.reciprocal_metrical_matrix()
+  return np.array([[aa, ab, ac], [ab, bb, bc], [ac, bc, cc]])
+
+def get_index_set(unit_cell, space_group, d_min, d_min_tolerance = 0):
+  ''' Asymmetric unit Miller indices of a space group containing all those of unit_cell with d >= d_min less
+      d_min_tolerance. The indices cached for the space group and d_min are reused when they provably cover the cell,
+      that is when the largest ratio of the cached cell's d* squared to this cell's, over all directions, keeps the
+      cached limit above d_min. Otherwise they are generated again for this cell. '''
+  import numpy as np
+  from cctbx.crystal import symmetry
+  key = (space_group.type().hall_symbol(), d_min)
+  metric = reciprocal_metric(unit_cell)
+  cached = _index_sets.get(key)
+  if cached is not None:
+    cached_metric, d_star_sq_max, indices = cached
+    ratio = max(np.linalg.eigvals(np.linalg.solve(metric, cached_metric)).real)
+    if ratio / (d_min * (1 - d_min_tolerance))**2 < d_star_sq_max:
+      return indices
+  d_min_generated = d_min * (1 - index_cell_margin)
+  cs = symmetry(unit_cell = unit_cell, space_group = space_group)
+  indices = cs.build_miller_set(anomalous_flag=False, d_min=d_min_generated).indices()
+  if len(_index_sets) >= max_index_sets:
+    _index_sets.clear()
+  _index_sets[key] = (metric, 1 / d_min_generated**2, indices)
+  return indices
+
+def get_binning_template(crystal, d_min, n_bins, d_min_tolerance = 1.e-6):
+  ''' Resolution bins of the full Miller set of a crystal to d_min, as made by build_miller_set and setup_binner. The
+      Miller indices come from get_index_set. The d spacings, bin edges and complete counts are computed from the exact
+      cell. The complete counts use the same complete set, to d_min less d_min_tolerance, as binner.counts_complete.
+      @return list of (bin number, d_max, d_min, number of Miller indices) for the bins in use, and numpy arrays of the
+      bins' d_max and d_min '''
+  import numpy as np
+  from cctbx import miller
+  from cctbx.crystal import symmetry
+  unit_cell = crystal.get_unit_cell()
+  space_group = crystal.get_space_group()
+  cs = symmetry(unit_cell = unit_cell, space_group = space_group)
+  indices = get_index_set(unit_cell, space_group, d_min, d_min_tolerance)
+  d_star_sq = unit_cell.d_star_sq(indices)
+  mset = miller.set(cs, indices.select(d_star_sq <= 1 / d_min**2), anomalous_flag=False)
+  binner = mset.setup_binner(n_bins=n_bins)
+  complete_d_min = mset.d_min() * (1 - d_min_tolerance)
+  complete_set = miller.set(cs, indices.select(d_star_sq <= 1 / complete_d_min**2), anomalous_flag=False)
+  counts_complete = miller.binner(binner, complete_set).counts()
+  bins = []
+  for i in binner.range_used():
+    bin_d_max, bin_d_min = binner.bin_d_range(i)
+    bins.append((i, bin_d_max, bin_d_min, counts_complete[i]))
+  return bins, np.array([float(b[1]) for b in bins]), np.array([float(b[2]) for b in bins])
+
+def bin_statistics(d, intensities, variances, bin_d_max, bin_d_min):
+  ''' Per-bin count, mean intensity, mean sigma and mean I/sigma of the reflections with positive intensity, in one
+      pass. A reflection is in a bin if bin d_min < d <= bin d_max.
+      @return numpy arrays of the counts and of the means, which are nan for empty bins '''
+  import numpy as np
+  n_bins = len(bin_d_max)
+  if n_bins == 0:
+    return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0), np.zeros(0)
+  # bins are in order of decreasing resolution limits, so the candidate bin of a reflection is the first whose d_min
+  # is below its d
+  candidate = np.searchsorted(-bin_d_min, -d, side='right')
+  candidate = np.minimum(candidate, n_bins - 1)
+  sel = (d > bin_d_min[candidate]) & (d <= bin_d_max[candidate]) & (intensities > 0)
+  bin_index = candidate[sel]
+  intensities = intensities[sel]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    sigmas = np.sqrt(variances[sel])
+    i_sigi = intensities / sigmas
+  counts = np.bincount(bin_index, minlength=n_bins)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    means = [np.bincount(bin_index, weights=values, minlength=n_bins) / counts
+             for values in (intensities, sigmas, i_sigi)]
+  return counts, means[0], means[1], means[2]
+
 def log_frame(experiments, reflections, params, run, n_strong, timestamp = None,
               two_theta_low = None, two_theta_high = None, db_event = None, app = None, trial = None):
   if app is None:
@@ -81,34 +165,152 @@ def log_frame(experiments, reflections, params, run, n_strong, timestamp = None,
     inserts += "INSERT INTO `%s_imageset_event` (imageset_id, event_id, event_run_id) VALUES (@imageset_id, @event_id, %d);\n" % (
       params.experiment_tag, db_run.id)
 
-    d = experiment.crystal.get_unit_cell().d(reflections['miller_index']).select(reflections['id']==i)
-    from cctbx.crystal import symmetry
-    cs = symmetry(unit_cell = experiment.crystal.get_unit_cell(), space_group = experiment.crystal.get_space_group())
-    mset = cs.build_miller_set(anomalous_flag=False, d_min=db_trial.d_min)
     n_bins = 10 # FIXME use n_bins as an attribute on the trial table
-    binner = mset.setup_binner(n_bins=n_bins)
-    for i in binner.range_used():
-      d_max, d_min = binner.bin_d_range(i)
-      Bin(app, number = i, d_min = d_min, d_max = d_max,
-          total_hkl = binner.counts_complete()[i], cell_id = '@cell_id')
+    bins, bin_d_max, bin_d_min = get_binning_template(experiment.crystal, db_trial.d_min, n_bins)
+    d = experiment.crystal.get_unit_cell().d(reflections_i['miller_index']).as_numpy_array()
+    counts, avg_intensity, avg_sigma, avg_i_sigi = bin_statistics(d,
+      reflections_i['intensity.sum.value'].as_numpy_array(),
+      reflections_i['intensity.sum.variance'].as_numpy_array(), bin_d_max, bin_d_min)
+    for j, (number, d_max, d_min, total_hkl) in enumerate(bins):
+      Bin(app, number = number, d_min = d_min, d_max = d_max,
+          total_hkl = total_hkl, cell_id = '@cell_id')
       save_last_id('bin')
 
-      sel = (d <= float(d_max)) & (d > float(d_min))
-      sel &= reflections_i['intensity.sum.value'] > 0
-      refls = reflections_i.select(sel)
-      n_refls = len(refls)
+      n_refls = int(counts[j])
       Cell_Bin(app,
                count = n_refls,
                bin_id = '@bin_id',
                crystal_id = '@crystal_id',
-               avg_intensity = flex.mean(refls['intensity.sum.value']) if n_refls > 0 else None,
-               avg_sigma = flex.mean(flex.sqrt(refls['intensity.sum.variance'])) if n_refls > 0 else None,
-               avg_i_sigi = flex.mean(refls['intensity.sum.value'] /
-                                      flex.sqrt(refls['intensity.sum.variance'])) if n_refls > 0 else None)
+               avg_intensity = float(avg_intensity[j]) if n_refls > 0 else None,
+               avg_sigma = float(avg_sigma[j]) if n_refls > 0 else None,
+               avg_i_sigi = float(avg_i_sigi[j]) if n_refls > 0 else None)
       inserts += app.last_query + ";\n"
   app.mode = 'execute'
   return inserts
 
+def sql_value(value):
+  ''' A column value as a query parameter, converted the way db_proxy writes values: booleans as integers, and None,
+      "None", empty strings and non-finite numbers as NULL '''
+  import math
+  if isinstance(value, bool):
+    return int(value)
+  if value is None or (isinstance(value, str) and value in ("None", "")):
+    return None
+  if isinstance(value, float) and not math.isfinite(value):
+    return None
+  return value
+
+class row_ref(object):
+  '''The id of a row of a frame_log_batch table, known once that table has been written'''
+  __slots__ = ['table', 'index']
+  def __init__(self, table, index):
+    self.table = table
+    self.index = index
+
+class frame_log_batch(object):
+  """
+  The rows a batch of frames adds to the database, gathered per table and written in one transaction, instead of
+  one INSERT and one SELECT LAST_INSERT_ID() per row (see log_frame). Tables whose ids are referenced by other rows
+  are written with multi-row INSERTs of up to rows_per_statement rows. The ids of the rows of such an INSERT are
+  consecutive from the id the server returns for its first row, in steps of auto_increment_increment, as InnoDB
+  guarantees for inserts of a known number of rows in every auto-increment lock mode. The other tables are written
+  with executemany. Rows refer to rows of other tables of the batch with row_refs, which are replaced by the ids of
+  the referenced rows when they are written.
+  """
+  # Tables in the order they are written, so that referenced rows are written first, and whether their ids are needed
+  tables = [('event', True), ('imageset', True), ('beam', True), ('detector', True), ('cell', True),
+            ('crystal', True), ('experiment', False), ('imageset_event', False), ('bin', True), ('cell_bin', False)]
+  rows_per_statement = 1000
+
+  def __init__(self, params):
+    self.params = params
+    self.rows = {table: [] for table, has_ids in self.tables}
+    self.n_frames = 0
+
+  def __len__(self):
+    return sum(len(rows) for rows in self.rows.values())
+
+  def add_row(self, table, **columns):
+    rows = self.rows[table]
+    rows.append(columns)
+    return row_ref(table, len(rows) - 1)
+
+  def add_frame(self, experiments, reflections, run, trial, n_strong, timestamp = None,
+                two_theta_low = None, two_theta_high = None, db_event = None):
+    ''' Add the rows of one frame, with the same content as log_frame '''
+    self.n_frames += 1
+    if db_event is None:
+      event_columns = dict(timestamp = timestamp, run_id = run.id, trial_id = trial.id, n_strong = n_strong,
+                           two_theta_low = two_theta_low, two_theta_high = two_theta_high)
+      if self.params.input.rungroup is not None:
+        event_columns['rungroup_id'] = self.params.input.rungroup
+      event = self.add_row('event', **event_columns)
+    else:
+      event = db_event.id
+
+    for i, experiment in enumerate(experiments or []):
+      reflections_i = reflections.select(reflections['id']==i)
+
+      imageset = self.add_row('imageset')
+      beam = self.add_row('beam', **beam_columns(experiment.beam))
+      detector = self.add_row('detector', **detector_columns(experiment.detector))
+      cell = self.add_row('cell', isoform_id = None, **cell_columns(experiment.crystal))
+      crystal = self.add_row('crystal', cell_id = cell, **crystal_columns(experiment.crystal))
+      self.add_row('experiment', imageset_id = imageset, beam_id = beam, detector_id = detector,
+                   crystal_id = crystal, crystal_cell_id = cell)
+      self.add_row('imageset_event', imageset_id = imageset, event_id = event, event_run_id = run.id)
+
+      n_bins = 10 # FIXME use n_bins as an attribute on the trial table
+      bins, bin_d_max, bin_d_min = get_binning_template(experiment.crystal, trial.d_min, n_bins)
+      d = experiment.crystal.get_unit_cell().d(reflections_i['miller_index']).as_numpy_array()
+      counts, avg_intensity, avg_sigma, avg_i_sigi = bin_statistics(d,
+        reflections_i['intensity.sum.value'].as_numpy_array(),
+        reflections_i['intensity.sum.variance'].as_numpy_array(), bin_d_max, bin_d_min)
+      for j, (number, d_max, d_min, total_hkl) in enumerate(bins):
+        db_bin = self.add_row('bin', number = number, d_min = d_min, d_max = d_max, total_hkl = total_hkl,
+                              cell_id = cell)
+        n_refls = int(counts[j])
+        self.add_row('cell_bin', count = n_refls, bin_id = db_bin, crystal_id = crystal,
+                     avg_intensity = float(avg_intensity[j]) if n_refls > 0 else None,
+                     avg_sigma = float(avg_sigma[j]) if n_refls > 0 else None,
+                     avg_i_sigi = float(avg_i_sigi[j]) if n_refls > 0 else None)
+
+  def write(self, cursor):
+    ''' Insert the rows with a MySQLdb cursor, in the current transaction. Returns the number of rows written. '''
+    tag = self.params.experiment_tag
+    cursor.execute("SELECT @@auto_increment_increment")
+    increment = int(cursor.fetchall()[0][0])
+    ids = {}
+
+    def resolve(value):
+      if isinstance(value, row_ref):
+        return ids[value.table][value.index]
+      return sql_value(value)
+
+    for table, has_ids in self.tables:
+      rows = self.rows[table]
+      if has_ids:
+        ids[table] = []
+      start = 0
+      while start < len(rows):
+        # rows of one statement must have the same columns
+        keys = list(rows[start])
+        end = start + 1
+        while end < len(rows) and end - start < self.rows_per_statement and list(rows[end]) == keys:
+          end += 1
+        values = [tuple(resolve(row[key]) for key in keys) for row in rows[start:end]]
+        query = "INSERT INTO `%s_%s` (%s) VALUES "%(tag, table, ", ".join(keys))
+        placeholders = "(%s)"%", ".join(["%s"] * len(keys))
+        if has_ids:
+          cursor.execute(query + ", ".join([placeholders] * len(values)),
+                         [value for row_values in values for value in row_values] or None)
+          first_id = cursor.lastrowid
+          ids[table].extend(first_id + k * increment for k in range(len(values)))
+        else:
+          cursor.executemany(query + placeholders, values)
+        start = end
+    return len(self)
+
 class dxtbx_xfel_db_application(xfel_db_application):
   def create_experiment(self, experiment):
     return Experiment(self, experiment=experiment)
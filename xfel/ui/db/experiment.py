@@ -4,6 +4,46 @@ from xfel.ui.db import db_proxy
 from scitbx.array_family import flex
 from six.moves import zip
 
+def beam_columns(beam):
+  u_s0 = beam.get_unit_s0()
+  return dict(direction_1 = u_s0[0], direction_2 = u_s0[1], direction_3 = u_s0[2], wavelength = beam.get_wavelength())
+
+def detector_columns(detector):
+  return dict(distance = flex.mean(flex.double([p.get_distance() for p in detector])))
+
+def crystal_columns(crystal):
+  from scitbx import matrix
+  columns = {}
+  u = matrix.sqr(crystal.get_U())  # orientation matrix
+  for i in range(len(u)):
+    columns['ori_%d' % (i + 1)] = u[i]
+  try:
+    columns['mosaic_block_rotation'] = crystal.get_half_mosaicity_deg()
+    columns['mosaic_block_size'] = crystal.get_domain_size_ang()
+  except AttributeError:
+    pass
+
+  if hasattr(crystal, 'identified_isoform'):
+    print("Warning, isoforms no longer have custom support in the database logger.")
+    #tag = app.params.experiment_tag
+    #query = """SELECT cell.id from `%s_cell` cell
+    #           JOIN `%s_isoform` isoform ON cell.isoform_id = isoform.id
+    #           JOIN `%s_trial` trial ON isoform.trial_id = trial.id
+    #           WHERE isoform.name = '%s' AND trial.trial = %d""" % (
+    #  tag, tag, tag, isoform_name, app.params.input.trial)
+    #cursor = app.execute_query(query)
+    #results = cursor.fetchall()
+    #assert len(results) == 1
+    #self.cell = Cell(app, cell_id = results[0][0])
+  return columns
+
+def cell_columns(crystal):
+  columns = {}
+  for key, p in zip(['a', 'b', 'c', 'alpha', 'beta', 'gamma'], crystal.get_unit_cell().parameters()):
+    columns['cell_%s'%key] = p
+  columns['lookup_symbol'] = crystal.get_space_group().type().lookup_symbol()
+  return columns
+
 class Event(db_proxy):
   def __init__(self, app, event_id = None, **kwargs):
     db_proxy.__init__(self, app, "%s_event" % app.params.experiment_tag, id = event_id, **kwargs)
@@ -42,11 +82,7 @@ class Beam(db_proxy):
   def __init__(self, app, beam_id = None, beam = None, **kwargs):
     assert [beam_id, beam].count(None) == 1
     if beam is not None:
-      u_s0 = beam.get_unit_s0()
-      kwargs['direction_1'] = u_s0[0]
-      kwargs['direction_2'] = u_s0[1]
-      kwargs['direction_3'] = u_s0[2]
-      kwargs['wavelength'] = beam.get_wavelength()
+      kwargs.update(beam_columns(beam))
 
     db_proxy.__init__(self, app, "%s_beam" % app.params.experiment_tag, id=beam_id, **kwargs)
     self.beam_id = self.id
@@ -55,37 +91,16 @@ class Detector(db_proxy):
   def __init__(self, app, detector_id = None, detector = None, **kwargs):
     assert [detector_id, detector].count(None) == 1
     if detector is not None:
-      kwargs['distance'] = flex.mean(flex.double([p.get_distance() for p in detector]))
+      kwargs.update(detector_columns(detector))
 
     db_proxy.__init__(self, app, "%s_detector" % app.params.experiment_tag, id=detector_id, **kwargs)
     self.detector_id = self.id
 
 class Crystal(db_proxy):
   def __init__(self, app, crystal_id = None, crystal = None, make_cell = True, **kwargs):
-    from scitbx import matrix
     assert [crystal_id, crystal].count(None) == 1
     if crystal is not None:
-      u = matrix.sqr(crystal.get_U())  # orientation matrix
-      for i in range(len(u)):
-        kwargs['ori_%d' % (i + 1)] = u[i]
-      try:
-        kwargs['mosaic_block_rotation'] = crystal.get_half_mosaicity_deg()
-        kwargs['mosaic_block_size'] = crystal.get_domain_size_ang()
-      except AttributeError:
-        pass
-
-      if hasattr(crystal, 'identified_isoform'):
-        print("Warning, isoforms no longer have custom support in the database logger.")
-        #tag = app.params.experiment_tag
-        #query = """SELECT cell.id from `%s_cell` cell
-        #           JOIN `%s_isoform` isoform ON cell.isoform_id = isoform.id
-        #           JOIN `%s_trial` trial ON isoform.trial_id = trial.id
-        #           WHERE isoform.name = '%s' AND trial.trial = %d""" % (
-        #  tag, tag, tag, isoform_name, app.params.input.trial)
-        #cursor = app.execute_query(query)
-        #results = cursor.fetchall()
-        #assert len(results) == 1
-        #self.cell = Cell(app, cell_id = results[0][0])
+      kwargs.update(crystal_columns(crystal))
 
       if make_cell:
         self.cell = Cell(app, crystal=crystal, isoform_id = None)
@@ -116,9 +131,7 @@ class Cell(db_proxy):
   def __init__(self, app, cell_id = None, crystal = None, init_bins = False, **kwargs):
     assert [cell_id, crystal].count(None) in [1,2]
     if crystal is not None:
-      for key, p in zip(['a', 'b', 'c', 'alpha', 'beta', 'gamma'], crystal.get_unit_cell().parameters()):
-        kwargs['cell_%s'%key] = p
-      kwargs['lookup_symbol'] = crystal.get_space_group().type().lookup_symbol()
+      kwargs.update(cell_columns(crystal))
     db_proxy.__init__(self, app, "%s_cell" % app.params.experiment_tag, id=cell_id, **kwargs)
     self.cell_id = self.id
 
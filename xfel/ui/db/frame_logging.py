@@ -1,7 +1,7 @@
 from __future__ import absolute_import, division, print_function
 
 from dials.command_line.stills_process import Processor
-from xfel.ui.db.dxtbx_db import log_frame, dxtbx_xfel_db_application
+from xfel.ui.db.dxtbx_db import frame_log_batch, dxtbx_xfel_db_application
 from xfel.ui.db.run import Run
 from xfel.ui.db.trial import Trial
 
@@ -58,7 +58,7 @@ class DialsProcessorWithLogging(Processor):
   def log_batched_frames(self):
     current_run = self.params.input.run_num
     current_dbrun = self.run
-    inserts = "BEGIN;\n" # start a transaction
+    batch = frame_log_batch(self.params)
     for q in self.queries:
       experiments, reflections, run, n_strong, timestamp, two_theta_low, two_theta_high, db_event = q
       if run != current_run:
@@ -67,25 +67,11 @@ class DialsProcessorWithLogging(Processor):
         current_dbrun = self.db_app.get_run(run_number=run)
         self.db_app.mode = "cache_commits"
 
-      inserts += log_frame(experiments, reflections, self.params, current_dbrun, n_strong, timestamp = timestamp,
-                           two_theta_low = two_theta_low, two_theta_high = two_theta_high,
-                           db_event = db_event, app = self.db_app, trial = self.trial)
-    inserts += "COMMIT;\n"
-
-    # patch up query so for example '@row_id' becomes @row_id
-    newinserts = []
-    for line in inserts.split('\n'):
-      if '@' in line:
-        newline = []
-        for word in line.split(' '):
-          if '@' in word:
-            word = word.replace("'", "")
-          newline.append(word)
-        line = ' '.join(newline)
-      newinserts.append(line)
-    inserts = '\n'.join(newinserts)
-
-    self.db_app.execute_query(inserts, commit=False) # transaction, so don't commit twice
+      batch.add_frame(experiments, reflections, current_dbrun, self.trial, n_strong, timestamp = timestamp,
+                      two_theta_low = two_theta_low, two_theta_high = two_theta_high, db_event = db_event)
+
+    if len(batch) > 0:
+      self.db_app.execute_transaction(batch.write) # one transaction per batch of db.logging_batch_size frames
     self.queries = []
 
   def log_frame(self, experiments, reflections, run, n_strong, timestamp = None,
@@ -1,9 +1,13 @@
 from __future__ import absolute_import, division, print_function
 from six.moves import range
+import time
 from scitbx.array_family import flex
 
 class Stats(object):
-  def __init__(self, app, trial, tags = None, isigi_cutoff = None, tag_selection_mode="union", selected_runs = None, selected_rungroup = None):
+  def __init__(self, app, trial, tags = None, isigi_cutoff = None, tag_selection_mode="union", selected_runs = None, selected_rungroup = None,
+               summary = None):
+    ''' If summary is a CellBinSummary of this trial and isigi_cutoff, the cell x bin counts are taken from it instead of
+        being queried from scratch '''
     self.app = app
     self.trial = trial
     if tags is None:
@@ -14,6 +18,9 @@ class Stats(object):
     self.tag_selection_mode = tag_selection_mode
     self.selected_runs = selected_runs
     self.selected_rungroup = selected_rungroup
+    self.summary = summary
+    if summary is not None:
+      assert summary.trial_id == trial.id and summary.isigi_cutoff == isigi_cutoff
 
   def __call__(self):
     runs = []
@@ -21,10 +28,16 @@ class Stats(object):
     if self.selected_runs is not None:
       assert self.selected_rungroup is not None
       selected_run_ids = [r.id for r in self.selected_runs]
+    rungroup_run_ids = {} # active rungroup id: its run ids, for the summary to detect changes
     for rungroup in self.trial.rungroups:
-      if self.selected_rungroup is not None and self.selected_rungroup.id != rungroup.id:
+      skip = self.selected_rungroup is not None and self.selected_rungroup.id != rungroup.id
+      if skip and self.summary is None:
         continue
-      for run in rungroup.runs:
+      rungroup_runs = rungroup.runs
+      rungroup_run_ids[rungroup.id] = frozenset(run.id for run in rungroup_runs)
+      if skip:
+        continue
+      for run in rungroup_runs:
         if self.selected_runs is not None:
           if run.id not in selected_run_ids:
             continue
@@ -46,9 +59,15 @@ class Stats(object):
           runs.append(run)
           run_numbers.append(run.run)
 
+    if self.summary is not None:
+      self.summary.check_selection(rungroup_run_ids)
+
     if len(runs) == 0:
       return []
 
+    if self.summary is not None:
+      return self.summary([r.id for r in runs])
+
     runs_str = "(%s)"%(", ".join([str(r.id) for r in runs]))
     tag = self.app.params.experiment_tag
 
@@ -95,8 +114,37 @@ class Stats(object):
 
     return cells
 
+def hitrate_indexed_events_query(tag, trial_id, run_id, rungroup_id, i_sigi_cutoff, min_event_id = 0):
+  ''' Per-event statistics of the indexed events with an id above min_event_id, in one query '''
+  return """SELECT event.id, event.timestamp, event.n_strong, MIN(bin.d_min), event.two_theta_low, event.two_theta_high, COUNT(DISTINCT crystal.id)
+            FROM `%s_event` event
+            JOIN `%s_imageset_event` is_e ON is_e.event_id = event.id
+            JOIN `%s_imageset` imgset ON imgset.id = is_e.imageset_id
+            JOIN `%s_experiment` exp ON exp.imageset_id = imgset.id
+            JOIN `%s_crystal` crystal ON crystal.id = exp.crystal_id
+            JOIN `%s_cell` cell ON cell.id = crystal.cell_id
+            JOIN `%s_bin` bin ON bin.cell_id = cell.id
+            JOIN `%s_cell_bin` cb ON cb.bin_id = bin.id AND cb.crystal_id = crystal.id
+            WHERE event.trial_id = %d AND event.run_id = %d AND event.rungroup_id = %d AND
+                  cb.avg_i_sigi >= %f AND event.id > %d
+            GROUP BY event.id
+         """ % (tag, tag, tag, tag, tag, tag, tag, tag, trial_id, run_id, rungroup_id, i_sigi_cutoff, min_event_id)
+
+def hitrate_unindexed_events_query(tag, trial_id, run_id, rungroup_id, min_event_id = 0):
+  ''' Per-event statistics of the events with an id above min_event_id that failed to index. This left join query
+      finds the events with no imageset. '''
+  return """SELECT event.id, event.timestamp, event.n_strong, event.two_theta_low, event.two_theta_high
+            FROM `%s_event` event
+            LEFT JOIN `%s_imageset_event` is_e ON is_e.event_id = event.id
+            WHERE is_e.event_id IS NULL AND
+                  event.trial_id = %d AND event.run_id = %d AND event.rungroup_id = %d AND event.id > %d
+         """ % (tag, tag, trial_id, run_id, rungroup_id, min_event_id)
+
 class HitrateStats(object):
-  def __init__(self, app, run_number, trial_number, rungroup_id, d_min = None, i_sigi_cutoff = 1, raw_data_sampling = 1):
+  def __init__(self, app, run_number, trial_number, rungroup_id, d_min = None, i_sigi_cutoff = 1, raw_data_sampling = 1,
+               summary = None):
+    ''' If summary is a HitrateSummary of this trial, run, rungroup, d_min and i_sigi_cutoff, the per-event rows are
+        taken from it instead of being queried from scratch '''
     self.app = app
     self.run = app.get_run(run_number = run_number)
     self.trial = app.get_trial(trial_number = trial_number)
@@ -104,6 +152,10 @@ class HitrateStats(object):
     self.d_min = d_min
     self.i_sigi_cutoff = i_sigi_cutoff
     self.sampling = raw_data_sampling
+    self.summary = summary
+    if summary is not None:
+      assert (summary.trial_id, summary.run_id, summary.rungroup_id, summary.d_min, summary.i_sigi_cutoff) == \
+             (self.trial.id, self.run.id, self.rungroup.id, d_min, i_sigi_cutoff)
 
   def __call__(self):
     from iotbx.detectors.cspad_detector_formats import reverse_timestamp
@@ -114,10 +166,15 @@ class HitrateStats(object):
     assert self.run.run in run_numbers
     rungroup_ids = [rg.id for rg in self.trial.rungroups]
     assert self.rungroup.id in rungroup_ids
-    if len(self.trial.isoforms) > 0:
+    n_trial_bins = 0
+    if self.summary is not None and self.summary.has_high_res_bins:
+      cells = [] # cells are never removed, so once a high resolution bin has been found there is no need to look again
+    elif len(self.trial.isoforms) > 0:
       cells = [isoform.cell for isoform in self.trial.isoforms]
     else:
-      cells = self.app.get_trial_cells(self.trial.id, self.rungroup.id, self.run.id)
+      # only whether a qualifying bin exists matters here, so count the bins instead of building the trial cells
+      cells = []
+      n_trial_bins = self.app.count_trial_cell_bins(self.trial.id, self.rungroup.id, self.run.id, d = self.d_min)
 
     high_res_bin_ids = []
     for cell in cells:
@@ -132,69 +189,55 @@ class HitrateStats(object):
         if len(qualified_bin_indices) == 0: continue
         min_bin_index = qualified_bin_indices[0]
       high_res_bin_ids.append(str(bins[min_bin_index].id))
+    has_high_res_bins = len(high_res_bin_ids) > 0 or n_trial_bins > 0 or \
+      (self.summary is not None and self.summary.has_high_res_bins)
+
+    tag = self.app.params.experiment_tag
+    if self.summary is not None:
+      indexed_rows, unindexed_rows = self.summary(has_high_res_bins)
+    else:
+      indexed_rows = []
+      if has_high_res_bins:
+        indexed_rows = self.app.execute_query(hitrate_indexed_events_query(
+          tag, self.trial.id, self.run.id, self.rungroup.id, self.i_sigi_cutoff)).fetchall()
+      unindexed_rows = self.app.execute_query(hitrate_unindexed_events_query(
+        tag, self.trial.id, self.run.id, self.rungroup.id)).fetchall()
 
     resolutions = flex.double()
     two_theta_low = flex.double()
     two_theta_high = flex.double()
-    tag = self.app.params.experiment_tag
     timestamps, timestamps_s = flex.double(), []
     n_strong = flex.int()
     n_lattices = flex.int()
-    if len(high_res_bin_ids) > 0:
-
-      # Get the stats in one query.
-      query = """SELECT event.timestamp, event.n_strong, MIN(bin.d_min), event.two_theta_low, event.two_theta_high, COUNT(DISTINCT crystal.id)
-                 FROM `%s_event` event
-                 JOIN `%s_imageset_event` is_e ON is_e.event_id = event.id
-                 JOIN `%s_imageset` imgset ON imgset.id = is_e.imageset_id
-                 JOIN `%s_experiment` exp ON exp.imageset_id = imgset.id
-                 JOIN `%s_crystal` crystal ON crystal.id = exp.crystal_id
-                 JOIN `%s_cell` cell ON cell.id = crystal.cell_id
-                 JOIN `%s_bin` bin ON bin.cell_id = cell.id
-                 JOIN `%s_cell_bin` cb ON cb.bin_id = bin.id AND cb.crystal_id = crystal.id
-                 WHERE event.trial_id = %d AND event.run_id = %d AND event.rungroup_id = %d AND
-                       cb.avg_i_sigi >= %f
-                 GROUP BY event.id
-              """ % (tag, tag, tag, tag, tag, tag, tag, tag, self.trial.id, self.run.id, self.rungroup.id, self.i_sigi_cutoff)
-      cursor = self.app.execute_query(query)
-      sample = -1
-      for row in cursor.fetchall():
-        sample += 1
-        if sample % self.sampling != 0:
-          continue
-        ts, n_s, d_min, tt_low, tt_high, n_xtal = row
-        try:
-          d_min = float(d_min)
-        except ValueError:
-          d_min = None
+    sample = -1
+    for row in indexed_rows:
+      sample += 1
+      if sample % self.sampling != 0:
+        continue
+      event_id, ts, n_s, d_min, tt_low, tt_high, n_xtal = row
+      try:
+        d_min = float(d_min)
+      except ValueError:
+        d_min = None
+      try:
+        rts = reverse_timestamp(ts)
+        timestamps.append(rts[0] + (rts[1]/1000))
+      except ValueError:
         try:
-          rts = reverse_timestamp(ts)
-          timestamps.append(rts[0] + (rts[1]/1000))
+          timestamps.append(float(ts))
         except ValueError:
-          try:
-            timestamps.append(float(ts))
-          except ValueError:
-            timestamps_s.append(ts)
-        n_strong.append(n_s)
-        two_theta_low.append(tt_low or -1)
-        two_theta_high.append(tt_high or -1)
-        resolutions.append(d_min or 0)
-        n_lattices.append(n_xtal or 0)
+          timestamps_s.append(ts)
+      n_strong.append(n_s)
+      two_theta_low.append(tt_low or -1)
+      two_theta_high.append(tt_high or -1)
+      resolutions.append(d_min or 0)
+      n_lattices.append(n_xtal or 0)
 
     # only get results that are strings or ints, not a mix of both
     assert not (len(timestamps) > 0 and len(timestamps_s) > 0)
 
-    # This left join query finds the events with no imageset, meaning they failed to index
-    query = """SELECT event.timestamp, event.n_strong, event.two_theta_low, event.two_theta_high
-               FROM `%s_event` event
-               LEFT JOIN `%s_imageset_event` is_e ON is_e.event_id = event.id
-               WHERE is_e.event_id IS NULL AND
-                     event.trial_id = %d AND event.run_id = %d AND event.rungroup_id = %d
-            """ % (tag, tag, self.trial.id, self.run.id, self.rungroup.id)
-
-    cursor = self.app.execute_query(query)
-    for row in cursor.fetchall():
-      ts, n_s, tt_low, tt_high = row
+    for row in unindexed_rows:
+      event_id, ts, n_s, tt_low, tt_high = row
       try:
         rts = reverse_timestamp(ts)
         timestamps.append(rts[0] + (rts[1]/1000))
@@ -318,3 +361,259 @@ class SpotfinderStats(object):
 
     t2 = time.time()
     return timestamps, n_strong
+
+class EventWatermark(object):
+  ''' Tracks which events have been counted in an incremental summary. Frames are logged in transactions, so an event
+      becomes visible together with its experiments and cell bins, but concurrent loggers can commit event ids out of
+      order. Each poll therefore reads the events above a low watermark that trails the counted events by settle_time
+      seconds, and skips the events it has already counted. Transactions are assumed to commit within settle_time. '''
+  def __init__(self, settle_time = 60):
+    self.settle_time = settle_time
+    self.low = 0 # all events with an id at or below low have been counted
+    self.counted = {} # event id: time it was counted, for the counted events above low
+
+  def new_events(self, event_ids):
+    ''' Mark the given events as counted, returning the set of those not counted before '''
+    now = time.time()
+    new = set(event_ids).difference(self.counted)
+    for event_id in new:
+      self.counted[event_id] = now
+    return new
+
+  def advance(self):
+    ''' Raise the low watermark over the events counted more than settle_time ago '''
+    now = time.time()
+    settled = [event_id for event_id, counted_time in self.counted.items() if now - counted_time > self.settle_time]
+    if len(settled) > 0:
+      self.low = max(self.low, max(settled))
+      self.counted = {event_id: counted_time for event_id, counted_time in self.counted.items() if event_id > self.low}
+
+class IncrementalSummary(object):
+  ''' Statistics kept up to date between the polls of a GUI sentinel by querying only the events added since the
+      previous poll. The work of each poll is recorded in last_poll and printed if db.verbose is set, so it can be
+      checked that it depends on the rate of incoming events rather than on the size of the experiment. '''
+  def __init__(self, app):
+    self.app = app
+    self.n_events = 0
+    self.n_polls = 0
+    self.last_poll = None
+    self.selection = None
+
+  def reset(self):
+    ''' Forget everything counted, so that the next poll queries all events again '''
+    self.n_events = 0
+
+  def check_selection(self, rungroup_runs):
+    ''' Reset the summary if the active rungroups of the trial changed, or if runs were removed from one of them, since
+        the previous call. rungroup_runs maps each active rungroup id to the set of its run ids. Runs added to a
+        rungroup need no reset, as their events are found by the next poll. '''
+    if self.selection is not None and (set(rungroup_runs) != set(self.selection) or
+        any(not runs <= rungroup_runs[rungroup_id] for rungroup_id, runs in self.selection.items())):
+      if self.app.params.db.verbose:
+        print("%s: active rungroups or runs changed, starting over" % self.__class__.__name__)
+      self.reset()
+    self.selection = rungroup_runs
+
+  def report_poll(self, n_rows, n_new_events, seconds, summed_entries = None):
+    ''' Record the work of a poll: rows fetched, new events and, for summaries that keep running totals, the number of
+        entries added to or subtracted from them '''
+    self.n_polls += 1
+    self.n_events += n_new_events
+    self.last_poll = dict(rows = n_rows, new_events = n_new_events, events = self.n_events, seconds = seconds)
+    if summed_entries is not None:
+      self.last_poll['summed_entries'] = summed_entries
+    if self.app.params.db.verbose:
+      print("%s poll %d: %d rows fetched, %d new events, %d events in total, %s%.3f s" % (
+        self.__class__.__name__, self.n_polls, n_rows, n_new_events, self.n_events,
+        "" if summed_entries is None else "%d entries summed, "%summed_entries, seconds))
+
+class CellBinSummary(IncrementalSummary):
+  ''' Per-run cell x bin reflection counts of a trial, as used by Stats, maintained incrementally. The totals of the
+      selected runs are kept with the cells they involve, and each call only adds the counts of the new events, and
+      adds or subtracts the counts of the runs that entered or left the selection. The per-run counts of unselected
+      runs are dropped beyond max_unselected_entries, and queried again if those runs are selected again. '''
+  max_cells = 20000 # cells kept with their bins between calls; unselected cells are dropped beyond this
+  max_unselected_entries = 200000 # (cell, bin) counts kept for runs outside the selection
+
+  def __init__(self, app, trial, isigi_cutoff = None, settle_time = 60):
+    IncrementalSummary.__init__(self, app)
+    self.trial_id = trial.id
+    self.isigi_cutoff = isigi_cutoff
+    self.settle_time = settle_time
+    self.reset()
+
+  def reset(self):
+    IncrementalSummary.reset(self)
+    self.watermark = EventWatermark(self.settle_time)
+    self.run_counts = {} # run id: {(cell id, bin id): count}, in the order the runs were first seen
+    self.dropped_runs = set() # runs whose counts were dropped while unselected
+    self.selected_runs = frozenset()
+    self.totals = {} # (cell id, bin id): count over the selected runs
+    self.cell_entries = {} # cell id: number of its (cell id, bin id) entries in self.totals
+    self.cells = {} # cell id: cell with its bins linked, in the order they were fetched
+    self.bins = {} # (cell id, bin id): bin of a cell in self.cells
+    self.new_cell_ids = set() # cells entering the totals that are not in self.cells
+
+  def query(self, condition):
+    tag = self.app.params.experiment_tag
+    query = """SELECT evt.id, run.id, cell.id, bin.id, cell_bin.count FROM `%s_cell_bin` cell_bin
+               JOIN `%s_bin` bin ON bin.id = cell_bin.bin_id
+               JOIN `%s_cell` cell ON cell.id = bin.cell_id
+               JOIN `%s_crystal` crystal ON crystal.id = cell_bin.crystal_id
+               JOIN `%s_experiment` exp ON exp.crystal_id = crystal.id
+               JOIN `%s_imageset` imgset ON imgset.id = exp.imageset_id
+               JOIN `%s_imageset_event` ie ON ie.imageset_id = imgset.id
+               JOIN `%s_event` evt ON evt.id = ie.event_id
+               JOIN `%s_run` run ON run.id = evt.run_id
+               JOIN `%s_rungroup` rg ON rg.id = evt.rungroup_id
+               JOIN `%s_trial_rungroup` t_rg ON t_rg.rungroup_id = rg.id
+               JOIN `%s_trial` trial ON trial.id = t_rg.trial_id AND trial.id = evt.trial_id
+               WHERE %s
+                     AND cell_bin.avg_intensity > 0
+                     AND trial.id = %d
+                     AND rg.active = True
+                     """ % (
+      tag, tag, tag, tag, tag, tag, tag, tag, tag, tag, tag, tag, condition, self.trial_id)
+    if self.isigi_cutoff is not None and self.isigi_cutoff >= 0:
+      query += " AND cell_bin.avg_i_sigi >= %f"%self.isigi_cutoff
+    return self.app.execute_query(query).fetchall()
+
+  def add_to_totals(self, key, count):
+    total = self.totals.get(key, 0) + count
+    cell_id = key[0]
+    if key not in self.totals:
+      if cell_id not in self.cell_entries and cell_id not in self.cells:
+        self.new_cell_ids.add(cell_id)
+      self.cell_entries[cell_id] = self.cell_entries.get(cell_id, 0) + 1
+    if total == 0:
+      del self.totals[key]
+      self.cell_entries[cell_id] -= 1
+      if self.cell_entries[cell_id] == 0:
+        del self.cell_entries[cell_id]
+    else:
+      self.totals[key] = total
+    if key in self.bins:
+      self.bins[key].count = total
+    self.n_summed += 1
+
+  def update(self):
+    ''' Add the cell bin counts of the events logged since the previous update. Returns the number of rows fetched and
+        of new events. '''
+    results = self.query("evt.id > %d"%self.watermark.low)
+    new_events = self.watermark.new_events([r[0] for r in results])
+    for event_id, run_id, cell_id, bin_id, count in results:
+      if event_id in new_events and run_id not in self.dropped_runs:
+        counts = self.run_counts.setdefault(run_id, {})
+        counts[(cell_id, bin_id)] = counts.get((cell_id, bin_id), 0) + count
+        if run_id in self.selected_runs:
+          self.add_to_totals((cell_id, bin_id), count)
+    self.watermark.advance()
+    return len(results), len(new_events)
+
+  def fetch_run(self, run_id):
+    ''' Query again the counts of a run that were dropped, limited to the events counted so far. Later events are
+        added by update. '''
+    counted = self.watermark.counted
+    results = self.query("run.id = %d AND evt.id <= %d"%(run_id, max([self.watermark.low] + list(counted))))
+    counts = self.run_counts.setdefault(run_id, {})
+    for event_id, run_id, cell_id, bin_id, count in results:
+      if event_id <= self.watermark.low or event_id in counted:
+        counts[(cell_id, bin_id)] = counts.get((cell_id, bin_id), 0) + count
+    self.dropped_runs.discard(run_id)
+    return len(results)
+
+  def select(self, run_ids):
+    ''' Move the totals to a new selection of runs, returning the number of rows fetched for dropped runs '''
+    run_ids = frozenset(run_ids)
+    n_rows = 0
+    for run_id in self.selected_runs - run_ids:
+      for key, count in self.run_counts.get(run_id, {}).items():
+        self.add_to_totals(key, -count)
+    for run_id in run_ids - self.selected_runs:
+      if run_id in self.dropped_runs:
+        n_rows += self.fetch_run(run_id)
+      for key, count in self.run_counts.get(run_id, {}).items():
+        self.add_to_totals(key, count)
+    self.selected_runs = run_ids
+
+    # drop the counts of the runs outside the selection seen first
+    unselected = [run_id for run_id in self.run_counts if run_id not in run_ids]
+    n_unselected_entries = sum(len(self.run_counts[run_id]) for run_id in unselected)
+    for run_id in unselected:
+      if n_unselected_entries <= self.max_unselected_entries:
+        break
+      n_unselected_entries -= len(self.run_counts.pop(run_id))
+      self.dropped_runs.add(run_id)
+    return n_rows
+
+  def __call__(self, run_ids):
+    ''' Update the summary and return the cells with counts in the given runs, with the counts set on their bins '''
+    t1 = time.time()
+    self.n_summed = 0
+    n_rows, n_new_events = self.update()
+    n_rows += self.select(run_ids)
+
+    new_cell_ids = [str(cell_id) for cell_id in self.new_cell_ids if cell_id in self.cell_entries]
+    self.new_cell_ids = set()
+    if len(new_cell_ids) > 0:
+      from .experiment import Cell
+      cells = self.app.get_all_x(Cell, 'cell', where = "WHERE id IN (%s)"%", ".join(new_cell_ids))
+      self.app.link_cell_bins(cells)
+      for cell in cells:
+        self.cells[cell.id] = cell
+        for bin in cell.bins:
+          self.bins[(cell.id, bin.id)] = bin
+          bin.count = self.totals.get((cell.id, bin.id), 0)
+
+    n_drop = len(self.cells) - max(self.max_cells, len(self.cell_entries))
+    if n_drop > 0:
+      # drop the oldest cells not in use by the selection
+      for cell_id in [cell_id for cell_id in self.cells if cell_id not in self.cell_entries][:n_drop]:
+        for bin in self.cells.pop(cell_id).bins:
+          del self.bins[(cell_id, bin.id)]
+
+    self.report_poll(n_rows, n_new_events, time.time() - t1, summed_entries = self.n_summed)
+    return [self.cells[cell_id] for cell_id in self.cell_entries]
+
+class HitrateSummary(IncrementalSummary):
+  ''' Per-event rows of HitrateStats for one run and rungroup of a trial, maintained incrementally '''
+  def __init__(self, app, trial_id, run_id, rungroup_id, d_min = None, i_sigi_cutoff = 1, settle_time = 60):
+    IncrementalSummary.__init__(self, app)
+    self.trial_id = trial_id
+    self.run_id = run_id
+    self.rungroup_id = rungroup_id
+    self.d_min = d_min
+    self.i_sigi_cutoff = i_sigi_cutoff
+    self.settle_time = settle_time
+    self.reset()
+
+  def reset(self):
+    IncrementalSummary.reset(self)
+    self.has_high_res_bins = False
+    self.indexed_rows = []
+    self.unindexed_rows = []
+    self.indexed_watermark = EventWatermark(self.settle_time)
+    self.unindexed_watermark = EventWatermark(self.settle_time)
+
+  def fetch(self, query, watermark, rows):
+    results = self.app.execute_query(query).fetchall()
+    new_events = watermark.new_events([r[0] for r in results])
+    rows.extend([r for r in results if r[0] in new_events])
+    watermark.advance()
+    return len(results), len(new_events)
+
+  def __call__(self, has_high_res_bins):
+    ''' Update the summary and return the indexed and unindexed event rows, the former sorted by event id. Indexed
+        events are only queried once the trial has a high resolution bin for this run, as in HitrateStats. '''
+    t1 = time.time()
+    tag = self.app.params.experiment_tag
+    n_rows = n_new_events = 0
+    if has_high_res_bins:
+      self.has_high_res_bins = True
+      n_rows, n_new_events = self.fetch(hitrate_indexed_events_query(tag, self.trial_id, self.run_id, self.rungroup_id,
+        self.i_sigi_cutoff, min_event_id = self.indexed_watermark.low), self.indexed_watermark, self.indexed_rows)
+      self.indexed_rows.sort(key = lambda row: row[0]) # nearly sorted already
+    n_unindexed_rows, n_new_unindexed_events = self.fetch(hitrate_unindexed_events_query(tag, self.trial_id, self.run_id,
+      self.rungroup_id, min_event_id = self.unindexed_watermark.low), self.unindexed_watermark, self.unindexed_rows)
+    self.report_poll(n_rows + n_unindexed_rows, n_new_events + n_new_unindexed_events, time.time() - t1)
+    return self.indexed_rows, self.unindexed_rows
@@ -1,6 +1,6 @@
 from __future__ import absolute_import, division, print_function
 
-import os, time
+import os, threading, time
 import libtbx.load_env
 from libtbx.utils import Sorry
 
@@ -14,14 +14,16 @@ from xfel.ui.db.experiment import Cell, Bin, Isoform, Event
 from xfel.ui.db.dataset import Dataset, DatasetVersion
 from xfel.ui.db.task import Task
 
-from xfel.ui.db import get_db_connection
+from xfel.ui.db import get_db_connection, get_connection_pool, connection_pool_stats
 from six.moves import range
 import six
 from six.moves import zip
 
 from xfel.command_line.experiment_manager import initialize as initialize_base
 
-CACHED_CONNECT_TIMEOUT = 300
+# Columns of the tables by database server, database and experiment tag, read once per process
+_columns_dicts = {}
+_columns_dicts_lock = threading.Lock()
 
 class initialize(initialize_base):
   expected_tables = ["run", "job", "rungroup", "trial", "tag", "run_tag", "event", "trial_rungroup",
@@ -291,12 +293,25 @@ class dummy_cursor(object):
   def fetchall(self):
     return self.prefetched
 
+# MySQL errors after which a query or transaction is run again on a fresh connection
+retry_strings = [
+    "MySQL server has gone away",
+    "max_user_connections",
+    "is not allowed to connect to this MariaDB server",
+    "Can't connect to MySQL server",
+    "Lost connection to MySQL server",
+    "Deadlock found when trying to get lock",
+    "WSREP has not yet prepared node for application use",
+]
+
 class db_application(object):
-  def __init__(self, params, cache_connection = True, mode = 'execute'):
+  def __init__(self, params, cache_connection = True, mode = 'execute', read_replica = False):
+    ''' @param cache_connection if False, connections are closed after each query instead of being returned to the
+        connection pool
+        @param read_replica if True and db.replica.host is set, read-only queries are sent to the replica '''
     self.params = params
-    self.dbobj = None
-    self.dbobj_refreshed_time = None
     self.cache_connection = cache_connection
+    self.read_replica = read_replica
     self.query_count = 0
     self.mode = mode
     self.last_query = None
@@ -306,95 +321,187 @@ class db_application(object):
       assert val in ['execute', 'cache_commits']
     return super(db_application, self).__setattr__(prop, val)
 
-  def execute_query(self, query, commit=True):
+  def use_replica(self, query):
+    ''' Whether to send a query to the read replica: only plain reads, and only if this application reads from it '''
+    if not self.read_replica or not getattr(getattr(self.params.db, 'replica', None), 'host', None):
+      return False
+    query = query.lstrip().upper()
+    return query.startswith(('SELECT', 'SHOW')) and ';' not in query.rstrip().rstrip(';') and \
+      all([s not in query for s in ['LAST_INSERT_ID', ' INTO ', 'FOR UPDATE', 'LOCK IN SHARE MODE']])
+
+  def print_query_time(self, query_time, query):
+    if query_time > 1:
+      print('Query % 6d SQLTime Taken = % 10.6f seconds' % (self.query_count, query_time), query[:min(len(query),145)])
+      for stats in connection_pool_stats():
+        print('  Connection pool', stats)
+
+  def run_with_retries(self, pool, run, description, query=None, rollback=False):
+    """ Call run(dbobj) on a connection acquired from pool, and give the connection back for reuse. If the
+        connection can't be made, is lost or deadlocks, it is discarded and run is called again on a fresh connection,
+        with exponential backoff, up to 10 times.
+        @param description what is run, used in the messages ("query" or "transaction")
+        @param query the query text, printed on errors
+        @param rollback if True, a failed connection is rolled back before it is discarded
+        @return the return value of run """
     from MySQLdb import OperationalError
 
-    if self.mode == 'cache_commits' and commit:
-      self.last_query = query
-      return
-
-    if self.params.db.verbose:
-      st = time.time()
-      self.query_count += 1
-
     retry_count = 0
     retry_max = 10
     sleep_time = 0.1
     while retry_count < retry_max:
+      dbobj = None
       try:
-
-        # Get the (maybe cached) connection
-        # We enable autocommit on the connection by default, to avoid stale
-        # reads arising from unclosed transactions. See:
-        # https://stackoverflow.com/questions/1617637/pythons-mysqldb-not-getting-updated-row
-        if not commit: # connection caching is not attempted if commit=False
-          dbobj = get_db_connection(self.params, autocommit=False)
-        elif (
-            self.dbobj is None
-            or time.time() - self.dbobj_refreshed_time > CACHED_CONNECT_TIMEOUT
-        ):
-          dbobj = get_db_connection(self.params, autocommit=True)
-          self.dbobj_refreshed_time = time.time()
-          if self.cache_connection:
-            self.dbobj = dbobj
-        else:
-          dbobj = self.dbobj
-
-        sql_cursor = dbobj.cursor()
-        sql_cursor.execute(query)
-        cursor = dummy_cursor(sql_cursor)
-        sql_cursor.close()
-
-        if self.params.db.verbose:
-          et = time.time() - st
-          if et > 1:
-            print('Query % 6d SQLTime Taken = % 10.6f seconds' % (self.query_count, et), query[:min(len(query),145)])
-        return cursor
+        dbobj = pool.acquire()
+        query_start = time.time()
+        result = run(dbobj)
+        pool.release(dbobj, keep=self.cache_connection, query_time=time.time() - query_start)
+        return result
       except OperationalError as e:
-        reconnect_strings = [
-            "MySQL server has gone away",
-            "max_user_connections",
-            "is not allowed to connect to this MariaDB server",
-        ]
-        retry_strings = [
-            "Can't connect to MySQL server",
-            "Lost connection to MySQL server",
-            "Deadlock found when trying to get lock",
-            "WSREP has not yet prepared node for application use",
-        ]
-        if any([s in str(e) for s in reconnect_strings]):
-          self.dbobj = None
-        elif all([s not in str(e) for s in retry_strings]):
-          print(query)
+        if dbobj is not None:
+          if rollback:
+            try:
+              dbobj.rollback()
+            except OperationalError:
+              pass
+          pool.release(dbobj, keep=False)
+        if all([s not in str(e) for s in retry_strings]):
+          if query is not None:
+            print(query)
           raise e
         retry_count += 1
-        print("Couldn't connect to MYSQL, retry", retry_count)
+        print("Couldn't execute MYSQL %s, retry"%description, retry_count)
         time.sleep(sleep_time)
         sleep_time *= 2
       except Exception as e:
-        print("Couldn't execute MYSQL query.  Query:")
-        print(query)
+        if dbobj is not None:
+          if rollback:
+            dbobj.rollback()
+          pool.release(dbobj, keep=False)
+        print("Couldn't execute MYSQL %s."%description)
+        if query is not None:
+          print("Query:")
+          print(query)
         print("Exception:")
         print(str(e))
         raise e
-    raise Sorry("Couldn't execute MYSQL query. Too many reconnects. Query: %s"%query)
+    raise Sorry("Couldn't execute MYSQL %s. Too many reconnects.%s"%(description, " Query: %s"%query if query is not None else ""))
+
+  def execute_query(self, query, commit=True):
+    if self.mode == 'cache_commits' and commit:
+      self.last_query = query
+      return
+
+    if self.params.db.verbose:
+      st = time.time()
+      self.query_count += 1
+
+    # Connections come from a pool shared by the threads of this process. We enable autocommit on the connections
+    # by default, to avoid stale reads arising from unclosed transactions. See:
+    # https://stackoverflow.com/questions/1617637/pythons-mysqldb-not-getting-updated-row
+    # Queries with commit=False are multi-statement transactions, run on connections without autocommit.
+    pool = get_connection_pool(self.params, autocommit=commit, replica=self.use_replica(query))
+
+    def run(dbobj):
+      sql_cursor = dbobj.cursor()
+      sql_cursor.execute(query)
+      cursor = dummy_cursor(sql_cursor)
+      if not commit:
+        # read the results of all the statements, so that the connection can be reused
+        while sql_cursor.nextset():
+          pass
+        dbobj.commit()
+      sql_cursor.close()
+      return cursor
+    cursor = self.run_with_retries(pool, run, "query", query=query)
+
+    if self.params.db.verbose:
+      self.print_query_time(time.time() - st, query)
+    return cursor
+
+  def stream_query(self, query, chunk_size = 10000):
+    """ Run a query with a server-side cursor, which reads the rows from the server as they are consumed instead of
+        fetching them all into memory first. The query isn't retried, and its connection is held until the generator
+        is exhausted or closed.
+        @return generator of lists of at most chunk_size rows """
+    import MySQLdb.cursors
+    if self.params.db.verbose:
+      st = time.time()
+      self.query_count += 1
+    pool = get_connection_pool(self.params, replica=self.use_replica(query))
+    dbobj = pool.acquire()
+    query_start = time.time()
+    keep = False
+    try:
+      sql_cursor = dbobj.cursor(MySQLdb.cursors.SSCursor)
+      sql_cursor.execute(query)
+      while True:
+        rows = sql_cursor.fetchmany(chunk_size)
+        if len(rows) == 0:
+          break
+        yield list(rows)
+      sql_cursor.close()
+      keep = self.cache_connection
+    finally:
+      # a connection with unread rows can't be reused
+      pool.release(dbobj, keep=keep, query_time=time.time() - query_start)
+    if self.params.db.verbose:
+      self.print_query_time(time.time() - st, query)
+
+  def execute_transaction(self, write):
+    """ Run write(cursor) in a single transaction on a pooled connection, and commit it. If the connection is lost
+        or the transaction deadlocks, it is rolled back and write is called again on a fresh connection.
+        @param write function taking a MySQLdb cursor, which may execute any number of queries
+        @return the return value of write """
+    if self.params.db.verbose:
+      st = time.time()
+      self.query_count += 1
+
+    pool = get_connection_pool(self.params, autocommit=False)
+
+    def run(dbobj):
+      sql_cursor = dbobj.cursor()
+      result = write(sql_cursor)
+      dbobj.commit()
+      sql_cursor.close()
+      return result
+    result = self.run_with_retries(pool, run, "transaction", rollback=True)
+
+    if self.params.db.verbose:
+      self.print_query_time(time.time() - st, "transaction")
+    return result
 
 class xfel_db_application(db_application):
   def __init__(self, params, drop_tables = False, verify_tables = False, **kwargs):
     super(xfel_db_application, self).__init__(params, **kwargs)
-    dbobj = get_db_connection(params)
-    init_tables = initialize(params, dbobj)
+    key = (params.db.host, params.db.port, params.db.name, params.experiment_tag)
+    with _columns_dicts_lock:
+      columns_dict = _columns_dicts.get(key)
+
+    if columns_dict is None or drop_tables or verify_tables:
+      # Dropping, verifying and creating tables run on initialize's dbobj, a connection checked out of the pool for
+      # this call. It isn't given back for reuse, as these multi-statement queries may leave unread results.
+      # set_up_columns_dict runs its queries through this application and needs no connection of its own.
+      pool = get_connection_pool(params)
+      dbobj = pool.acquire() if drop_tables or verify_tables else None
+      try:
+        init_tables = initialize(params, dbobj)
 
-    if drop_tables:
-      init_tables.drop_tables()
+        if drop_tables:
+          init_tables.drop_tables()
 
-    if verify_tables and not init_tables.verify_tables():
-      init_tables.create_tables()
-      print('Creating experiment tables...')
-      if not init_tables.verify_tables():
-        raise Sorry("Couldn't create experiment tables")
+        if verify_tables and not init_tables.verify_tables():
+          init_tables.create_tables()
+          print('Creating experiment tables...')
+          if not init_tables.verify_tables():
+            raise Sorry("Couldn't create experiment tables")
+      finally:
+        if dbobj is not None:
+          pool.release(dbobj, keep=False)
 
-    self.columns_dict = init_tables.set_up_columns_dict(self)
+      columns_dict = init_tables.set_up_columns_dict(self)
+      with _columns_dicts_lock:
+        _columns_dicts[key] = columns_dict
+    self.columns_dict = columns_dict
 
   def list_lcls_runs(self):
     if self.params.facility.lcls.web.location is None or len(self.params.facility.lcls.web.location) == 0:
@@ -511,8 +618,7 @@ class xfel_db_application(db_application):
     else:
       return cells[0]
 
-  def get_trial_cells(self, trial_id, rungroup_id = None, run_id = None):
-    # Use big queries to assist listing lots of cells. Start with list of cells for this trial
+  def _get_trial_cells_where(self, trial_id, rungroup_id = None, run_id = None):
     tag = self.params.experiment_tag
     if rungroup_id is not None or run_id is not None:
       assert rungroup_id is not None and run_id is not None
@@ -520,7 +626,7 @@ class xfel_db_application(db_application):
     else:
       extra_where = ""
 
-    where  = """JOIN `%s_crystal` crystal ON crystal.cell_id = cell.id
+    return """JOIN `%s_crystal` crystal ON crystal.cell_id = cell.id
                JOIN `%s_experiment` expt ON expt.crystal_id = crystal.id
                JOIN `%s_imageset` imgset ON imgset.id = expt.imageset_id
                JOIN `%s_imageset_event` is_e ON is_e.imageset_id = imgset.id
@@ -529,10 +635,26 @@ class xfel_db_application(db_application):
                JOIN `%s_rungroup` rg ON evt.rungroup_id = rg.id
                WHERE trial.id = %d AND rg.active = True %s""" % (
                tag, tag, tag, tag, tag, tag, tag, trial_id, extra_where)
+
+  def get_trial_cells(self, trial_id, rungroup_id = None, run_id = None):
+    # Use big queries to assist listing lots of cells. Start with list of cells for this trial
+    tag = self.params.experiment_tag
+    where = self._get_trial_cells_where(trial_id, rungroup_id, run_id)
     cells = self.get_all_x(Cell, 'cell', where)
     where = " JOIN `%s_cell` cell ON bin.cell_id = cell.id "%(tag) + where
     return self.link_cell_bins(cells, where = where)
 
+  def count_trial_cell_bins(self, trial_id, rungroup_id = None, run_id = None, d = None):
+    """ Count the resolution bins of the cells get_trial_cells would return, without building the cells
+        @param d if given, only count the bins whose resolution range includes d
+        @return number of bins """
+    tag = self.params.experiment_tag
+    query = "SELECT COUNT(DISTINCT bin.id) FROM `%s_bin` bin JOIN `%s_cell` cell ON bin.cell_id = cell.id "%(tag, tag) + \
+      self._get_trial_cells_where(trial_id, rungroup_id, run_id)
+    if d is not None:
+      query += " AND bin.d_max >= %f AND bin.d_min <= %f"%(d, d)
+    return int(self.execute_query(query).fetchall()[0][0])
+
   def link_cell_bins(self, cells, where = None):
     tag = self.params.experiment_tag
     cells_d = {cell.id:cell for cell in cells}
@@ -861,40 +983,132 @@ class xfel_db_application(db_application):
 
     self.delete_x(job, job_id)
 
-  def get_all_events(self, trial = None, runs = None, only_indexed = True, isoform = None, where = None):
+  # Columns of the event table by name for count_events_by, and the join needed to group by isoform
+  event_group_columns = {'run': 'event.run_id', 'rungroup': 'event.rungroup_id', 'trial': 'event.trial_id',
+                         'isoform': 'cell.isoform_id'}
+
+  @staticmethod
+  def _strip_where(where):
+    where = where.strip()
+    if where.upper().startswith("WHERE"):
+      where = where[len("WHERE"):].strip()
+    return where
+
+  def _get_events_where(self, trial = None, runs = None, only_indexed = True, isoform = None, where = None,
+                        join_cells = False):
+    """ Build the JOIN/WHERE clause that selects the events of get_all_events. Returns None if no event can match.
+        If join_cells is True, the events are joined to their cells, even when no isoform is given. """
     tag = self.params.experiment_tag
     if where is None:
       final_where = ""
     else:
       final_where = where.strip()
     where = ""
-    if only_indexed or isoform is not None:
+    if only_indexed or isoform is not None or join_cells:
       where = " JOIN `%s_imageset_event` is_e ON event.id = is_e.event_id"%tag
+    if isoform is not None or join_cells:
+      where += """ JOIN `%s_imageset` imgset ON imgset.id = is_e.imageset_id
+                   JOIN `%s_experiment` exp ON exp.imageset_id = imgset.id
+                   JOIN `%s_crystal` crystal ON crystal.id = exp.crystal_id
+                   JOIN `%s_cell` cell ON cell.id = crystal.cell_id"""%(tag, tag, tag, tag)
+    conditions = []
+    if isoform is not None:
+      where += " JOIN `%s_isoform` isoform ON isoform.id = cell.isoform_id"%tag
+      conditions.append("isoform.id = %s"%isoform.id)
     if trial is not None:
       if runs is None:
         runs = trial.runs
       if len(runs) == 0:
-        return []
-      if isoform is None:
-        where += " WHERE"
-      else:
-        where += """ JOIN `%s_imageset` imgset ON imgset.id = is_e.imageset_id
-                     JOIN `%s_experiment` exp ON exp.imageset_id = imgset.id
-                     JOIN `%s_crystal` crystal ON crystal.id = exp.crystal_id
-                     JOIN `%s_cell` cell ON cell.id = crystal.cell_id
-                     JOIN `%s_isoform` isoform ON isoform.id = cell.isoform_id
-                     WHERE isoform.id = %s AND"""%(tag, tag, tag, tag, tag, isoform.id)
-      where += " event.trial_id = %d AND event.run_id in (%s)" % (
-        trial.id, ", ".join([str(r.id) for r in runs]))
+        return None
+      conditions.append("event.trial_id = %d AND event.run_id in (%s)" % (
+        trial.id, ", ".join([str(r.id) for r in runs])))
 
       if 'rungroup_id' in self.columns_dict["%s_%s" % (tag, 'event')]: # some backwards compatibility, as event.rungroup_id was added late to the schema
         rungroups = ", ".join([str(rg.id) for rg in trial.rungroups])
         if len(rungroups) > 0:
-          where += " AND event.rungroup_id in (%s)"%rungroups
+          conditions.append("event.rungroup_id in (%s)"%rungroups)
+
+    final_where = self._strip_where(final_where)
+    if len(final_where) > 0:
+      conditions.append(final_where)
+    if len(conditions) > 0:
+      where += " WHERE " + " AND ".join(conditions)
+    return where
+
+  def get_all_events(self, trial = None, runs = None, only_indexed = True, isoform = None, where = None):
+    where = self._get_events_where(trial, runs, only_indexed, isoform, where)
+    if where is None:
+      return []
+    return self.get_all_x(Event, "event", where)
 
-    if len(where) > 0 and len(final_where) > 0:
-      final_where = "AND " + final_where.lstrip("WHERE")
-    return self.get_all_x(Event, "event", where + " " + final_where)
+  def count_events(self, trial = None, runs = None, only_indexed = True, isoform = None, where = None):
+    """ Number of events get_all_events would return, counted by the database instead of building an Event per row """
+    where = self._get_events_where(trial, runs, only_indexed, isoform, where)
+    if where is None:
+      return 0
+    tag = self.params.experiment_tag
+    query = "SELECT COUNT(*) FROM `%s_event` event %s"%(tag, where)
+    return int(self.execute_query(query).fetchall()[0][0])
+
+  def count_events_by(self, group_by, trial = None, runs = None, only_indexed = True, where = None):
+    """ Number of events per run, rungroup, trial or isoform, or per combination of these
+        @param group_by a name from event_group_columns, or a tuple of names
+        @return keys, counts: numpy integer arrays, keys of shape (n,) for one name, or (n, len(group_by)) for a tuple.
+        Grouping by isoform only counts the events with a lattice whose cell belongs to an isoform. """
+    import numpy as np
+    names = (group_by,) if isinstance(group_by, str) else tuple(group_by)
+    for name in names:
+      assert name in self.event_group_columns, "Can't group events by %s"%name
+    columns = [self.event_group_columns[name] for name in names]
+    join_cells = 'isoform' in names
+    if join_cells:
+      where = "cell.isoform_id IS NOT NULL" + ("" if where is None else " AND " + self._strip_where(where))
+    where = self._get_events_where(trial, runs, only_indexed, None, where, join_cells = join_cells)
+    if where is None:
+      rows = []
+    else:
+      tag = self.params.experiment_tag
+      query = "SELECT %s, COUNT(*) FROM `%s_event` event %s GROUP BY %s"%(
+        ", ".join(columns), tag, where, ", ".join(columns))
+      rows = self.execute_query(query).fetchall()
+    keys = np.array([row[:-1] for row in rows], dtype=np.int64).reshape(len(rows), len(names))
+    counts = np.array([row[-1] for row in rows], dtype=np.int64)
+    if isinstance(group_by, str):
+      keys = keys[:,0]
+    return keys, counts
+
+  def iter_event_columns(self, columns, trial = None, runs = None, only_indexed = True, isoform = None, where = None,
+                         chunk_size = 100000):
+    """ Stream columns of the events get_all_events would select, in chunks ordered by event id, without building
+        Event objects. The rows are read with a server-side cursor, so only one chunk is held in memory at a time.
+        @param columns names of columns of the event table
+        @return generator of dicts of column name to numpy array, one per chunk. NULLs become nan in numeric columns. """
+    import numpy as np
+    tag = self.params.experiment_tag
+    for column in columns:
+      assert column in self.columns_dict["%s_%s" % (tag, 'event')], "No column %s in the event table"%column
+    where = self._get_events_where(trial, runs, only_indexed, isoform, where)
+    if where is None:
+      return
+    select = ", ".join(["event.id"] + ["event.%s"%column for column in columns])
+    query = "SELECT DISTINCT %s FROM `%s_event` event %s ORDER BY event.id"%(select, tag, where)
+    for rows in self.stream_query(query, chunk_size = chunk_size):
+      chunk = {}
+      for i, column in enumerate(columns):
+        values = [row[i+1] for row in rows]
+        if any(isinstance(v, (str, bytes)) for v in values):
+          chunk[column] = np.array(values, dtype=object)
+        else:
+          chunk[column] = np.array([np.nan if v is None else v for v in values], dtype=float)
+      yield chunk
+
+  def get_event_columns(self, columns, trial = None, runs = None, only_indexed = True, isoform = None, where = None):
+    """ Columns of the events get_all_events would select, as a dict of column name to numpy array """
+    import numpy as np
+    chunks = list(self.iter_event_columns(columns, trial, runs, only_indexed, isoform, where))
+    if len(chunks) == 0:
+      return {column: np.array([], dtype=float) for column in columns}
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in columns}
 
   def get_stats(self, **kwargs):
     return Stats(self, **kwargs)